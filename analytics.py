@@ -0,0 +1,286 @@
+# analytics.py
+"""Spending breakdowns by event, month, famille, sous_famille and fournisseur.
+
+Amounts are aggregated into the ``spending_rollup`` table as articles and
+receipts are written, by the triggers declared here and installed by the
+database migrations. Breakdowns are then answered from the rollup, whose
+rows number the distinct combinations of dimensions, instead of scanning
+the articles table. The rollup is keyed by the integer ids of the dimension
+tables (see dimensions.py); names are only joined to the grouped rows.
+"""
+import sqlite3
+import logging
+from collections import namedtuple
+
+from instrumentation import instrumented
+from dimensions import DIMENSION_TABLES, dimension_key
+
+logger = logging.getLogger(__name__)
+
+# Dimensions disponibles, dans l'ordre de la clé primaire de spending_rollup
+DIMENSIONS = ('event_id', 'month', 'famille', 'sous_famille', 'fournisseur')
+
+# Tolérance sur les montants cumulés, les additions successives de flottants pouvant dériver
+ROLLUP_TOLERANCE = 1e-6
+
+# key contient les valeurs des dimensions demandées, dans l'ordre de la demande
+SpendingRow = namedtuple('SpendingRow', ['key', 'total', 'article_count'])
+
+# Clé d'agrégation de spending_rollup : colonnes de famille et sous-famille (articles), de fournisseur
+# (receipts), leur type et la valeur stockée à la place d'une valeur absente
+_RollupKey = namedtuple('_RollupKey', ['famille', 'sous_famille', 'fournisseur', 'type', 'missing'])
+# Noms en texte, jusqu'à la migration 9
+_TEXT_KEY = _RollupKey('famille', 'sous_famille', 'fournisseur', 'TEXT', "''")
+# Identifiants des tables de dimensions (dimensions.py), depuis la migration 9
+_ID_KEY = _RollupKey('famille_id', 'sous_famille_id', 'fournisseur_id', 'INTEGER', '0')
+
+
+def _key_columns(key):
+    return f"event_id, month, {key.famille}, {key.sous_famille}, {key.fournisseur}"
+
+
+def _key_values(key, r, a):
+    # Clé d'agrégation d'un article {a} de ticket {r}; les valeurs absentes sont remplacées
+    # pour que la clé primaire reste unique
+    return (f"COALESCE({r}.event_id, 0), COALESCE(strftime('%Y-%m', {r}.date), ''), "
+            f"COALESCE({a}.{key.famille}, {key.missing}), COALESCE({a}.{key.sous_famille}, {key.missing}), "
+            f"COALESCE({r}.{key.fournisseur}, {key.missing})")
+
+
+def _upsert(key, select):
+    return f'''
+            INSERT INTO spending_rollup ({_key_columns(key)}, total, article_count)
+            {select}
+            ON CONFLICT ({_key_columns(key)}) DO UPDATE SET
+                total = total + excluded.total,
+                article_count = article_count + excluded.article_count;'''
+
+
+def _add_article(key, article):
+    # La clause WHERE lève l'ambiguïté entre ON CONFLICT et une jointure
+    return _upsert(key, f'''SELECT {_key_values(key, 'r', article)}, COALESCE({article}.prix_total, 0), 1
+            FROM receipts r WHERE r.id = {article}.receipt_id''')
+
+
+def _remove_article(key, article):
+    return f'''
+            UPDATE spending_rollup SET total = total - COALESCE({article}.prix_total, 0), article_count = article_count - 1
+            WHERE ({_key_columns(key)}) = (SELECT {_key_values(key, 'r', article)} FROM receipts r WHERE r.id = {article}.receipt_id);'''
+
+
+def _add_receipt(key, receipt):
+    return _upsert(key, f'''SELECT {_key_values(key, receipt, 'a')}, SUM(COALESCE(a.prix_total, 0)), COUNT(*)
+            FROM articles a WHERE a.receipt_id = {receipt}.id
+            GROUP BY COALESCE(a.{key.famille}, {key.missing}), COALESCE(a.{key.sous_famille}, {key.missing})''')
+
+
+def _remove_receipt(key, receipt):
+    return f'''
+            UPDATE spending_rollup SET total = spending_rollup.total - g.total, article_count = spending_rollup.article_count - g.article_count
+            FROM (SELECT COALESCE(a.{key.famille}, {key.missing}) AS famille, COALESCE(a.{key.sous_famille}, {key.missing}) AS sous_famille,
+                         SUM(COALESCE(a.prix_total, 0)) AS total, COUNT(*) AS article_count
+                  FROM articles a WHERE a.receipt_id = {receipt}.id
+                  GROUP BY 1, 2) AS g
+            WHERE spending_rollup.event_id = COALESCE({receipt}.event_id, 0)
+                AND spending_rollup.month = COALESCE(strftime('%Y-%m', {receipt}.date), '')
+                AND spending_rollup.{key.fournisseur} = COALESCE({receipt}.{key.fournisseur}, {key.missing})
+                AND spending_rollup.{key.famille} = g.famille AND spending_rollup.{key.sous_famille} = g.sous_famille;'''
+
+
+def _prune(event_id):
+    # Les combinaisons vidées sont supprimées, limitées à l'évènement concerné (préfixe de la clé)
+    return f"DELETE FROM spending_rollup WHERE event_id = COALESCE({event_id}, 0) AND article_count <= 0;"
+
+
+def _rebuild_rollup(key):
+    return [
+        "DELETE FROM spending_rollup",
+        f'''
+    INSERT INTO spending_rollup ({_key_columns(key)}, total, article_count)
+    SELECT {_key_values(key, 'r', 'a')}, SUM(COALESCE(a.prix_total, 0)), COUNT(*)
+    FROM articles a JOIN receipts r ON r.id = a.receipt_id
+    GROUP BY 1, 2, 3, 4, 5
+    ''',
+    ]
+
+
+def _rollup_schema(key):
+    return [
+        f'''
+    CREATE TABLE IF NOT EXISTS spending_rollup (
+        event_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        {key.famille} {key.type} NOT NULL,
+        {key.sous_famille} {key.type} NOT NULL,
+        {key.fournisseur} {key.type} NOT NULL,
+        total REAL NOT NULL DEFAULT 0,
+        article_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY ({_key_columns(key)})
+    ) WITHOUT ROWID
+    ''',
+        # Ventilations par mois sur tous les évènements
+        "CREATE INDEX IF NOT EXISTS idx_spending_rollup_month ON spending_rollup (month)",
+        *_rebuild_rollup(key),
+        f'''
+    CREATE TRIGGER IF NOT EXISTS trg_articles_insert_rollup AFTER INSERT ON articles
+    BEGIN{_add_article(key, 'NEW')}
+    END
+    ''',
+        f'''
+    CREATE TRIGGER IF NOT EXISTS trg_articles_delete_rollup AFTER DELETE ON articles
+    BEGIN{_remove_article(key, 'OLD')}
+            {_prune('(SELECT event_id FROM receipts WHERE id = OLD.receipt_id)')}
+    END
+    ''',
+        f'''
+    CREATE TRIGGER IF NOT EXISTS trg_articles_update_rollup AFTER UPDATE OF receipt_id, {key.famille}, {key.sous_famille}, prix_total ON articles
+    BEGIN{_remove_article(key, 'OLD')}{_add_article(key, 'NEW')}
+            {_prune('(SELECT event_id FROM receipts WHERE id = OLD.receipt_id)')}
+    END
+    ''',
+        # Un ticket supprimé retire ses articles de la ventilation, même s'ils restent en base
+        f'''
+    CREATE TRIGGER IF NOT EXISTS trg_receipts_delete_rollup AFTER DELETE ON receipts
+    BEGIN{_remove_receipt(key, 'OLD')}
+            {_prune('OLD.event_id')}
+    END
+    ''',
+        f'''
+    CREATE TRIGGER IF NOT EXISTS trg_receipts_update_rollup AFTER UPDATE OF event_id, date, {key.fournisseur} ON receipts
+    BEGIN{_remove_receipt(key, 'OLD')}{_add_receipt(key, 'NEW')}
+            {_prune('OLD.event_id')}
+    END
+    ''',
+    ]
+
+
+# Table et triggers installés par la migration 4 de database.py, sur les noms en texte
+ROLLUP_SCHEMA = _rollup_schema(_TEXT_KEY)
+
+# Retrait de la ventilation en texte par la migration 9, avant la suppression des colonnes de noms
+DROP_ROLLUP = [
+    *(f"DROP TRIGGER IF EXISTS {trigger}" for trigger in (
+        'trg_articles_insert_rollup', 'trg_articles_delete_rollup', 'trg_articles_update_rollup',
+        'trg_receipts_delete_rollup', 'trg_receipts_update_rollup')),
+    "DROP TABLE IF EXISTS spending_rollup",
+]
+
+# Ventilation sur les identifiants des dimensions, installée par la migration 9
+DICTIONARY_ROLLUP_SCHEMA = _rollup_schema(_ID_KEY)
+
+# Recalcul complet de spending_rollup, utilisé par rebuild_rollup
+REBUILD_ROLLUP = _rebuild_rollup(_ID_KEY)
+
+# Colonne de spending_rollup de chaque dimension et, pour celles encodées, la table de leurs noms
+_DIMENSION_COLUMNS = {'event_id': 'event_id', 'month': 'month', 'famille': _ID_KEY.famille,
+                      'sous_famille': _ID_KEY.sous_famille, 'fournisseur': _ID_KEY.fournisseur}
+
+
+@instrumented('analytics.breakdown')
+def select_breakdown(cursor, dimensions, event_ids=None, start_month=None, end_month=None, filters=None):
+    """Sum spending from the rollup, grouped by ``dimensions``.
+
+    ``dimensions`` is a sequence taken from DIMENSIONS; an empty one gives the
+    grand total. ``event_ids`` restricts to some events, ``start_month`` and
+    ``end_month`` ('YYYY-MM', inclusive) to a period, and ``filters`` maps a
+    dimension to the only value to keep. Rows come largest total first.
+    """
+    dimensions = list(dimensions)
+    filters = dict(filters or {})
+    unknown = [name for name in dimensions + list(filters) if name not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown spending dimensions: {', '.join(unknown)}")
+
+    conditions = []
+    params = []
+    if event_ids is not None:
+        event_ids = list(event_ids)
+        conditions.append(f"event_id IN ({', '.join('?' * len(event_ids))})")
+        params.extend(event_ids)
+    if start_month is not None:
+        conditions.append("month >= ?")
+        params.append(start_month)
+    if end_month is not None:
+        conditions.append("month <= ?")
+        params.append(end_month)
+    for name, value in filters.items():
+        if name in DIMENSION_TABLES:
+            # Filtre sur l'identifiant, trouvé par la clé normalisée du nom
+            conditions.append(f"{_DIMENSION_COLUMNS[name]} = COALESCE((SELECT id FROM {DIMENSION_TABLES[name]} WHERE key = ?), 0)")
+            params.append(dimension_key(value))
+        else:
+            conditions.append(f"{name} = ?")
+            params.append(value)
+
+    # Regroupement sur les entiers de spending_rollup, les noms n'étant joints qu'aux lignes du résultat
+    columns = [_DIMENSION_COLUMNS[name] for name in dimensions]
+    outputs = []
+    joins = []
+    for index, name in enumerate(dimensions):
+        if name in DIMENSION_TABLES:
+            outputs.append(f"COALESCE(d{index}.name, '')")
+            joins.append(f"LEFT JOIN {DIMENSION_TABLES[name]} d{index} ON d{index}.id = g.{columns[index]}")
+        else:
+            outputs.append(f"g.{columns[index]}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    group_by = f"GROUP BY {', '.join(dict.fromkeys(columns))}" if columns else ""
+    cursor.execute(f'''
+            SELECT {''.join(output + ', ' for output in outputs)}g.total, g.article_count
+            FROM (
+                SELECT {''.join(column + ', ' for column in dict.fromkeys(columns))}SUM(total) AS total, SUM(article_count) AS article_count
+                FROM spending_rollup
+                {where}
+                {group_by}
+                HAVING SUM(article_count) > 0
+            ) AS g
+            {' '.join(joins)}
+            ORDER BY g.total DESC
+        ''', params)
+    return [SpendingRow(tuple(row[:-2]), row[-2], row[-1]) for row in cursor.fetchall()]
+
+
+def spending_breakdown(db_path, dimensions, event_ids=None, start_month=None, end_month=None, filters=None):
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            return select_breakdown(conn.cursor(), dimensions, event_ids, start_month, end_month, filters)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error("Error computing spending breakdown: %s", e)
+        raise
+
+
+def find_rollup_mismatches(cursor):
+    # Compare la ventilation stockée à un recalcul depuis les articles, dans les deux sens
+    key_columns = _key_columns(_ID_KEY)
+    cursor.execute(f'''
+            WITH expected ({key_columns}, total, article_count) AS (
+                SELECT {_key_values(_ID_KEY, 'r', 'a')}, SUM(COALESCE(a.prix_total, 0)), COUNT(*)
+                FROM articles a JOIN receipts r ON r.id = a.receipt_id
+                GROUP BY 1, 2, 3, 4, 5
+            )
+            SELECT {', '.join('s.' + column for column in key_columns.split(', '))}, s.total, COALESCE(e.total, 0)
+            FROM spending_rollup s LEFT JOIN expected e USING ({key_columns})
+            WHERE e.total IS NULL OR ABS(s.total - e.total) > ? OR s.article_count != e.article_count
+            UNION ALL
+            SELECT {', '.join('e.' + column for column in key_columns.split(', '))}, 0, e.total
+            FROM expected e LEFT JOIN spending_rollup s USING ({key_columns})
+            WHERE s.total IS NULL
+        ''', (ROLLUP_TOLERANCE,))
+    return cursor.fetchall()
+
+
+def rebuild_rollup(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        for statement in REBUILD_ROLLUP:
+            conn.execute(statement)
+        conn.commit()
+        logger.info("Spending rollup rebuilt.")
+    except Exception as e:
+        conn.rollback()
+        logger.error("Error rebuilding spending rollup: %s", e)
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,279 @@
+# batch_processor.py
+import os
+import logging
+from collections import namedtuple, deque
+from itertools import islice, repeat
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import jobs
+import metrics
+from instrumentation import instrumented, span
+import receipt_reader
+import image_preprocessing
+
+logger = logging.getLogger(__name__)
+
+# Nombre de tickets envoyés en parallèle à l'API (modifiable via RECEIPT_MAX_WORKERS)
+DEFAULT_MAX_WORKERS = int(os.getenv('RECEIPT_MAX_WORKERS', '4'))
+# Délai maximal de prise en compte d'une annulation, en secondes
+CANCEL_POLL_INTERVAL = 0.2
+# Nombre de jobs réclamés à la fois par process_jobs, chacun sous bail jusqu'à son traitement
+CLAIM_SIZE = 20
+
+# Résultat du traitement d'une image: error est None si le ticket a été enregistré,
+# metrics les mesures des appels à l'API faits pour elle (metrics.ImageMetrics)
+ImageResult = namedtuple('ImageResult', ['image_path', 'parsed_data', 'error', 'bytes_saved', 'metrics'],
+                         defaults=[0, None])
+
+
+def _bytes_sent(image_path, image_data):
+    if image_data is not None:
+        return len(image_data)
+    try:
+        return os.path.getsize(image_path)
+    except OSError:
+        return 0
+
+
+def _image_metrics(image_path, image_data, request_metrics, output_mode=None):
+    # L'image part une fois dans chaque requête faite pour elle
+    output_mode = output_mode or receipt_reader.OUTPUT_MODE
+    if not request_metrics:
+        return metrics.summarize_requests(request_metrics, 0, output_mode)
+    return metrics.summarize_requests(request_metrics, _bytes_sent(image_path, image_data) * len(request_metrics),
+                                      output_mode)
+
+
+def _read_prepared(image_path, api_key, image_data, bytes_saved, cache, request_metrics=None, output_mode=None):
+    request_metrics = request_metrics if request_metrics is not None else []
+    try:
+        parsed_data = receipt_reader.read_receipt(image_path, api_key, image_data=image_data, cache=cache,
+                                                  metrics=request_metrics)
+    except Exception as e:
+        logger.error("Error reading image %s: %s", os.path.basename(image_path), e)
+        return ImageResult(image_path, None, str(e), bytes_saved, _image_metrics(image_path, image_data, request_metrics, output_mode))
+    if not parsed_data:
+        logger.warning("Data parsing incomplete for %s", os.path.basename(image_path))
+        return ImageResult(image_path, None, "Les données extraites sont incorrectes", bytes_saved,
+                           _image_metrics(image_path, image_data, request_metrics, output_mode))
+    return ImageResult(image_path, parsed_data, None, bytes_saved, _image_metrics(image_path, image_data, request_metrics, output_mode))
+
+
+@instrumented('pipeline.read_image')
+def read_image(image_path, api_key, preprocessed=None, cache=None):
+    """Encode, send and parse one image in a worker thread.
+
+    HTTP and parse retries happen inside receipt_reader on the already
+    encoded payload. ``preprocessed`` is an optional future resolving to a
+    PreprocessedImage; its bytes are sent instead of the original file.
+    ``cache`` is an optional ResponseCache consulted before calling the API.
+    """
+    image_data = None
+    bytes_saved = 0
+    if preprocessed is not None:
+        try:
+            with span('pipeline.preprocess_wait'):
+                prepared = preprocessed.result()
+            image_data, bytes_saved = prepared.data, prepared.bytes_saved
+        except Exception as e:
+            logger.error("Error preprocessing image %s: %s", os.path.basename(image_path), e)
+            return ImageResult(image_path, None, str(e))
+    return _read_prepared(image_path, api_key, image_data, bytes_saved, cache)
+
+
+@instrumented('pipeline.read_batch')
+def read_batch(image_paths, api_key, preprocessed=None, cache=None):
+    """Read several images with a single API request and return one ImageResult per image.
+
+    ``preprocessed`` is an optional list of futures, one per image, as for
+    read_image. Images missing from the combined answer, or whose part of it
+    does not parse, are read again one by one; so are all of them if the
+    batch request itself fails.
+    """
+    prepared = []
+    results = {}
+    for index, image_path in enumerate(image_paths):
+        image_data, bytes_saved = None, 0
+        if preprocessed is not None:
+            try:
+                with span('pipeline.preprocess_wait'):
+                    prepared_image = preprocessed[index].result()
+                image_data, bytes_saved = prepared_image.data, prepared_image.bytes_saved
+            except Exception as e:
+                logger.error("Error preprocessing image %s: %s", os.path.basename(image_path), e)
+                results[index] = ImageResult(image_path, None, str(e))
+                continue
+        prepared.append((index, image_path, image_data, bytes_saved))
+
+    request_metrics = [[] for item in prepared]
+    try:
+        parsed = receipt_reader.read_receipts([item[1] for item in prepared], api_key,
+                                              images_data=[item[2] for item in prepared], cache=cache,
+                                              metrics=request_metrics)
+    except Exception as e:
+        logger.warning("Batch request failed, reading its %s images one by one: %s", len(prepared), e)
+        parsed = [None] * len(prepared)
+
+    for (index, image_path, image_data, bytes_saved), parsed_data, image_requests in zip(prepared, parsed, request_metrics):
+        if parsed_data:
+            results[index] = ImageResult(image_path, parsed_data, None, bytes_saved,
+                                         _image_metrics(image_path, image_data, image_requests, 'batch'))
+        else:
+            results[index] = _read_prepared(image_path, api_key, image_data, bytes_saved, cache, image_requests, 'batch')
+    return [results[index] for index in range(len(image_paths))]
+
+
+def _wait_for(future, cancel_event):
+    if cancel_event is None:
+        return future.result()
+    while not cancel_event.is_set():
+        try:
+            return future.result(timeout=CANCEL_POLL_INTERVAL)
+        except TimeoutError:
+            pass
+    return None
+
+
+def _store_result(result, database, destination_folder, event_id, job):
+    # Renvoie None si le bail du job a été repris par un autre worker : l'image est alors à lui
+    receipt_id = None
+    lease_lost = False
+    if result.parsed_data:
+        try:
+            with span('pipeline.store'):
+                if job is not None:
+                    receipt_id = database.complete_job(job, result.parsed_data)
+                else:
+                    receipt_id = database.insert_receipt_data(result.parsed_data, event_id)
+                receipt_reader.archive_image(result.image_path, destination_folder)
+        except jobs.JobStateError as e:
+            logger.warning("Receipt %s dropped: %s", os.path.basename(result.image_path), e)
+            lease_lost = True
+        except Exception as e:
+            logger.error("Error storing receipt %s: %s", os.path.basename(result.image_path), e)
+            result = result._replace(error=str(e))
+    if result.error and job is not None and not lease_lost:
+        try:
+            lease_lost = not database.fail_job(job, result.error)
+        except Exception as e:
+            logger.error("Error recording the failure of job %s: %s", job.id, e)
+        if lease_lost:
+            logger.warning("Failure of %s not recorded: job %s is no longer held by this claim",
+                           os.path.basename(result.image_path), job.id)
+    if result.metrics is not None:
+        try:
+            database.record_metrics(receipt_id, event_id, os.path.basename(result.image_path), result.metrics)
+        except Exception as e:
+            logger.error("Error recording metrics for %s: %s", os.path.basename(result.image_path), e)
+    return None if lease_lost else result
+
+
+def _run_pipeline(items, destination_folder, api_key, database, max_workers=DEFAULT_MAX_WORKERS,
+                  preprocess=image_preprocessing.PREPROCESS_ENABLED, cache=None, cancel_event=None,
+                  batch_size=receipt_reader.BATCH_SIZE):
+    # items : itérable de (image_path, event_id, job), lu au fil des soumissions et non d'avance,
+    # afin que process_jobs ne réclame ses jobs qu'au moment où le pipeline en a besoin
+    items = iter(items)
+    capacity = receipt_reader.batch_capacity(batch_size)
+    # Requêtes soumises d'avance : de quoi occuper chaque worker pendant que la précédente est enregistrée
+    window = 2 * max(1, max_workers)
+    process_pool = None
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='receipt-worker')
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < window:
+                chunk = list(islice(items, capacity))
+                if not chunk:
+                    break
+                image_paths = [item[0] for item in chunk]
+                if preprocess and process_pool is None:
+                    process_pool = image_preprocessing.create_process_pool()
+                preprocessed = [process_pool.submit(image_preprocessing.preprocess_image, image_path)
+                                for image_path in image_paths] if process_pool else None
+                if capacity == 1:
+                    future = executor.submit(read_image, image_paths[0], api_key,
+                                             preprocessed=preprocessed[0] if preprocessed else None, cache=cache)
+                else:
+                    future = executor.submit(read_batch, image_paths, api_key, preprocessed=preprocessed, cache=cache)
+                pending.append((chunk, future))
+            if not pending:
+                return
+
+            chunk, future = pending.popleft()
+            results = _wait_for(future, cancel_event)
+            if results is None:
+                logger.info("Batch processing cancelled")
+                return
+            for (image_path, event_id, job), result in zip(chunk, results if isinstance(results, list) else [results]):
+                stored = _store_result(result, database, destination_folder, event_id, job)
+                if stored is not None:
+                    yield stored
+    finally:
+        # Abandonner les images non commencées si le consommateur s'arrête avant la fin
+        executor.shutdown(wait=False, cancel_futures=True)
+        if process_pool:
+            process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def process_images(image_paths, destination_folder, api_key, database, event_id, max_workers=DEFAULT_MAX_WORKERS,
+                   preprocess=image_preprocessing.PREPROCESS_ENABLED, cache=None, cancel_event=None,
+                   batch_size=receipt_reader.BATCH_SIZE, claimed=None):
+    """Process a batch of images concurrently and yield one ImageResult per image, in input order.
+
+    When ``preprocess`` is set, images are first downscaled and recompressed
+    in a process pool. Encoding, API calls and parsing run in a pool of
+    ``max_workers`` threads. Database inserts (through the ReceiptDatabase
+    ``database``) and file moves are done by the consuming thread only, one
+    receipt at a time, so SQLite only ever sees a single writer while the
+    pools keep working on the next images.
+
+    With ``batch_size`` above 1, images are grouped into requests of up to
+    that many receipts (capped by receipt_reader.batch_capacity) and read
+    with read_batch.
+
+    Setting the threading.Event ``cancel_event`` stops the batch: results
+    not yet stored are dropped and their images stay where they are.
+
+    ``claimed`` gives the Job returned by claim_jobs (see jobs.py) for each
+    image: its receipt is then stored with database.complete_job, in the
+    transaction that marks the job done, and failures are recorded with
+    fail_job. An image whose lease was taken over by another worker in the
+    meantime is left to that worker and yields no result.
+    """
+    image_paths = list(image_paths)
+    claimed = list(claimed) if claimed is not None else [None] * len(image_paths)
+    return _run_pipeline(zip(image_paths, repeat(event_id), claimed), destination_folder, api_key, database,
+                         max_workers, preprocess, cache, cancel_event, batch_size)
+
+
+def process_jobs(job_ids, destination_folder, api_key, database, claim_size=CLAIM_SIZE, **options):
+    """Claim the jobs ``job_ids`` and process their images, yielding ImageResult.
+
+    Jobs are claimed ``claim_size`` at a time as the pipeline needs more
+    images, and all of them go through a single pipeline (one set of pools),
+    whatever their event. Jobs already done or in flight elsewhere, or whose
+    lease another worker took over before they were stored, are skipped
+    without a result, so running this again after a crash only resumes the
+    unfinished work. ``options`` are passed to process_images. Jobs claimed
+    but not processed, when the batch is cancelled or the consumer stops
+    early, are put back in the queue.
+    """
+    job_ids = list(job_ids)
+    claimed = {}
+    finished = set()
+
+    def claimed_items():
+        for start in range(0, len(job_ids), claim_size):
+            for job in database.claim_jobs(job_ids[start:start + claim_size]):
+                claimed[job.id] = job
+                yield job.image_path, job.event_id, job
+
+    try:
+        for result in _run_pipeline(claimed_items(), destination_folder, api_key, database, **options):
+            finished.add(result.image_path)
+            yield result
+    finally:
+        unfinished = [job for job in claimed.values() if job.image_path not in finished]
+        if unfinished:
+            database.release_jobs(unfinished)
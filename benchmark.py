@@ -0,0 +1,400 @@
+# benchmark.py
+"""Throughput benchmark of the receipt pipeline against a local stub of the vision API.
+
+StubVisionAPI imitates ``/v1/chat/completions`` with a configurable latency,
+error rate and canned receipts. run_benchmark copies a synthetic image corpus
+into a work folder and processes it with the batch pipeline used by the UI
+(batch_processor.process_images) and with the sequential process_image flow,
+then reports receipts/sec, peak RSS and the time spent in each stage. Each
+flow runs in its own process, so that its peak RSS is not the high-water mark
+left by the flows before it.
+
+    python benchmark.py --images 100 --latency 0.5 --output bench.json --compare previous.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:  # Windows: pas de mesure de la mémoire résidente
+    resource = None
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:  # Pillow absent: le corpus est fait d'octets aléatoires
+    Image = None
+    ImageDraw = None
+
+import receipt_reader
+import batch_processor
+import instrumentation
+import log_setup
+from database import ReceiptDatabase, initialize_database
+
+logger = logging.getLogger(__name__)
+
+# Tickets renvoyés tour à tour par le serveur factice
+CANNED_RECEIPTS = [
+    {"date": "31/08/2023", "fournisseur": "Intermarché", "localisation": "Foix", "articles": [
+        {"famille": "Alimentation", "sous_famille": "Snacking", "nom": "Vico Chips Class.Nat", "prix_unitaire": 3.56, "quantite": 1, "prix_total": 3.56},
+        {"famille": "Alimentation", "sous_famille": "Crèmerie", "nom": "Pat. Emmental Rape 3", "prix_unitaire": 3.01, "quantite": 1, "prix_total": 3.01},
+        {"famille": "Alimentation", "sous_famille": "Crèmerie", "nom": "Pat Beurre Moule DX", "prix_unitaire": 4.63, "quantite": 1, "prix_total": 4.63},
+    ]},
+    {"date": "01/09/2023", "fournisseur": "Carrefour", "localisation": "Pamiers", "articles": [
+        {"famille": "Boissons", "sous_famille": "Non Alcoolisées", "nom": "Jus d'orange", "prix_unitaire": 2.5, "quantite": 4, "prix_total": 10.0},
+        {"famille": "Energie", "sous_famille": "Carburant", "nom": "Essence au litre", "prix_unitaire": 1.72, "quantite": 40, "prix_total": 68.8},
+    ]},
+]
+
+# Seuil de régression signalé par compare_results (variation relative)
+REGRESSION_TOLERANCE = 0.10
+
+
+def _receipt_text(receipt):
+    lines = [f"{receipt['date']}, {receipt['fournisseur']}, {receipt['localisation']}"]
+    for article in receipt["articles"]:
+        lines.append(f"{article['famille']}, {article['sous_famille']}, {article['nom']}, "
+                     f"{article['prix_unitaire']}, {article['quantite']}, {article['prix_total']}")
+    return "\n".join(lines)
+
+
+class StubVisionAPI:
+    """Local HTTP server answering chat completions with canned receipts.
+
+    Each request waits ``latency`` seconds (plus up to ``jitter``), then fails
+    with a 503 and ``Retry-After: 0`` with probability ``error_rate``. Answers
+    follow the request: JSON when a response_format is given, one delimited
+    section per image for batches, the line format otherwise.
+    """
+
+    def __init__(self, latency=0.1, jitter=0.0, error_rate=0.0, receipts=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.receipts = receipts or CANNED_RECEIPTS
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, answer = stub.answer(body)
+                data = json.dumps(answer).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status != 200:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def answer(self, body):
+        with self._lock:
+            self.requests += 1
+            receipt_index = self.requests
+            failed = self._random.random() < self.error_rate
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if failed:
+            return 503, {"error": {"message": "Service unavailable (stub)"}}
+
+        payload = json.loads(body)
+        content = payload["messages"][0]["content"]
+        images = sum(1 for part in content if part.get("type") == "image_url")
+        # Fournisseur numéroté : chaque ticket a sa propre empreinte et n'est pas écarté comme doublon
+        receipts = []
+        for offset in range(images):
+            receipt = self.receipts[(receipt_index + offset) % len(self.receipts)]
+            receipts.append(dict(receipt, fournisseur=f"{receipt['fournisseur']} {receipt_index}-{offset}"))
+        if "response_format" in payload:
+            output = json.dumps(receipts[0], ensure_ascii=False)
+        elif images > 1:
+            output = "\n".join(f"{receipt_reader.RECEIPT_DELIMITER.format(number)}\n{_receipt_text(receipt)}"
+                               for number, receipt in enumerate(receipts, start=1))
+        else:
+            output = _receipt_text(receipts[0])
+
+        prompt_chars = sum(len(part.get("text", "")) for part in content)
+        return 200, {
+            "model": payload.get("model", receipt_reader.MODEL),
+            "choices": [{"message": {"role": "assistant", "content": output}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_chars // 4 + receipt_reader.IMAGE_TOKENS * images,
+                      "completion_tokens": len(output) // 4},
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-vision-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def make_corpus(folder, count, size=(1200, 1600), seed=0):
+    """Write ``count`` synthetic receipt photos to ``folder`` and return their paths."""
+    os.makedirs(folder, exist_ok=True)
+    generator = random.Random(seed)
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, f"receipt_{index:05d}.jpg")
+        if Image is not None:
+            # Papier clair sur fond sombre, avec des lignes de texte simulées
+            image = Image.new("RGB", size, (40, 40, 40))
+            draw = ImageDraw.Draw(image)
+            left, top = size[0] // 6, size[1] // 10
+            draw.rectangle((left, top, size[0] - left, size[1] - top), fill=(235, 235, 230))
+            for line in range(top + 40, size[1] - top - 40, 36):
+                width = generator.randint(size[0] // 4, size[0] - 2 * left - 40)
+                draw.rectangle((left + 20, line, left + 20 + width, line + 14), fill=(30, 30, 30))
+            image.save(path, format="JPEG", quality=90)
+        else:
+            with open(path, "wb") as image_file:
+                image_file.write(generator.randbytes(300_000))
+        paths.append(path)
+    return paths
+
+
+def peak_rss_mb():
+    # Pic de mémoire résidente de ce processus et de ses enfants (pool de prétraitement), depuis son lancement
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss est en octets sur macOS, en kilo-octets ailleurs
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+@contextmanager
+def _timed(owner, name, stages, stage):
+    # Remplace owner.name par une version chronométrée le temps du bloc
+    original = getattr(owner, name)
+
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            with _stages_lock:
+                stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - started
+
+    setattr(owner, name, timed)
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+
+_stages_lock = threading.Lock()
+
+
+def _prepare_flow(corpus, workdir, name):
+    queue = os.path.join(workdir, name, "queue")
+    processed = os.path.join(workdir, name, "processed")
+    os.makedirs(queue)
+    os.makedirs(processed)
+    images = []
+    for path in corpus:
+        images.append(shutil.copy(path, queue))
+    return images, processed, os.path.join(workdir, name, "receipts.db")
+
+
+def _flow_result(images, stored, elapsed, stages):
+    return {
+        "images": images,
+        "receipts": stored,
+        "elapsed_s": round(elapsed, 4),
+        "receipts_per_s": round(stored / elapsed, 3) if elapsed > 0 else None,
+        "stages_s": {stage: round(seconds, 4) for stage, seconds in sorted(stages.items())},
+        "peak_rss_mb": peak_rss_mb(),
+        # Spans de instrumentation : détail des étapes de receipt_reader et database
+        "spans": instrumentation.snapshot(),
+    }
+
+
+def run_pipeline(corpus, workdir, max_workers=batch_processor.DEFAULT_MAX_WORKERS, batch_size=1, preprocess=False):
+    """Process the corpus like the UI does, with batch_processor.process_images."""
+    images, processed, db_path = _prepare_flow(corpus, workdir, f"pipeline_w{max_workers}_b{batch_size}")
+    instrumentation.reset()
+    database = ReceiptDatabase(db_path)
+    database.insert_event("Benchmark", datetime.now().strftime("%Y-%m-%d"))
+    event_id = database.get_events()[0][0]
+    stages = {}
+    stored = 0
+    try:
+        with _timed(database, "insert_receipt_data", stages, "store"), \
+                _timed(database, "record_metrics", stages, "metrics"), \
+                _timed(receipt_reader, "archive_image", stages, "archive"):
+            started = time.perf_counter()
+            for result in batch_processor.process_images(images, processed, "benchmark-key", database, event_id,
+                                                         max_workers=max_workers, preprocess=preprocess,
+                                                         batch_size=batch_size):
+                if result.error is None:
+                    stored += 1
+                if result.metrics is not None:
+                    # Temps cumulé des appels, sur tous les workers
+                    stages["api"] = stages.get("api", 0.0) + result.metrics.latency
+            elapsed = time.perf_counter() - started
+    finally:
+        database.close()
+    return _flow_result(len(images), stored, elapsed, stages)
+
+
+def run_sequential(corpus, workdir):
+    """Process the corpus one image at a time with receipt_reader.process_image."""
+    images, processed, db_path = _prepare_flow(corpus, workdir, "sequential")
+    instrumentation.reset()
+    initialize_database(db_path)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("INSERT INTO event (event_name, event_date) VALUES ('Benchmark', date('now'))")
+    conn.close()
+    stages = {}
+    stored = 0
+    with _timed(receipt_reader, "send_request", stages, "api"), \
+            _timed(receipt_reader, "insert_receipt_data", stages, "store"), \
+            _timed(receipt_reader, "archive_image", stages, "archive"):
+        started = time.perf_counter()
+        for image_path in images:
+            if receipt_reader.process_image(image_path, processed, "benchmark-key", db_path, 1):
+                stored += 1
+        elapsed = time.perf_counter() - started
+    return _flow_result(len(images), stored, elapsed, stages)
+
+
+def _run_isolated(flow, api_url, *args):
+    # Exécuté dans un processus neuf : ru_maxrss n'y mesure que ce parcours
+    receipt_reader.API_URL = api_url
+    try:
+        return flow(*args)
+    finally:
+        receipt_reader.close_session()
+
+
+def run_flow(flow, api_url, *args):
+    """Run ``flow(*args)`` against ``api_url`` in a fresh process and return its result."""
+    # Un enfant forké depuis ce processus hériterait de sa mémoire résidente dans ru_maxrss :
+    # forkserver le forke depuis un petit processus serveur
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_isolated, flow, api_url, *args).result()
+
+
+def run_benchmark(images=50, latency=0.1, jitter=0.0, error_rate=0.0, max_workers=batch_processor.DEFAULT_MAX_WORKERS,
+                  batch_size=1, preprocess=False, sequential=True, image_size=(1200, 1600), seed=0, workdir=None):
+    """Run every flow against a fresh StubVisionAPI and return the results as a JSON-ready dict."""
+    workdir = workdir or tempfile.mkdtemp(prefix="receipt-bench-")
+    try:
+        corpus = make_corpus(os.path.join(workdir, "corpus"), images, image_size, seed)
+        corpus_bytes = sum(os.path.getsize(path) for path in corpus)
+        flows = {}
+        with StubVisionAPI(latency, jitter, error_rate, seed=seed) as api:
+            flows["pipeline"] = run_flow(run_pipeline, api.url, corpus, workdir, max_workers, 1, preprocess)
+            if batch_size > 1:
+                flows["pipeline_batch"] = run_flow(run_pipeline, api.url, corpus, workdir, max_workers, batch_size, preprocess)
+            if sequential:
+                flows["sequential"] = run_flow(run_sequential, api.url, corpus, workdir)
+            server = {"requests": api.requests, "errors": api.errors}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {"images": images, "image_size": list(image_size), "corpus_bytes": corpus_bytes, "latency_s": latency,
+                   "jitter_s": jitter, "error_rate": error_rate, "max_workers": max_workers, "batch_size": batch_size,
+                   "preprocess": preprocess, "output_mode": receipt_reader.OUTPUT_MODE, "seed": seed},
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "server": server,
+        "flows": flows,
+    }
+
+
+def compare_results(previous, current, tolerance=REGRESSION_TOLERANCE):
+    """Return one message per flow whose receipts/sec dropped by more than ``tolerance``."""
+    regressions = []
+    for name, flow in current["flows"].items():
+        before = previous.get("flows", {}).get(name, {}).get("receipts_per_s")
+        after = flow.get("receipts_per_s")
+        if before and after is not None and after < before * (1 - tolerance):
+            regressions.append(f"{name}: {before} -> {after} receipts/s ({after / before - 1:+.1%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.1, help="secondes par requête")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=batch_processor.DEFAULT_MAX_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--preprocess", action="store_true")
+    parser.add_argument("--no-sequential", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="fichier JSON des résultats")
+    parser.add_argument("--compare", help="résultats JSON d'un run précédent")
+    args = parser.parse_args(argv)
+
+    log_setup.setup_logging(logging.WARNING)
+    results = run_benchmark(args.images, args.latency, args.jitter, args.error_rate, args.workers, args.batch_size,
+                            args.preprocess, not args.no_sequential, seed=args.seed)
+    report = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(report)
+    print(report)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as previous_file:
+            regressions = compare_results(json.load(previous_file), results)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
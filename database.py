@@ -1,6 +1,20 @@
 # database.py
+import os
 import sqlite3
 import logging
+import threading
+import unicodedata
+from collections import namedtuple
+from contextlib import contextmanager
+
+import jobs
+import analytics
+import dimensions
+import metrics
+from instrumentation import instrumented, span
+from dimensions import DimensionCache
+
+logger = logging.getLogger(__name__)
 
 class EventExistsError(Exception):
     pass
@@ -8,195 +22,955 @@ class EventExistsError(Exception):
 class EventDateMismatchError(Exception):
     pass
 
+# Réglages des connexions longues de ReceiptDatabase
+STATEMENT_CACHE_SIZE = 256
+SYNCHRONOUS = 'NORMAL'  # Sûr en mode WAL, évite un fsync à chaque commit
+CACHE_SIZE_KIB = 20000
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Nombre de tickets écrits par transaction dans insert_receipts_bulk
+BULK_BATCH_SIZE = 500
+
+# Nombre de tickets lus par page dans iter_event_receipts et iter_event_articles
+DETAILS_PAGE_SIZE = 200
+
+# Traitement d'un ticket dont l'empreinte existe déjà (modifiable via RECEIPT_DUPLICATE_POLICY) :
+# 'skip' garde le ticket existant, 'replace' le remplace par le nouveau, 'flag' enregistre le
+# nouveau en le marquant comme doublon (duplicate_of) pour vérification. Un ticket marqué compte dans les
+# totaux et la ventilation jusqu'à ce que ReceiptDatabase.resolve_duplicate le supprime ou le garde
+DUPLICATE_SKIP = 'skip'
+DUPLICATE_REPLACE = 'replace'
+DUPLICATE_FLAG = 'flag'
+DUPLICATE_POLICIES = (DUPLICATE_SKIP, DUPLICATE_REPLACE, DUPLICATE_FLAG)
+
+def check_duplicate_policy(policy):
+    # Casse et espaces ignorés ; une politique inconnue est refusée avant tout enregistrement
+    normalized = str(policy).strip().lower()
+    if normalized not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy {policy!r}, expected one of {DUPLICATE_POLICIES}")
+    return normalized
+
+DUPLICATE_POLICY = check_duplicate_policy(os.getenv('RECEIPT_DUPLICATE_POLICY', DUPLICATE_SKIP))
+
+# Lignes compactes des détails d'un évènement : l'en-tête du ticket n'est pas répété sur chaque article
+ReceiptRow = namedtuple('ReceiptRow', ['id', 'date', 'fournisseur', 'localisation', 'total'])
+ArticleRow = namedtuple('ArticleRow', ['id', 'receipt_id', 'famille', 'sous_famille', 'nom', 'prix_unitaire', 'quantite', 'prix_total'])
+
+# Recalcul complet des totaux matérialisés, utilisé par la migration 3 et rebuild_totals
+REBUILD_TOTALS = [
+    '''
+    UPDATE receipts SET receipt_total = COALESCE((SELECT SUM(a.prix_total) FROM articles a WHERE a.receipt_id = receipts.id), 0)
+    ''',
+    '''
+    UPDATE event SET event_total = COALESCE((SELECT SUM(r.receipt_total) FROM receipts r WHERE r.event_id = event.id), 0)
+    ''',
+]
+
+# Migration qui encode les noms dans les tables de dimensions (VACUUM des bases existantes ensuite)
+DICTIONARY_VERSION = 9
+
+# Migrations du schéma, appliquées une seule fois et dans l'ordre selon PRAGMA user_version,
+# aussi bien sur les bases neuves (après CREATE TABLE) que sur les bases existantes.
+MIGRATIONS = [
+    (1, [
+        # event -> receipts : l'index couvre r.id (rowid) pour les jointures par évènement
+        "CREATE INDEX IF NOT EXISTS idx_receipts_event_id ON receipts (event_id)",
+        # receipts -> articles : couvrant pour SUM(prix_total) sans lire la table
+        "CREATE INDEX IF NOT EXISTS idx_articles_receipt_id ON articles (receipt_id, prix_total)",
+    ]),
+    (2, [
+        # Recherche d'évènements par préfixe de nom, insensible à la casse comme LIKE
+        "CREATE INDEX IF NOT EXISTS idx_event_name ON event (event_name COLLATE NOCASE)",
+    ]),
+    (3, [
+        # Totaux matérialisés par ticket et par évènement, tenus à jour par des triggers
+        "ALTER TABLE receipts ADD COLUMN receipt_total REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE event ADD COLUMN event_total REAL NOT NULL DEFAULT 0",
+        *REBUILD_TOTALS,
+        # articles -> receipts
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_articles_insert_total AFTER INSERT ON articles
+        BEGIN
+            UPDATE receipts SET receipt_total = receipt_total + COALESCE(NEW.prix_total, 0) WHERE id = NEW.receipt_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_articles_delete_total AFTER DELETE ON articles
+        BEGIN
+            UPDATE receipts SET receipt_total = receipt_total - COALESCE(OLD.prix_total, 0) WHERE id = OLD.receipt_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_articles_update_total AFTER UPDATE OF prix_total, receipt_id ON articles
+        BEGIN
+            UPDATE receipts SET receipt_total = receipt_total - COALESCE(OLD.prix_total, 0) WHERE id = OLD.receipt_id;
+            UPDATE receipts SET receipt_total = receipt_total + COALESCE(NEW.prix_total, 0) WHERE id = NEW.receipt_id;
+        END
+        ''',
+        # receipts -> event
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_insert_total AFTER INSERT ON receipts
+        BEGIN
+            UPDATE event SET event_total = event_total + NEW.receipt_total WHERE id = NEW.event_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_delete_total AFTER DELETE ON receipts
+        BEGIN
+            UPDATE event SET event_total = event_total - OLD.receipt_total WHERE id = OLD.event_id;
+        END
+        ''',
+        # Changement d'évènement : l'ancien total est déplacé, la variation éventuelle est
+        # appliquée par le trigger suivant sur le nouvel évènement
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_move_total AFTER UPDATE OF event_id ON receipts
+        BEGIN
+            UPDATE event SET event_total = event_total - OLD.receipt_total WHERE id = OLD.event_id;
+            UPDATE event SET event_total = event_total + OLD.receipt_total WHERE id = NEW.event_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_update_total AFTER UPDATE OF receipt_total ON receipts
+        BEGIN
+            UPDATE event SET event_total = event_total + NEW.receipt_total - OLD.receipt_total WHERE id = NEW.event_id;
+        END
+        ''',
+    ]),
+    (4, [
+        # Ventilation des dépenses par évènement, mois, famille, sous-famille et fournisseur
+        *analytics.ROLLUP_SCHEMA,
+    ]),
+    (5, [
+        # Tokens, octets envoyés, latence et tentatives de chaque image traitée
+        *metrics.METRICS_SCHEMA,
+    ]),
+    (6, [
+        # Mode de sortie demandé à l'API, pour comparer les taux de renvoi
+        *metrics.METRICS_OUTPUT_MODE,
+    ]),
+    (7, [
+        # File durable des images à traiter, reprise après un arrêt brutal
+        *jobs.JOBS_SCHEMA,
+    ]),
+    (8, [
+        # Empreinte des tickets (date, fournisseur normalisé, nombre d'articles, total) pour écarter
+        # les doublons ; les doublons déjà présents sont marqués, le plus ancien faisant foi
+        "ALTER TABLE receipts ADD COLUMN fingerprint TEXT",
+        "ALTER TABLE receipts ADD COLUMN duplicate_of INTEGER REFERENCES receipts (id)",
+        '''
+        UPDATE receipts SET fingerprint = receipt_fingerprint(
+            date, fournisseur, (SELECT COUNT(*) FROM articles a WHERE a.receipt_id = receipts.id), receipt_total)
+        ''',
+        '''
+        UPDATE receipts SET duplicate_of = d.first_id
+        FROM (SELECT id, MIN(id) OVER (PARTITION BY fingerprint) AS first_id FROM receipts) AS d
+        WHERE d.id = receipts.id AND d.first_id != receipts.id
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_receipts_fingerprint ON receipts (fingerprint) WHERE duplicate_of IS NULL",
+    ]),
+    (DICTIONARY_VERSION, [
+        # Noms de famille, sous-famille et fournisseur encodés dans des tables de dimensions : chaque
+        # ligne ne garde qu'un entier, et les variantes de casse ou d'accents sont regroupées
+        *dimensions.DIMENSION_SCHEMA,
+        # Par fréquence décroissante puis ordre d'apparition : l'orthographe la plus courante devient le nom affiché
+        '''
+        INSERT OR IGNORE INTO dim_famille (key, name)
+        SELECT dimension_key(famille), dimension_name(famille) FROM articles
+        WHERE dimension_key(famille) IS NOT NULL GROUP BY famille ORDER BY COUNT(*) DESC, MIN(rowid)
+        ''',
+        '''
+        INSERT OR IGNORE INTO dim_sous_famille (key, name)
+        SELECT dimension_key(sous_famille), dimension_name(sous_famille) FROM articles
+        WHERE dimension_key(sous_famille) IS NOT NULL GROUP BY sous_famille ORDER BY COUNT(*) DESC, MIN(rowid)
+        ''',
+        '''
+        INSERT OR IGNORE INTO dim_fournisseur (key, name)
+        SELECT dimension_key(fournisseur), dimension_name(fournisseur) FROM receipts
+        WHERE dimension_key(fournisseur) IS NOT NULL GROUP BY fournisseur ORDER BY COUNT(*) DESC, MIN(rowid)
+        ''',
+        "ALTER TABLE articles ADD COLUMN famille_id INTEGER REFERENCES dim_famille (id)",
+        "ALTER TABLE articles ADD COLUMN sous_famille_id INTEGER REFERENCES dim_sous_famille (id)",
+        "ALTER TABLE receipts ADD COLUMN fournisseur_id INTEGER REFERENCES dim_fournisseur (id)",
+        '''
+        UPDATE articles SET
+            famille_id = (SELECT id FROM dim_famille WHERE key = dimension_key(articles.famille)),
+            sous_famille_id = (SELECT id FROM dim_sous_famille WHERE key = dimension_key(articles.sous_famille))
+        ''',
+        "UPDATE receipts SET fournisseur_id = (SELECT id FROM dim_fournisseur WHERE key = dimension_key(receipts.fournisseur))",
+        # Les triggers de la ventilation citent les colonnes en texte : ils partent avant elles
+        *analytics.DROP_ROLLUP,
+        "ALTER TABLE articles DROP COLUMN famille",
+        "ALTER TABLE articles DROP COLUMN sous_famille",
+        "ALTER TABLE receipts DROP COLUMN fournisseur",
+        *analytics.DICTIONARY_ROLLUP_SCHEMA,
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
 def initialize_database(db_path):
+    # Transactions explicites (isolation_level=None) : sinon chaque ALTER/CREATE est validé à part
+    conn = sqlite3.connect(db_path, isolation_level=None)
     try:
-        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
+        # Une base antérieure aux versions du schéma a aussi user_version = 0, mais déjà ses tables
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'receipts'")
+        existing = cursor.fetchone()[0] > 0
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS event (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_name TEXT,
-                event_date TEXT
-            )
-        ''')
-        logging.info("Table 'event' initialized or already exists.")
+        with _transaction(cursor):
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS event (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_name TEXT,
+                    event_date TEXT
+                )
+            ''')
+            logger.info("Table 'event' initialized or already exists.")
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS receipts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_id INTEGER,
-                date TEXT,
-                fournisseur TEXT,
-                localisation TEXT,
-                FOREIGN KEY (event_id) REFERENCES event(id)
-            )
-        ''')
-        logging.info("Table 'receipts' initialized or already exists.")
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS receipts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_id INTEGER,
+                    date TEXT,
+                    fournisseur TEXT,
+                    localisation TEXT,
+                    FOREIGN KEY (event_id) REFERENCES event(id)
+                )
+            ''')
+            logger.info("Table 'receipts' initialized or already exists.")
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS articles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                receipt_id INTEGER,
-                famille TEXT,
-                sous_famille TEXT,
-                nom TEXT,
-                prix_unitaire REAL,
-                quantite REAL,
-                prix_total REAL,
-                FOREIGN KEY (receipt_id) REFERENCES receipts (id)
-            )
-        ''')
-        logging.info("Table 'articles' initialized or already exists.")
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS articles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    receipt_id INTEGER,
+                    famille TEXT,
+                    sous_famille TEXT,
+                    nom TEXT,
+                    prix_unitaire REAL,
+                    quantite REAL,
+                    prix_total REAL,
+                    FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+                )
+            ''')
+            logger.info("Table 'articles' initialized or already exists.")
 
-        conn.commit()
+        previous_version = upgrade_database(cursor)
+
+        if existing and previous_version < DICTIONARY_VERSION:
+            # Les pages libérées par l'encodage des noms ne sont rendues au disque que par VACUUM ;
+            # une base neuve n'a rien à rendre
+            cursor.execute("VACUUM")
     except Exception as e:
-        logging.error(f"Error initializing database: {e}")
+        # Une base à moitié migrée ne doit pas être utilisée : l'erreur remonte à l'appelant
+        logger.error("Error initializing database: %s", e)
+        raise
     finally:
         conn.close()
 
-def insert_receipt_data(db_path, receipt_data, event_id):
+def _normalize_fournisseur(fournisseur):
+    # 'Intermarché ', 'INTERMARCHE' et 'inter-marché' donnent la même empreinte
+    text = unicodedata.normalize('NFKD', str(fournisseur or ''))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    return ''.join(char for char in text if char.isalnum())
+
+def _fingerprint(date, fournisseur, article_count, total):
+    return f"{str(date or '').strip()}|{_normalize_fournisseur(fournisseur)}|{article_count}|{round((total or 0) * 100)}"
+
+def receipt_fingerprint(receipt_data):
+    articles = receipt_data['articles']
+    return _fingerprint(receipt_data['date'], receipt_data['fournisseur'], len(articles),
+                        sum(float(article['prix_total']) for article in articles))
+
+@contextmanager
+def _transaction(cursor):
+    # Pour une connexion en mode autocommit : tout ou rien, annulé si une instruction échoue
+    cursor.execute("BEGIN IMMEDIATE")
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+        yield cursor
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    cursor.execute("COMMIT")
 
-        cursor.execute('''
-            INSERT INTO receipts (event_id, date, fournisseur, localisation)
-            VALUES (?, ?, ?, ?)
-        ''', (
-            event_id, receipt_data['date'], receipt_data['fournisseur'], receipt_data['localisation']))
+@instrumented('db.upgrade')
+def upgrade_database(cursor):
+    """Apply the pending MIGRATIONS, each with its user_version bump in one transaction.
 
-        receipt_id = cursor.lastrowid
-        logging.info(
-            f"Inserted receipt with ID {receipt_id}: Date: {receipt_data['date']}, Fournisseur: {receipt_data['fournisseur']}, Localisation: {receipt_data['localisation']}")
+    ``cursor`` must belong to a connection opened with isolation_level=None.
+    A failing migration is rolled back entirely and its error raised; the
+    migrations before it stay applied. Returns the version found on entry.
+    """
+    # Fonctions Python utilisées par les migrations 8 (empreintes) et 9 (dimensions)
+    cursor.connection.create_function('receipt_fingerprint', 4, _fingerprint, deterministic=True)
+    cursor.connection.create_function('dimension_key', 1, dimensions.dimension_key, deterministic=True)
+    cursor.connection.create_function('dimension_name', 1, dimensions.dimension_name, deterministic=True)
+    cursor.execute("PRAGMA user_version")
+    previous_version = cursor.fetchone()[0]
 
-        for article in receipt_data['articles']:
-            cursor.execute('''
-                INSERT INTO articles (receipt_id, famille, sous_famille, nom, prix_unitaire, quantite, prix_total)
+    for target_version, statements in MIGRATIONS:
+        if previous_version >= target_version:
+            continue
+        with _transaction(cursor):
+            # Relu sous le verrou d'écriture : un autre processus a pu migrer entre-temps
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= target_version:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {target_version}")
+        logger.info("Database schema upgraded to version %s.", target_version)
+    return previous_version
+
+def _find_receipt_by_fingerprint(cursor, fingerprint):
+    # Recherche dans idx_receipts_fingerprint, les doublons marqués en étant exclus
+    cursor.execute("SELECT id FROM receipts WHERE fingerprint = ? AND duplicate_of IS NULL", (fingerprint,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _insert_articles(cursor, receipt_id, articles, dimension_cache):
+    for article in articles:
+        cursor.execute('''
+                INSERT INTO articles (receipt_id, famille_id, sous_famille_id, nom, prix_unitaire, quantite, prix_total)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (
-                receipt_id,
-                article['famille'],
-                article['sous_famille'],
-                article['nom'],
-                float(article['prix_unitaire']),
-                float(article['quantite']),
-                float(article['prix_total'])
-            ))
-            logging.info(
-                f"Inserted article for receipt ID {receipt_id}: Famille: {article['famille']}, Sous famille: {article['sous_famille']}, Nom: {article['nom']}, Prix unitaire: {article['prix_unitaire']}, Quantité: {article['quantite']}, Prix total: {article['prix_total']}")
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Error inserting data into database: {e}")
-    finally:
-        conn.close()
+            receipt_id,
+            dimension_cache.intern(cursor, 'famille', article['famille']),
+            dimension_cache.intern(cursor, 'sous_famille', article['sous_famille']),
+            article['nom'],
+            float(article['prix_unitaire']),
+            float(article['quantite']),
+            float(article['prix_total'])
+        ))
 
-def insert_event(db_path, event_name, event_date):
+def _replace_receipt(cursor, receipt_id, receipt_data, event_id, dimension_cache):
+    # Le ticket garde son ID (jobs et métriques y font référence) ; les triggers recalculent les totaux
+    cursor.execute('''
+            UPDATE receipts SET event_id = ?, date = ?, fournisseur_id = ?, localisation = ? WHERE id = ?
+        ''', (event_id, receipt_data['date'], dimension_cache.intern(cursor, 'fournisseur', receipt_data['fournisseur']),
+              receipt_data['localisation'], receipt_id))
+    cursor.execute("DELETE FROM articles WHERE receipt_id = ?", (receipt_id,))
+    _insert_articles(cursor, receipt_id, receipt_data['articles'], dimension_cache)
+
+@instrumented('db.insert_receipt')
+def _insert_receipt(cursor, receipt_data, event_id, on_duplicate=DUPLICATE_POLICY, dimension_cache=None):
+    # dimension_cache : DimensionCache de longue durée, sinon les noms sont cherchés pour ce seul ticket
+    dimension_cache = dimension_cache if dimension_cache is not None else DimensionCache()
+    on_duplicate = check_duplicate_policy(on_duplicate)
+    fingerprint = receipt_fingerprint(receipt_data)
+    duplicate_of = _find_receipt_by_fingerprint(cursor, fingerprint)
+    if duplicate_of is not None:
+        if on_duplicate == DUPLICATE_SKIP:
+            logger.warning("Receipt already stored with ID %s, skipped: %s", duplicate_of, fingerprint)
+            return duplicate_of
+        if on_duplicate == DUPLICATE_REPLACE:
+            _replace_receipt(cursor, duplicate_of, receipt_data, event_id, dimension_cache)
+            logger.warning("Receipt with ID %s replaced by a new reading: %s", duplicate_of, fingerprint)
+            return duplicate_of
+        logger.warning("Receipt flagged as a duplicate of receipt ID %s: %s", duplicate_of, fingerprint)
+
+    cursor.execute('''
+            INSERT INTO receipts (event_id, date, fournisseur_id, localisation, fingerprint, duplicate_of)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+        event_id, receipt_data['date'], dimension_cache.intern(cursor, 'fournisseur', receipt_data['fournisseur']),
+        receipt_data['localisation'], fingerprint, duplicate_of))
+
+    receipt_id = cursor.lastrowid
+    _insert_articles(cursor, receipt_id, receipt_data['articles'], dimension_cache)
+    # Une ligne par ticket, au niveau DEBUG : le détail des articles reste en base
+    logger.debug("Inserted receipt with ID %s and %s articles: Date: %s, Fournisseur: %s, Localisation: %s", receipt_id,
+                 len(receipt_data['articles']), receipt_data['date'], receipt_data['fournisseur'], receipt_data['localisation'])
+    return receipt_id
+
+def insert_receipt_data(db_path, receipt_data, event_id, on_duplicate=DUPLICATE_POLICY):
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
-        # Check if an event with the same or similar name already exists
-        cursor.execute('''
+        receipt_id = _insert_receipt(cursor, receipt_data, event_id, on_duplicate)
+        conn.commit()
+        return receipt_id
+    except Exception as e:
+        logger.error("Error inserting data into database: %s", e)
+    finally:
+        conn.close()
+
+@instrumented('db.insert_event')
+def _insert_event(cursor, event_name, event_date):
+    # Check if an event with the same or similar name already exists
+    cursor.execute('''
             SELECT event_name, event_date FROM event WHERE event_name LIKE ?
         ''', (f'%{event_name}%',))
-        existing_events = cursor.fetchall()
+    existing_events = cursor.fetchall()
 
-        if existing_events:
-            for existing_event in existing_events:
-                if existing_event[1] != event_date:
-                    logging.warning(f"Event with a similar name but different date already exists: {existing_event}")
-                    raise EventDateMismatchError(f"L'évènement existe déjà avec une date différente:\n {existing_event}")
-            logging.error(f"Event with a similar name already exists: {existing_events}")
-            raise EventExistsError(f"L'évènement existe déjà:\n {existing_events}")
+    if existing_events:
+        for existing_event in existing_events:
+            if existing_event[1] != event_date:
+                logger.warning("Event with a similar name but different date already exists: %s", existing_event)
+                raise EventDateMismatchError(f"L'évènement existe déjà avec une date différente:\n {existing_event}")
+        logger.error("Event with a similar name already exists: %s", existing_events)
+        raise EventExistsError(f"L'évènement existe déjà:\n {existing_events}")
 
-        cursor.execute('''
+    cursor.execute('''
             INSERT INTO event (event_name, event_date)
             VALUES (?, ?)
         ''', (event_name, event_date))
 
+def _find_receipts_by_fingerprints(cursor, fingerprints):
+    fingerprints = list(set(fingerprints))
+    cursor.execute(f'''
+            SELECT fingerprint, id FROM receipts WHERE fingerprint IN ({', '.join('?' * len(fingerprints))}) AND duplicate_of IS NULL
+        ''', fingerprints)
+    return dict(cursor.fetchall())
+
+@instrumented('db.insert_receipt_batch')
+def _insert_receipt_batch(cursor, receipts, event_id, on_duplicate=DUPLICATE_POLICY, dimension_cache=None):
+    dimension_cache = dimension_cache if dimension_cache is not None else DimensionCache()
+    on_duplicate = check_duplicate_policy(on_duplicate)
+    fingerprints = [receipt_fingerprint(receipt_data) for receipt_data in receipts]
+    # Les tickets déjà en base, ou répétés dans le lot, passent ensuite un par un par la politique de doublons
+    existing = _find_receipts_by_fingerprints(cursor, fingerprints) if receipts else {}
+    new_indexes = []
+    seen = set()
+    for index, fingerprint in enumerate(fingerprints):
+        if fingerprint not in existing and fingerprint not in seen:
+            new_indexes.append(index)
+            seen.add(fingerprint)
+
+    receipt_ids = [None] * len(receipts)
+    if new_indexes:
+        cursor.executemany('''
+                INSERT INTO receipts (event_id, date, fournisseur_id, localisation, fingerprint)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(event_id, receipts[index]['date'], dimension_cache.intern(cursor, 'fournisseur', receipts[index]['fournisseur']),
+                   receipts[index]['localisation'], fingerprints[index]) for index in new_indexes])
+
+        # Dans une même transaction d'écriture, AUTOINCREMENT attribue des IDs consécutifs
+        last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        for index, receipt_id in zip(new_indexes, range(last_id - len(new_indexes) + 1, last_id + 1)):
+            receipt_ids[index] = receipt_id
+
+        articles = [(
+            receipt_ids[index],
+            dimension_cache.intern(cursor, 'famille', article['famille']),
+            dimension_cache.intern(cursor, 'sous_famille', article['sous_famille']),
+            article['nom'],
+            float(article['prix_unitaire']),
+            float(article['quantite']),
+            float(article['prix_total'])
+        ) for index in new_indexes for article in receipts[index]['articles']]
+        cursor.executemany('''
+                INSERT INTO articles (receipt_id, famille_id, sous_famille_id, nom, prix_unitaire, quantite, prix_total)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', articles)
+        logger.info("Inserted %s receipts (IDs %s to %s) with %s articles", len(new_indexes), last_id - len(new_indexes) + 1, last_id, len(articles))
+
+    for index, receipt_data in enumerate(receipts):
+        if receipt_ids[index] is None:
+            receipt_ids[index] = _insert_receipt(cursor, receipt_data, event_id, on_duplicate, dimension_cache)
+    return receipt_ids
+
+def insert_receipts_bulk(db_path, receipts, event_id, batch_size=BULK_BATCH_SIZE, on_duplicate=DUPLICATE_POLICY):
+    receipts = list(receipts)
+    receipt_ids = []
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+        for start in range(0, len(receipts), batch_size):
+            receipt_ids.extend(_insert_receipt_batch(cursor, receipts[start:start + batch_size], event_id, on_duplicate))
+            conn.commit()
+        return receipt_ids
+    except Exception as e:
+        logger.error("Error inserting receipts in bulk after %s receipts: %s", len(receipt_ids), e)
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def insert_event(db_path, event_name, event_date):
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+        _insert_event(cursor, event_name, event_date)
+
         conn.commit()
-        logging.info(f"Event '{event_name}' added successfully.")
+        logger.info("Event '%s' added successfully.", event_name)
         return f"Event '{event_name}' added successfully."
     except EventExistsError as e:
         raise e
     except EventDateMismatchError as e:
         raise e
     except Exception as e:
-        logging.error(f"Error inserting event into database: {e}")
+        logger.error("Error inserting event into database: %s", e)
         return f"Error inserting event into database: {e}"
     finally:
         if conn:
             conn.close()
 
-def insert_event_with_iteration(db_path, event_name, event_date):
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Count existing events with the same name or similar
-        cursor.execute('''
+@instrumented('db.insert_event')
+def _insert_event_with_iteration(cursor, event_name, event_date):
+    # Count existing events with the same name or similar
+    cursor.execute('''
             SELECT COUNT(*) FROM event WHERE event_name LIKE ?
         ''', (f'%{event_name}%',))
-        count = cursor.fetchone()[0]
+    count = cursor.fetchone()[0]
 
-        new_event_name = f"{event_name} ({count + 1})"
+    new_event_name = f"{event_name} ({count + 1})"
 
-        cursor.execute('''
+    cursor.execute('''
             INSERT INTO event (event_name, event_date)
             VALUES (?, ?)
         ''', (new_event_name, event_date))
+    return new_event_name
+
+def insert_event_with_iteration(db_path, event_name, event_date):
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+        new_event_name = _insert_event_with_iteration(cursor, event_name, event_date)
 
         conn.commit()
-        logging.info(f"Event '{new_event_name}' added successfully.")
+        logger.info("Event '%s' added successfully.", new_event_name)
         return f"Event '{new_event_name}' added successfully."
     except Exception as e:
-        logging.error(f"Error inserting event with iteration into database: {e}")
+        logger.error("Error inserting event with iteration into database: %s", e)
         return f"Error inserting event with iteration into database: {e}"
     finally:
         if conn:
             conn.close()
 
 
-def get_event_details(db_path, event_id):
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT e.event_name, e.event_date, r.id as receipt_id, r.date as receipt_date, r.fournisseur, r.localisation,
-                   a.id as article_id, a.famille, a.sous_famille, a.nom, a.prix_unitaire, a.quantite, a.prix_total
+@instrumented('db.event_details')
+def _select_event_details(cursor, event_id):
+    cursor.execute('''
+            SELECT e.event_name, e.event_date, r.id as receipt_id, r.date as receipt_date, fo.name as fournisseur, r.localisation,
+                   a.id as article_id, fa.name as famille, sf.name as sous_famille, a.nom, a.prix_unitaire, a.quantite, a.prix_total
             FROM event e
             JOIN receipts r ON e.id = r.event_id
             JOIN articles a ON r.id = a.receipt_id
+            LEFT JOIN dim_fournisseur fo ON fo.id = r.fournisseur_id
+            LEFT JOIN dim_famille fa ON fa.id = a.famille_id
+            LEFT JOIN dim_sous_famille sf ON sf.id = a.sous_famille_id
             WHERE e.id = ?
         ''', (event_id,))
+    return cursor.fetchall()
+
+def get_event_details(db_path, event_id):
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
 
-        rows = cursor.fetchall()
+        rows = _select_event_details(cursor, event_id)
         conn.close()
 
         return rows
     except Exception as e:
-        logging.error(f"Error fetching event details: {e}")
+        logger.error("Error fetching event details: %s", e)
         raise e
 
+@instrumented('db.receipts_page')
+def _select_receipts_page(cursor, event_id, after_receipt_id, limit):
+    # Pagination par clé (id > dernier id lu) sur idx_receipts_event_id : chaque page coûte pareil
+    cursor.execute('''
+            SELECT r.id, r.date, fo.name, r.localisation, r.receipt_total
+            FROM receipts r
+            LEFT JOIN dim_fournisseur fo ON fo.id = r.fournisseur_id
+            WHERE r.event_id = ? AND r.id > ?
+            ORDER BY r.id
+            LIMIT ?
+        ''', (event_id, after_receipt_id, limit))
+    return [ReceiptRow(*row) for row in cursor.fetchall()]
+
+@instrumented('db.receipts_articles')
+def _select_receipts_articles(cursor, receipt_ids):
+    cursor.execute(f'''
+            SELECT a.id, a.receipt_id, fa.name, sf.name, a.nom, a.prix_unitaire, a.quantite, a.prix_total
+            FROM articles a
+            LEFT JOIN dim_famille fa ON fa.id = a.famille_id
+            LEFT JOIN dim_sous_famille sf ON sf.id = a.sous_famille_id
+            WHERE a.receipt_id IN ({', '.join('?' * len(receipt_ids))})
+            ORDER BY a.receipt_id, a.id
+        ''', receipt_ids)
+    return [ArticleRow(*row) for row in cursor.fetchall()]
+
+def _iter_event_receipts(cursor, event_id, page_size=DETAILS_PAGE_SIZE):
+    after_receipt_id = 0
+    while True:
+        receipts = _select_receipts_page(cursor, event_id, after_receipt_id, page_size)
+        if not receipts:
+            return
+        articles = {}
+        for article in _select_receipts_articles(cursor, [receipt.id for receipt in receipts]):
+            articles.setdefault(article.receipt_id, []).append(article)
+        for receipt in receipts:
+            yield receipt, articles.get(receipt.id, [])
+        after_receipt_id = receipts[-1].id
+
+def _iter_event_articles(cursor, event_id, page_size=DETAILS_PAGE_SIZE):
+    for receipt, articles in _iter_event_receipts(cursor, event_id, page_size):
+        yield from articles
+
+def iter_event_receipts(db_path, event_id, page_size=DETAILS_PAGE_SIZE):
+    """Yield ``(ReceiptRow, [ArticleRow, ...])`` for each receipt of an event, in id order.
+
+    Receipts are read ``page_size`` at a time with their articles, so memory
+    stays bounded by one page whatever the size of the event. Receipts without
+    articles are yielded with an empty list.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        yield from _iter_event_receipts(conn.cursor(), event_id, page_size)
+    except Exception as e:
+        logger.error("Error fetching event details: %s", e)
+        raise
+    finally:
+        conn.close()
+
+def iter_event_articles(db_path, event_id, page_size=DETAILS_PAGE_SIZE):
+    # Forme à plat de iter_event_receipts : un ArticleRow par article
+    for receipt, articles in iter_event_receipts(db_path, event_id, page_size):
+        yield from articles
+
+@instrumented('db.event_total')
+def _select_event_total(cursor, event_id):
+    # Total matérialisé par les triggers : une simple lecture par clé primaire
+    cursor.execute("SELECT event_total FROM event WHERE id = ?", (event_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
 def get_event_total(db_path, event_id):
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT SUM(a.prix_total)
-            FROM event e
-            JOIN receipts r ON e.id = r.event_id
-            JOIN articles a ON r.id = a.receipt_id
-            WHERE e.id = ?
-        ''', (event_id,))
-
-        total = cursor.fetchone()[0]
+        total = _select_event_total(cursor, event_id)
         conn.close()
 
         return total
     except Exception as e:
-        logging.error(f"Error calculating event total: {e}")
+        logger.error("Error calculating event total: %s", e)
         raise e
+
+# Tolérance sur les totaux, les additions successives de flottants pouvant dériver légèrement
+TOTAL_TOLERANCE = 1e-6
+
+@instrumented('db.check_totals')
+def _find_total_mismatches(cursor):
+    cursor.execute('''
+            SELECT 'receipt', r.id, r.receipt_total, COALESCE(SUM(a.prix_total), 0) AS expected
+            FROM receipts r
+            LEFT JOIN articles a ON a.receipt_id = r.id
+            GROUP BY r.id
+            HAVING ABS(r.receipt_total - expected) > ?
+        ''', (TOTAL_TOLERANCE,))
+    mismatches = cursor.fetchall()
+    cursor.execute('''
+            SELECT 'event', e.id, e.event_total, COALESCE(SUM(a.prix_total), 0) AS expected
+            FROM event e
+            LEFT JOIN receipts r ON r.event_id = e.id
+            LEFT JOIN articles a ON a.receipt_id = r.id
+            GROUP BY e.id
+            HAVING ABS(e.event_total - expected) > ?
+        ''', (TOTAL_TOLERANCE,))
+    return mismatches + cursor.fetchall()
+
+@instrumented('db.rebuild_totals')
+def _rebuild_totals(cursor):
+    for statement in REBUILD_TOTALS:
+        cursor.execute(statement)
+
+def check_totals(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        mismatches = _find_total_mismatches(conn.cursor())
+        for kind, row_id, stored, expected in mismatches:
+            logger.warning("Materialized total mismatch for %s %s: stored %s, expected %s", kind, row_id, stored, expected)
+        return mismatches
+    finally:
+        conn.close()
+
+def rebuild_totals(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        _rebuild_totals(conn.cursor())
+        conn.commit()
+        logger.info("Materialized receipt and event totals rebuilt.")
+    except Exception as e:
+        conn.rollback()
+        logger.error("Error rebuilding totals: %s", e)
+        raise
+    finally:
+        conn.close()
+
+@instrumented('db.events')
+def _select_events(cursor):
+    cursor.execute("SELECT id, event_name, event_date FROM event")
+    return cursor.fetchall()
+
+def _like_prefix(query):
+    # Échapper les jokers de LIKE pour une recherche par préfixe littérale
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+@instrumented('db.events_page')
+def _select_events_page(cursor, query, offset, limit):
+    if query:
+        cursor.execute('''
+            SELECT id, event_name, event_date FROM event
+            WHERE event_name LIKE ? ESCAPE '\\'
+            ORDER BY event_name COLLATE NOCASE, id
+            LIMIT ? OFFSET ?
+        ''', (_like_prefix(query), limit, offset))
+    else:
+        cursor.execute("SELECT id, event_name, event_date FROM event ORDER BY id LIMIT ? OFFSET ?", (limit, offset))
+    return cursor.fetchall()
+
+@instrumented('db.count_events')
+def _count_events(cursor, query):
+    if query:
+        cursor.execute("SELECT COUNT(*) FROM event WHERE event_name LIKE ? ESCAPE '\\'", (_like_prefix(query),))
+    else:
+        cursor.execute("SELECT COUNT(*) FROM event")
+    return cursor.fetchone()[0]
+
+def _select_flagged_duplicates(cursor):
+    # Tickets enregistrés avec la politique 'flag' (ou marqués par la migration 8), avec le ticket d'origine
+    cursor.execute('''
+            SELECT r.id, r.duplicate_of, r.event_id, r.date, fo.name, r.receipt_total
+            FROM receipts r
+            LEFT JOIN dim_fournisseur fo ON fo.id = r.fournisseur_id
+            WHERE r.duplicate_of IS NOT NULL
+            ORDER BY r.duplicate_of, r.id
+        ''')
+    return cursor.fetchall()
+
+def _resolve_duplicate(cursor, receipt_id, keep=False):
+    cursor.execute("SELECT duplicate_of FROM receipts WHERE id = ? AND duplicate_of IS NOT NULL", (receipt_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"Receipt {receipt_id} is not flagged as a duplicate")
+    duplicate_of = row[0]
+    if keep:
+        # Achat distinct : l'empreinte reçoit l'ID du ticket pour ne pas heurter l'index unique,
+        # les relectures suivantes restent rapprochées du ticket d'origine
+        cursor.execute('''
+                UPDATE receipts SET duplicate_of = NULL, fingerprint = fingerprint || '#' || id WHERE id = ?
+            ''', (receipt_id,))
+        return duplicate_of
+    # Relecture du même ticket : jobs et métriques pointent vers l'original, les triggers retirent les totaux
+    cursor.execute("UPDATE jobs SET receipt_id = ? WHERE receipt_id = ?", (duplicate_of, receipt_id))
+    cursor.execute("UPDATE metrics SET receipt_id = ? WHERE receipt_id = ?", (duplicate_of, receipt_id))
+    cursor.execute("DELETE FROM articles WHERE receipt_id = ?", (receipt_id,))
+    cursor.execute("DELETE FROM receipts WHERE id = ?", (receipt_id,))
+    return duplicate_of
+
+def _select_event(cursor, event_id):
+    cursor.execute("SELECT event_name, event_date FROM event WHERE id = ?", (event_id,))
+    return cursor.fetchone()
+
+
+class ReceiptDatabase:
+    """Long-lived access to the receipts database.
+
+    The schema is checked once, then every call reuses open connections in WAL
+    mode: a single writer connection shared behind a lock, and one read-only
+    connection per thread, so reads from the UI never wait on ingestion writes.
+    Statements are prepared once per connection thanks to sqlite3's statement
+    cache.
+    """
+
+    def __init__(self, db_path, synchronous=SYNCHRONOUS, cache_size_kib=CACHE_SIZE_KIB, mmap_size=MMAP_SIZE,
+                 duplicate_policy=DUPLICATE_POLICY):
+        self.db_path = db_path
+        self.duplicate_policy = check_duplicate_policy(duplicate_policy)
+        # Identifiants des noms de famille, sous-famille et fournisseur déjà rencontrés
+        self.dimension_cache = DimensionCache()
+        self.synchronous = synchronous
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+
+        initialize_database(db_path)
+
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def writer(self):
+        # Une seule transaction d'écriture à la fois, validée ou annulée en bloc
+        with span('db.write_lock_wait'):
+            self._write_lock.acquire()
+        try:
+            cursor = self._writer.cursor()
+            try:
+                yield cursor
+                with span('db.commit'):
+                    self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                # Des noms ajoutés aux dimensions pendant la transaction n'existent plus
+                self.dimension_cache.clear()
+                raise
+            finally:
+                cursor.close()
+        finally:
+            self._write_lock.release()
+
+    def reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+        self._local = threading.local()
+        with self._write_lock:
+            self._writer.close()
+
+    def insert_receipt_data(self, receipt_data, event_id, on_duplicate=None):
+        with self.writer() as cursor:
+            return _insert_receipt(cursor, receipt_data, event_id, on_duplicate or self.duplicate_policy,
+                                   self.dimension_cache)
+
+    def insert_receipts_bulk(self, receipts, event_id, batch_size=BULK_BATCH_SIZE, on_duplicate=None):
+        receipts = list(receipts)
+        receipt_ids = []
+        for start in range(0, len(receipts), batch_size):
+            with self.writer() as cursor:
+                receipt_ids.extend(_insert_receipt_batch(cursor, receipts[start:start + batch_size], event_id,
+                                                         on_duplicate or self.duplicate_policy, self.dimension_cache))
+        return receipt_ids
+
+    def get_flagged_duplicates(self):
+        return _select_flagged_duplicates(self.reader().cursor())
+
+    def resolve_duplicate(self, receipt_id, keep=False):
+        """Settle a receipt flagged as a duplicate; returns the id of the receipt it duplicated.
+
+        By default the flagged receipt is a second reading and is deleted with
+        its articles, which takes it out of the totals and the breakdown.
+        ``keep=True`` clears the flag for a distinct purchase sharing the fingerprint.
+        """
+        with self.writer() as cursor:
+            duplicate_of = _resolve_duplicate(cursor, receipt_id, keep)
+        logger.info("Flagged receipt %s %s (duplicate of %s).", receipt_id, 'kept' if keep else 'deleted', duplicate_of)
+        return duplicate_of
+
+    def insert_event(self, event_name, event_date):
+        with self.writer() as cursor:
+            _insert_event(cursor, event_name, event_date)
+        logger.info("Event '%s' added successfully.", event_name)
+        return f"Event '{event_name}' added successfully."
+
+    def insert_event_with_iteration(self, event_name, event_date):
+        with self.writer() as cursor:
+            new_event_name = _insert_event_with_iteration(cursor, event_name, event_date)
+        logger.info("Event '%s' added successfully.", new_event_name)
+        return f"Event '{new_event_name}' added successfully."
+
+    def get_events(self):
+        return _select_events(self.reader().cursor())
+
+    def search_events(self, query='', offset=0, limit=100):
+        return _select_events_page(self.reader().cursor(), query, offset, limit)
+
+    def count_events(self, query=''):
+        return _count_events(self.reader().cursor(), query)
+
+    def get_event(self, event_id):
+        return _select_event(self.reader().cursor(), event_id)
+
+    def get_event_details(self, event_id):
+        return _select_event_details(self.reader().cursor(), event_id)
+
+    def iter_event_receipts(self, event_id, page_size=DETAILS_PAGE_SIZE):
+        return _iter_event_receipts(self.reader().cursor(), event_id, page_size)
+
+    def iter_event_articles(self, event_id, page_size=DETAILS_PAGE_SIZE):
+        return _iter_event_articles(self.reader().cursor(), event_id, page_size)
+
+    def get_event_total(self, event_id):
+        return _select_event_total(self.reader().cursor(), event_id)
+
+    def check_totals(self):
+        return _find_total_mismatches(self.reader().cursor())
+
+    def rebuild_totals(self):
+        with self.writer() as cursor:
+            _rebuild_totals(cursor)
+        logger.info("Materialized receipt and event totals rebuilt.")
+
+    def enqueue_jobs(self, image_paths, event_id):
+        with self.writer() as cursor:
+            return jobs.enqueue_jobs(cursor, image_paths, event_id)
+
+    def claim_jobs(self, job_ids, lease=jobs.LEASE_SECONDS):
+        with self.writer() as cursor:
+            return jobs.claim_jobs(cursor, job_ids, lease)
+
+    def complete_job(self, job, receipt_data):
+        # Ticket et fin du job dans la même transaction : après un plantage, soit les deux existent, soit aucun.
+        # job : le Job renvoyé par claim_jobs, dont l'évènement reçoit le ticket
+        with self.writer() as cursor:
+            receipt_id = _insert_receipt(cursor, receipt_data, job.event_id, self.duplicate_policy, self.dimension_cache)
+            jobs.complete_job(cursor, job, receipt_id)
+        return receipt_id
+
+    def fail_job(self, job, error):
+        with self.writer() as cursor:
+            return jobs.fail_job(cursor, job, error)
+
+    def release_jobs(self, claimed):
+        with self.writer() as cursor:
+            return jobs.release_jobs(cursor, claimed)
+
+    def recover_jobs(self):
+        with self.writer() as cursor:
+            recovered = jobs.recover_jobs(cursor)
+        if recovered:
+            logger.info("%s interrupted jobs put back in the queue.", recovered)
+        return recovered
+
+    def unfinished_jobs(self):
+        return jobs.select_unfinished_jobs(self.reader().cursor())
+
+    def count_jobs(self):
+        return jobs.count_jobs(self.reader().cursor())
+
+    def record_metrics(self, receipt_id, event_id, image_name, image_metrics):
+        with self.writer() as cursor:
+            return metrics.insert_image_metrics(cursor, receipt_id, event_id, image_name, image_metrics)
+
+    def metrics_report(self, event_id=None):
+        return metrics.select_event_reports(self.reader().cursor(), event_id)
+
+    def mode_report(self):
+        return metrics.select_mode_reports(self.reader().cursor())
+
+    def spending_breakdown(self, dimensions, event_ids=None, start_month=None, end_month=None, filters=None):
+        return analytics.select_breakdown(self.reader().cursor(), dimensions, event_ids, start_month, end_month, filters)
@@ -0,0 +1,90 @@
+# dimensions.py
+"""Dictionary encoding of the famille, sous_famille and fournisseur names.
+
+Each distinct name is stored once in a dimension table and referenced by an
+integer id from articles and receipts. Names that differ only by case,
+accents or spacing ("Alimentation", "ALIMENTATION ") share one entry, shown
+with the spelling seen first (or most often, for converted databases).
+DimensionCache keeps the name -> id lookups of a process in memory so that
+ingestion does not query the dimension tables for every article.
+"""
+import threading
+import unicodedata
+
+# Dimension -> table du dictionnaire
+DIMENSION_TABLES = {
+    'famille': 'dim_famille',
+    'sous_famille': 'dim_sous_famille',
+    'fournisseur': 'dim_fournisseur',
+}
+
+# Tables installées par la migration 9 de database.py
+DIMENSION_SCHEMA = [
+    f'''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        key TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL
+    )
+    ''' for table in DIMENSION_TABLES.values()
+]
+
+
+def dimension_name(name):
+    # Nom affiché : espaces superflus retirés, None pour un nom vide
+    if name is None:
+        return None
+    name = ' '.join(str(name).split())
+    return name or None
+
+
+def dimension_key(name):
+    # Clé de comparaison : sans casse, sans accents, espaces normalisés
+    name = dimension_name(name)
+    if name is None:
+        return None
+    text = unicodedata.normalize('NFKD', name)
+    return ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+
+
+def intern_name(cursor, dimension, name):
+    """Return the id of ``name`` in the table of ``dimension``, adding it if needed; None for no name."""
+    key = dimension_key(name)
+    if key is None:
+        return None
+    table = DIMENSION_TABLES[dimension]
+    cursor.execute(f"SELECT id FROM {table} WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    cursor.execute(f"INSERT INTO {table} (key, name) VALUES (?, ?)", (key, dimension_name(name)))
+    return cursor.lastrowid
+
+
+class DimensionCache:
+    """In-memory name -> id lookups, shared by the threads of a process.
+
+    Ids learnt inside a write transaction that is rolled back may not exist:
+    the owner of the cache must call clear() after a rollback.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def intern(self, cursor, dimension, name):
+        with self._lock:
+            dimension_id = self._ids.get((dimension, name))
+        if dimension_id is None:
+            dimension_id = intern_name(cursor, dimension, name)
+            if dimension_id is not None:
+                with self._lock:
+                    self._ids[(dimension, name)] = dimension_id
+        return dimension_id
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def __len__(self):
+        return len(self._ids)
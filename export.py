@@ -0,0 +1,235 @@
+# export.py
+"""Streaming export of receipts and articles to CSV, or Parquet when pyarrow is installed.
+
+    python export.py receipts.csv [--event-id 3] [--since-file receipts.watermark]
+
+Rows are read from a single cursor ``chunk_size`` at a time and written as
+they come, so memory stays bounded by one chunk whatever the size of the
+event. Each export covers the receipts whose id is above a watermark and
+returns the new watermark: a nightly sync that keeps it (see sync_export)
+only writes the receipts added since its last run. A receipt replaced in
+place by the duplicate policy keeps its id and is not exported again.
+"""
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+import sqlite3
+from collections import namedtuple
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow absent: seul l'export CSV est disponible
+    pyarrow = None
+
+import log_setup
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+CSV = 'csv'
+PARQUET = 'parquet'
+FORMATS = (CSV, PARQUET)
+PARQUET_AVAILABLE = pyarrow is not None
+
+EXPORT_CHUNK_SIZE = int(os.getenv('RECEIPT_EXPORT_CHUNK', '5000'))  # lignes lues et écrites à la fois
+
+# Une ligne par article ; un ticket sans article donne une ligne aux colonnes d'article vides
+EXPORT_COLUMNS = [
+    ('event_id', 'int64'), ('event_name', 'string'), ('event_date', 'string'),
+    ('receipt_id', 'int64'), ('date', 'string'), ('fournisseur', 'string'), ('localisation', 'string'),
+    ('duplicate_of', 'int64'),
+    ('article_id', 'int64'), ('famille', 'string'), ('sous_famille', 'string'), ('nom', 'string'),
+    ('prix_unitaire', 'float64'), ('quantite', 'float64'), ('prix_total', 'float64'),
+]
+
+ExportResult = namedtuple('ExportResult', ['path', 'format', 'rows', 'receipts', 'since_receipt_id', 'watermark'])
+
+
+def export_format(path, format=None):
+    # Format explicite, sinon déduit de l'extension du fichier
+    if format is None:
+        extension = os.path.splitext(path)[1].lower()
+        format = {'.csv': CSV, '.parquet': PARQUET, '.pq': PARQUET}.get(extension)
+        if format is None:
+            raise ValueError(f"Cannot infer the export format of {path}, expected one of {FORMATS}")
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format {format!r}, expected one of {FORMATS}")
+    if format == PARQUET and not PARQUET_AVAILABLE:
+        raise ImportError("pyarrow is required for Parquet exports")
+    return format
+
+
+def _select_watermark(cursor, event_id=None):
+    # Borne haute figée avant la lecture : les tickets insérés pendant l'export iront au suivant
+    if event_id is None:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM receipts")
+    else:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM receipts WHERE event_id = ?", (event_id,))
+    return cursor.fetchone()[0]
+
+
+def _iter_export_chunks(cursor, since_receipt_id, until_receipt_id, event_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of at most ``chunk_size`` export rows for the receipts in (since, until], in id order."""
+    event_filter = "AND r.event_id = ?" if event_id is not None else ""
+    parameters = (since_receipt_id, until_receipt_id) + ((event_id,) if event_id is not None else ())
+    cursor.execute(f'''
+            SELECT r.event_id, e.event_name, e.event_date,
+                   r.id, r.date, fo.name, r.localisation, r.duplicate_of,
+                   a.id, fa.name, sf.name, a.nom, a.prix_unitaire, a.quantite, a.prix_total
+            FROM receipts r
+            JOIN event e ON e.id = r.event_id
+            LEFT JOIN dim_fournisseur fo ON fo.id = r.fournisseur_id
+            LEFT JOIN articles a ON a.receipt_id = r.id
+            LEFT JOIN dim_famille fa ON fa.id = a.famille_id
+            LEFT JOIN dim_sous_famille sf ON sf.id = a.sous_famille_id
+            WHERE r.id > ? AND r.id <= ? {event_filter}
+            ORDER BY r.id, a.id
+        ''', parameters)
+    while True:
+        with span('export.fetch'):
+            rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _write_csv(path, chunks):
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow([name for name, _ in EXPORT_COLUMNS])
+        for chunk in chunks:
+            with span('export.write'):
+                writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+
+def _parquet_schema():
+    types = {'int64': pyarrow.int64(), 'string': pyarrow.string(), 'float64': pyarrow.float64()}
+    return pyarrow.schema([(name, types[type_name]) for name, type_name in EXPORT_COLUMNS])
+
+
+def _write_parquet(path, chunks):
+    # Un groupe de lignes Parquet par bloc lu : le fichier n'est jamais entier en mémoire
+    rows = 0
+    schema = _parquet_schema()
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            with span('export.write'):
+                columns = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*chunk), schema)]
+                writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+_WRITERS = {CSV: _write_csv, PARQUET: _write_parquet}
+
+
+def _export(cursor, path, format=None, event_id=None, since_receipt_id=0, chunk_size=EXPORT_CHUNK_SIZE,
+            until_receipt_id=None):
+    format = export_format(path, format)
+    if until_receipt_id is None:
+        until_receipt_id = _select_watermark(cursor, event_id)
+    watermark = max(until_receipt_id, since_receipt_id)
+    receipts = set()
+
+    def chunks():
+        for chunk in _iter_export_chunks(cursor, since_receipt_id, watermark, event_id, chunk_size):
+            receipts.update(row[3] for row in chunk)
+            yield chunk
+
+    # Écriture dans un fichier temporaire : un export interrompu ne laisse pas de fichier tronqué
+    partial_path = path + '.partial'
+    try:
+        rows = _WRITERS[format](partial_path, chunks())
+        os.replace(partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    logger.info("Exported %s rows from %s receipts to %s", rows, len(receipts), path)
+    return ExportResult(path, format, rows, len(receipts), since_receipt_id, watermark)
+
+
+def export_receipts(db_path, path, format=None, event_id=None, since_receipt_id=0, chunk_size=EXPORT_CHUNK_SIZE):
+    """Write the articles of the receipts with an id above ``since_receipt_id`` to ``path``.
+
+    ``format`` is 'csv' or 'parquet', inferred from the extension when None;
+    ``event_id`` limits the export to one event. Returns an ExportResult
+    whose ``watermark`` is the ``since_receipt_id`` of the next export.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        return _export(conn.cursor(), path, format, event_id, since_receipt_id, chunk_size)
+    except Exception as e:
+        logger.error("Error exporting receipts to %s: %s", path, e)
+        raise
+    finally:
+        conn.close()
+
+
+def read_watermark(watermark_path):
+    # Aucun fichier : premier export, tout est écrit
+    try:
+        with open(watermark_path, encoding='utf-8') as file:
+            return int(json.load(file)['receipt_id'])
+    except FileNotFoundError:
+        return 0
+
+
+def write_watermark(watermark_path, receipt_id):
+    partial_path = watermark_path + '.partial'
+    with open(partial_path, 'w', encoding='utf-8') as file:
+        json.dump({'receipt_id': receipt_id}, file)
+    os.replace(partial_path, watermark_path)
+
+
+def sync_export(db_path, folder, watermark_path, format=CSV, event_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Export the receipts added since the watermark stored in ``watermark_path`` into ``folder``.
+
+    The file is named after the receipt id range it covers and the watermark
+    is only advanced once it is complete. Returns None when nothing is new.
+    """
+    since_receipt_id = read_watermark(watermark_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        until_receipt_id = _select_watermark(cursor, event_id)
+        if until_receipt_id <= since_receipt_id:
+            logger.info("No receipt added since receipt %s", since_receipt_id)
+            return None
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"receipts_{since_receipt_id + 1}-{until_receipt_id}.{format}")
+        result = _export(cursor, path, format, event_id, since_receipt_id, chunk_size, until_receipt_id)
+    finally:
+        conn.close()
+    write_watermark(watermark_path, result.watermark)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="fichier .csv ou .parquet, ou dossier avec --since-file")
+    parser.add_argument("--db", default='./receipts.db')
+    parser.add_argument("--event-id", type=int)
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--since-file", help="fichier du dernier ticket exporté, pour un export incrémental")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    log_setup.setup_logging()
+
+    if args.since_file:
+        sync_export(args.db, args.output, args.since_file, args.format or CSV, args.event_id, args.chunk_size)
+    else:
+        export_receipts(args.db, args.output, args.format, args.event_id, chunk_size=args.chunk_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# image_preprocessing.py
+import io
+import os
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow absent: les images sont envoyées telles quelles
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# Réglages par défaut de la préparation des images avant envoi à l'API
+LONG_EDGE = 1600          # Plus grand côté en pixels après réduction
+JPEG_QUALITY = 75
+GRAYSCALE = True
+CROP_TO_RECEIPT = True
+CROP_THRESHOLD = 140      # Niveau de gris au-dessus duquel un pixel est considéré comme du papier
+CROP_MARGIN = 10
+CROP_MIN_AREA = 0.2       # En dessous de 20% de l'image, le recadrage est jugé peu fiable
+
+PREPROCESS_ENABLED = Image is not None and os.getenv('RECEIPT_PREPROCESS', '1') != '0'
+
+PreprocessedImage = namedtuple('PreprocessedImage', ['image_path', 'data', 'original_size', 'bytes_saved'])
+
+
+def crop_to_receipt(image, threshold=CROP_THRESHOLD, margin=CROP_MARGIN, min_area=CROP_MIN_AREA):
+    # Un ticket est un papier clair posé sur un fond plus sombre : on garde la zone claire
+    gray = image if image.mode == 'L' else image.convert('L')
+    bbox = gray.point(lambda value: 255 if value > threshold else 0).getbbox()
+    if bbox is None:
+        return image
+
+    left, top, right, bottom = bbox
+    if (right - left) * (bottom - top) < min_area * image.width * image.height:
+        return image
+    return image.crop((max(0, left - margin), max(0, top - margin),
+                       min(image.width, right + margin), min(image.height, bottom + margin)))
+
+
+def preprocess_image(image_path, long_edge=LONG_EDGE, quality=JPEG_QUALITY, grayscale=GRAYSCALE, crop=CROP_TO_RECEIPT):
+    """Auto-orient, crop, convert and downscale an image, then re-encode it as JPEG.
+
+    The original bytes are kept when Pillow is missing, when the file cannot be
+    decoded, or when re-encoding would not make it smaller.
+    """
+    with open(image_path, "rb") as image_file:
+        original = image_file.read()
+
+    if Image is None:
+        return PreprocessedImage(image_path, original, len(original), 0)
+
+    try:
+        with Image.open(io.BytesIO(original)) as image:
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('L' if grayscale else 'RGB')
+            if crop:
+                image = crop_to_receipt(image)
+            if max(image.size) > long_edge:
+                image.thumbnail((long_edge, long_edge), Image.LANCZOS)
+
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+            data = output.getvalue()
+    except Exception as e:
+        logger.warning("Could not preprocess image %s, sending it unchanged: %s", os.path.basename(image_path), e)
+        return PreprocessedImage(image_path, original, len(original), 0)
+
+    if len(data) >= len(original):
+        data = original
+    bytes_saved = len(original) - len(data)
+    logger.info("Preprocessed image %s: %s -> %s bytes (%s saved)", os.path.basename(image_path), len(original), len(data), bytes_saved)
+    return PreprocessedImage(image_path, data, len(original), bytes_saved)
+
+
+def create_process_pool(max_workers=None):
+    # Le redimensionnement est limité par le CPU : un processus par cœur par défaut
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
+def preprocess_images(image_paths, max_workers=None, **options):
+    with create_process_pool(max_workers) as pool:
+        futures = [pool.submit(preprocess_image, image_path, **options) for image_path in image_paths]
+        return [future.result() for future in futures]
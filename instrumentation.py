@@ -0,0 +1,217 @@
+# instrumentation.py
+"""Lightweight timing of the processing stages.
+
+``with span('reader.http'):`` adds the duration of the block to an in-memory
+histogram named after the stage, and ``@instrumented('db.insert_receipt')``
+does the same for every call of a function. ``snapshot()`` returns count,
+total, mean and percentiles per stage, ``dump(path)`` writes them as JSON,
+and ``start_periodic_dump`` does so every few seconds from a daemon thread.
+
+Setting RECEIPT_PROFILE to ``cprofile``, ``tracemalloc`` or both (comma
+separated) also profiles the code running inside spans, in every thread;
+dump writes the results next to the JSON file (``.prof`` and ``.mem.txt``).
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import cProfile
+import pstats
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Bornes supérieures des classes des histogrammes, en secondes (progression logarithmique)
+BUCKETS = [0.0001 * 2 ** exponent for exponent in range(21)]  # 0.1ms .. ~105s
+PERCENTILES = (0.5, 0.95, 0.99)
+
+PROFILE_MODES = {mode.strip() for mode in os.getenv('RECEIPT_PROFILE', '').lower().split(',') if mode.strip()}
+DUMP_PATH = os.getenv('RECEIPT_INSTRUMENTATION_DUMP')
+DUMP_INTERVAL = float(os.getenv('RECEIPT_INSTRUMENTATION_INTERVAL', '60'))  # secondes
+TRACEMALLOC_TOP = 25
+
+
+class Histogram:
+    """Durations of one stage: counts per bucket plus exact count, sum, min and max."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+
+    def percentile(self, fraction):
+        # Borne supérieure de la classe contenant le rang demandé, ramenée dans [min, max]
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        summary = {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else None,
+            "min_s": self.min,
+            "max_s": self.max,
+        }
+        for fraction in PERCENTILES:
+            summary[f"p{int(fraction * 100)}_s"] = self.percentile(fraction)
+        return summary
+
+
+if 'tracemalloc' in PROFILE_MODES:
+    tracemalloc.start()
+
+_histograms = {}
+_lock = threading.Lock()
+_local = threading.local()
+_profilers = []
+_dump_thread = None
+_dump_path = None
+_dump_stop = threading.Event()
+
+
+def record(name, duration):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(duration)
+
+
+def _profiler():
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        profiler = _local.profiler = cProfile.Profile()
+        with _lock:
+            _profilers.append(profiler)
+    return profiler
+
+
+@contextmanager
+def span(name):
+    # Seul le span le plus externe d'un thread active le profileur de ce thread
+    depth = getattr(_local, 'depth', 0)
+    profile = 'cprofile' in PROFILE_MODES and depth == 0
+    _local.depth = depth + 1
+    if profile:
+        _profiler().enable()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        if profile:
+            _profiler().disable()
+        _local.depth = depth
+        record(name, duration)
+
+
+def instrumented(name):
+    """Decorator timing every call of the function under the span ``name``."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        return {name: histogram.summary() for name, histogram in sorted(_histograms.items())}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        for profiler in _profilers:
+            profiler.clear()
+
+
+def profile_stats():
+    """Merge the cProfile data of every thread into one pstats.Stats, or None."""
+    with _lock:
+        profilers = list(_profilers)
+    stats = None
+    for profiler in profilers:
+        try:
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        except TypeError:  # Profileur sans données
+            continue
+    return stats
+
+
+def dump(path):
+    """Write the snapshot to ``path`` as JSON, plus the profiles when RECEIPT_PROFILE is set."""
+    data = {"timestamp": time.time(), "pid": os.getpid(), "stages": snapshot()}
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as dump_file:
+        json.dump(data, dump_file, indent=2)
+    # Remplacement atomique : un lecteur ne voit jamais un fichier à moitié écrit
+    os.replace(temporary_path, path)
+
+    if 'cprofile' in PROFILE_MODES:
+        stats = profile_stats()
+        if stats is not None:
+            stats.dump_stats(f"{path}.prof")
+    if 'tracemalloc' in PROFILE_MODES and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"current={current} peak={peak}"]
+        lines.extend(str(statistic) for statistic in tracemalloc.take_snapshot().statistics('lineno')[:TRACEMALLOC_TOP])
+        with open(f"{path}.mem.txt", "w", encoding="utf-8") as memory_file:
+            memory_file.write("\n".join(lines) + "\n")
+    return data
+
+
+def _dump_loop(path, interval):
+    while not _dump_stop.wait(interval):
+        try:
+            dump(path)
+        except Exception as e:
+            logger.error("Error dumping instrumentation to %s: %s", path, e)
+
+
+def start_periodic_dump(path=DUMP_PATH, interval=DUMP_INTERVAL):
+    global _dump_thread, _dump_path
+    if not path or _dump_thread is not None:
+        return
+    _dump_path = path
+    _dump_stop.clear()
+    _dump_thread = threading.Thread(target=_dump_loop, args=(path, interval), name="instrumentation-dump", daemon=True)
+    _dump_thread.start()
+    logger.info("Instrumentation dumped to %s every %ss", path, interval)
+
+
+def stop_periodic_dump():
+    # Arrête le thread et écrit un dernier état complet
+    global _dump_thread
+    if _dump_thread is None:
+        return
+    _dump_stop.set()
+    _dump_thread.join()
+    _dump_thread = None
+    dump(_dump_path)
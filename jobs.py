@@ -0,0 +1,161 @@
+# jobs.py
+"""Durable queue of the images to process, in the ``jobs`` table.
+
+Each image queued for an event gets a job that goes from ``pending`` to
+``in_flight`` when a worker claims it, for ``lease`` seconds, then to
+``done`` (in the same transaction as its receipt) or ``failed``. Jobs left
+in flight by a crash are claimed again once their lease expires, or at once
+after recover_jobs; jobs already done are never sent to the API again.
+
+Each claim increments ``attempts``, so the Job returned by claim_jobs
+identifies its lease: complete_job, fail_job and release_jobs only change
+a job still held under that claim, never one a worker took over since.
+"""
+import time
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_SECONDS = 600   # Durée d'un bail, au-delà de laquelle un job en cours peut être repris
+MAX_ATTEMPTS = 3      # Baux expirés tolérés avant d'abandonner une image (plantage à chaque essai)
+CLAIM_CHUNK_SIZE = 500  # Identifiants par requête, sous la limite de variables de SQLite
+
+Job = namedtuple('Job', ['id', 'image_path', 'event_id', 'state', 'attempts', 'lease_until', 'receipt_id', 'error'])
+_JOB_COLUMNS = "id, image_path, event_id, state, attempts, lease_until, receipt_id, error"
+
+
+class JobStateError(Exception):
+    pass
+
+
+# Table installée par la migration 7 de database.py
+JOBS_SCHEMA = [
+    f'''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_path TEXT NOT NULL,
+        event_id INTEGER NOT NULL,
+        state TEXT NOT NULL DEFAULT '{PENDING}' CHECK (state IN ('{PENDING}', '{IN_FLIGHT}', '{DONE}', '{FAILED}')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        receipt_id INTEGER,
+        error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        FOREIGN KEY (event_id) REFERENCES event (id),
+        FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+    )
+    ''',
+    # Une image n'a qu'un job non terminé à la fois ; une fois traitée elle peut être remise en file
+    f"CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_image ON jobs (image_path) WHERE state != '{DONE}'",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id)",
+]
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CLAIM_CHUNK_SIZE):
+        yield values[start:start + CLAIM_CHUNK_SIZE]
+
+
+def enqueue_jobs(cursor, image_paths, event_id, now=None):
+    """Queue the images for ``event_id`` and return their job ids, in order.
+
+    An image that already has a pending or in-flight job keeps it; a failed
+    one is queued again for ``event_id``.
+    """
+    now = time.time() if now is None else now
+    job_ids = []
+    for image_path in image_paths:
+        cursor.execute(f'''
+            INSERT INTO jobs (image_path, event_id, state, created_at, updated_at) VALUES (?, ?, '{PENDING}', ?, ?)
+            ON CONFLICT (image_path) WHERE state != '{DONE}' DO UPDATE SET
+                state = '{PENDING}', event_id = excluded.event_id, attempts = 0, lease_until = NULL, error = NULL,
+                updated_at = excluded.updated_at
+            WHERE state = '{FAILED}'
+        ''', (image_path, event_id, now, now))
+        cursor.execute(f"SELECT id FROM jobs WHERE image_path = ? AND state != '{DONE}'", (image_path,))
+        job_ids.append(cursor.fetchone()[0])
+    return job_ids
+
+
+def claim_jobs(cursor, job_ids, lease=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, now=None):
+    """Move the pending (or expired in-flight) jobs among ``job_ids`` in flight and return them, by id."""
+    now = time.time() if now is None else now
+    claimed = []
+    for chunk in _chunks(job_ids):
+        placeholders = ', '.join('?' * len(chunk))
+        # Un job dont chaque bail a expiré fait sans doute tomber le processus : il est abandonné
+        cursor.execute(f'''
+            UPDATE jobs SET state = '{FAILED}', error = 'Lease expired after ' || attempts || ' attempts', updated_at = ?
+            WHERE id IN ({placeholders}) AND state = '{IN_FLIGHT}' AND lease_until < ? AND attempts >= ?
+        ''', (now, *chunk, now, max_attempts))
+        if cursor.rowcount:
+            logger.warning("%s jobs failed after %s expired leases", cursor.rowcount, max_attempts)
+        cursor.execute(f'''
+            UPDATE jobs SET state = '{IN_FLIGHT}', attempts = attempts + 1, lease_until = ?, updated_at = ?
+            WHERE id IN ({placeholders}) AND (state = '{PENDING}' OR (state = '{IN_FLIGHT}' AND lease_until < ?))
+            RETURNING {_JOB_COLUMNS}
+        ''', (now + lease, now, *chunk, now))
+        claimed.extend(Job(*row) for row in cursor.fetchall())
+    return sorted(claimed)
+
+
+def complete_job(cursor, job, receipt_id, now=None):
+    # job : le Job renvoyé par claim_jobs. Lève JobStateError si le bail a été perdu (expiré et repris
+    # par un autre worker, ou remis en file), pour annuler le ticket inséré dans la même transaction
+    now = time.time() if now is None else now
+    cursor.execute(f'''
+        UPDATE jobs SET state = '{DONE}', receipt_id = ?, lease_until = NULL, error = NULL, updated_at = ?
+        WHERE id = ? AND attempts = ? AND state = '{IN_FLIGHT}'
+    ''', (receipt_id, now, job.id, job.attempts))
+    if cursor.rowcount != 1:
+        raise JobStateError(f"Job {job.id} is no longer held by this claim")
+
+
+def fail_job(cursor, job, error, now=None):
+    # Renvoie False si le bail a été perdu : le job appartient alors à un autre worker
+    now = time.time() if now is None else now
+    cursor.execute(f'''
+        UPDATE jobs SET state = '{FAILED}', error = ?, lease_until = NULL, updated_at = ?
+        WHERE id = ? AND attempts = ? AND state = '{IN_FLIGHT}'
+    ''', (error, now, job.id, job.attempts))
+    return cursor.rowcount == 1
+
+
+def release_jobs(cursor, claimed, now=None):
+    # Jobs réclamés mais non traités (annulation) : rendus à la file sans compter l'essai,
+    # sauf ceux dont le bail a été repris entre-temps
+    now = time.time() if now is None else now
+    cursor.executemany(f'''
+        UPDATE jobs SET state = '{PENDING}', attempts = MAX(attempts - 1, 0), lease_until = NULL, updated_at = ?
+        WHERE id = ? AND attempts = ? AND state = '{IN_FLIGHT}'
+    ''', [(now, job.id, job.attempts) for job in claimed])
+    return cursor.rowcount
+
+
+def recover_jobs(cursor, now=None):
+    """Put every in-flight job back in the queue; only for a process that knows it is the only worker."""
+    now = time.time() if now is None else now
+    cursor.execute(f'''
+        UPDATE jobs SET state = '{PENDING}', lease_until = NULL, updated_at = ? WHERE state = '{IN_FLIGHT}'
+    ''', (now,))
+    return cursor.rowcount
+
+
+def select_unfinished_jobs(cursor):
+    cursor.execute(f'''
+        SELECT {_JOB_COLUMNS} FROM jobs WHERE state IN ('{PENDING}', '{IN_FLIGHT}') ORDER BY id
+    ''')
+    return [Job(*row) for row in cursor.fetchall()]
+
+
+def count_jobs(cursor):
+    cursor.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+    return dict(cursor.fetchall())
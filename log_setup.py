@@ -0,0 +1,83 @@
+# log_setup.py
+"""Logging configuration for the programs of the project (UI, watcher, export, benchmark).
+
+The engine modules only create loggers; a program calls setup_logging once.
+Records are put on a queue by a QueueHandler and written by a QueueListener
+thread, so the threads that read and store receipts never wait on the
+console or a log file. Levels can be set per module, from the code or with
+RECEIPT_LOG_LEVELS, e.g. ``database=DEBUG,receipt_reader=WARNING``.
+"""
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOG_LEVEL = os.getenv('RECEIPT_LOG_LEVEL', 'INFO')
+
+# Bibliothèques bavardes au niveau DEBUG (une ligne par connexion, par image ouverte)
+DEFAULT_MODULE_LEVELS = {'urllib3': 'WARNING', 'PIL': 'INFO'}
+
+_listener = None
+_queue_handler = None
+
+
+def parse_module_levels(spec):
+    # "database=DEBUG,receipt_reader=WARNING" -> {'database': 'DEBUG', 'receipt_reader': 'WARNING'}
+    levels = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, separator, level = item.partition('=')
+        if not separator or not name.strip():
+            raise ValueError(f"Invalid module level {item!r}, expected module=LEVEL")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level=LOG_LEVEL, module_levels=None, handlers=None, fmt=LOG_FORMAT, datefmt=DATE_FORMAT):
+    """Send the records of every logger through a queue to ``handlers`` (the console by default).
+
+    ``module_levels`` maps logger names to levels, on top of DEFAULT_MODULE_LEVELS
+    and RECEIPT_LOG_LEVELS. Calling it again replaces the previous setup.
+    Returns the started QueueListener.
+    """
+    global _listener, _queue_handler
+    stop_logging()
+
+    handlers = list(handlers) if handlers else [logging.StreamHandler()]
+    formatter = logging.Formatter(fmt, datefmt)
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    levels = {**DEFAULT_MODULE_LEVELS, **parse_module_levels(os.getenv('RECEIPT_LOG_LEVELS', '')), **(module_levels or {})}
+    for name, module_level in levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    # Vide la file et ferme les handlers ; appelé aussi à la sortie du programme
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,198 @@
+# metrics.py
+"""Per-image API usage: tokens, bytes sent, latency, retries and cost.
+
+One row of the ``metrics`` table is written for each processed image, linked
+to its receipt (NULL when the image could not be read) and its event. The
+report aggregates them per event: throughput, p50/p95 latency and cost.
+"""
+import sys
+import math
+import time
+import sqlite3
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Prix en dollars par million de tokens (entrée, sortie), par préfixe de nom de modèle
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+}
+
+# Mesures d'une image: requests vaut 0 quand la réponse venait du cache, output_mode
+# est le mode de sortie demandé à l'API ('json', 'text' ou 'batch')
+ImageMetrics = namedtuple('ImageMetrics', ['model', 'prompt_tokens', 'completion_tokens', 'bytes_sent', 'latency',
+                                           'retries', 'requests', 'output_mode'], defaults=[None])
+EventReport = namedtuple('EventReport', ['event_id', 'images', 'receipts', 'requests', 'prompt_tokens', 'completion_tokens',
+                                         'bytes_sent', 'receipts_per_minute', 'latency_p50', 'latency_p95', 'cost'])
+# parse_retries compte les requêtes renvoyées après une réponse illisible
+ModeReport = namedtuple('ModeReport', ['output_mode', 'images', 'requests', 'parse_retries', 'retry_rate', 'failure_rate'])
+
+# Table installée par la migration 5 de database.py, complétée par METRICS_OUTPUT_MODE (migration 6)
+METRICS_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        receipt_id INTEGER,
+        event_id INTEGER,
+        image_name TEXT,
+        model TEXT,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        bytes_sent INTEGER NOT NULL DEFAULT 0,
+        latency REAL NOT NULL DEFAULT 0,
+        retries INTEGER NOT NULL DEFAULT 0,
+        requests INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        FOREIGN KEY (receipt_id) REFERENCES receipts (id),
+        FOREIGN KEY (event_id) REFERENCES event (id)
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_metrics_event_id ON metrics (event_id, latency)",
+]
+METRICS_OUTPUT_MODE = [
+    "ALTER TABLE metrics ADD COLUMN output_mode TEXT",
+]
+
+
+def summarize_requests(request_metrics, bytes_sent, output_mode=None):
+    """Combine the receipt_reader.RequestMetrics of the calls made for one image into ImageMetrics."""
+    request_metrics = list(request_metrics)
+    if not request_metrics:
+        return ImageMetrics(None, 0, 0, 0, 0.0, 0, 0, output_mode)
+    return ImageMetrics(
+        request_metrics[-1].model,
+        sum(metric.prompt_tokens for metric in request_metrics),
+        sum(metric.completion_tokens for metric in request_metrics),
+        bytes_sent,
+        sum(metric.latency for metric in request_metrics),
+        # Tentatives HTTP refaites et requêtes renvoyées après une réponse illisible
+        sum(metric.retries for metric in request_metrics) + len(request_metrics) - 1,
+        len(request_metrics),
+        output_mode,
+    )
+
+
+def model_cost(model, prompt_tokens, completion_tokens):
+    # Le préfixe le plus long l'emporte : 'gpt-4o-mini-2024-07-18' n'est pas facturé comme 'gpt-4o'
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(prefix):
+            input_price, output_price = MODEL_PRICES[prefix]
+            return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    return 0.0
+
+
+def percentile(sorted_values, fraction):
+    # Rang le plus proche, sur des valeurs déjà triées
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def insert_image_metrics(cursor, receipt_id, event_id, image_name, image_metrics):
+    cursor.execute('''
+        INSERT INTO metrics (receipt_id, event_id, image_name, model, prompt_tokens, completion_tokens, bytes_sent,
+                             latency, retries, requests, output_mode, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (receipt_id, event_id, image_name, *image_metrics, time.time()))
+    return cursor.lastrowid
+
+
+def select_event_reports(cursor, event_id=None):
+    """Aggregate the metrics of each event, or of ``event_id`` only, into EventReport rows."""
+    condition, params = ("WHERE event_id = ?", (event_id,)) if event_id is not None else ("", ())
+    cursor.execute(f'''
+        SELECT event_id, COUNT(*), COUNT(receipt_id), SUM(requests), SUM(prompt_tokens), SUM(completion_tokens),
+               SUM(bytes_sent), MIN(created_at), MAX(created_at)
+        FROM metrics
+        {condition}
+        GROUP BY event_id
+        ORDER BY event_id
+    ''', params)
+    totals = cursor.fetchall()
+
+    reports = []
+    for (report_event_id, images, receipts, requests, prompt_tokens, completion_tokens, bytes_sent,
+         first_at, last_at) in totals:
+        # Latences des images envoyées à l'API, lues triées depuis idx_metrics_event_id
+        cursor.execute("SELECT latency FROM metrics WHERE event_id IS ? AND requests > 0 ORDER BY latency",
+                       (report_event_id,))
+        latencies = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''
+            SELECT model, SUM(prompt_tokens), SUM(completion_tokens) FROM metrics WHERE event_id IS ? GROUP BY model
+        ''', (report_event_id,))
+        cost = sum(model_cost(*row) for row in cursor.fetchall())
+        elapsed = last_at - first_at
+        reports.append(EventReport(report_event_id, images, receipts, requests, prompt_tokens, completion_tokens,
+                                   bytes_sent, receipts * 60 / elapsed if elapsed > 0 else None,
+                                   percentile(latencies, 0.5), percentile(latencies, 0.95), cost))
+    return reports
+
+
+def select_mode_reports(cursor):
+    """Compare the output modes: parse retries per image sent to the API and share of unread images."""
+    # Les requêtes au-delà de la première pour une image sont des renvois après une réponse illisible
+    cursor.execute('''
+        SELECT COALESCE(output_mode, 'text'), COUNT(*), SUM(requests), SUM(requests - 1),
+               SUM(CASE WHEN receipt_id IS NULL THEN 1 ELSE 0 END)
+        FROM metrics
+        WHERE requests > 0
+        GROUP BY 1
+        ORDER BY 1
+    ''')
+    return [ModeReport(output_mode, images, requests, parse_retries, parse_retries / images, failures / images)
+            for output_mode, images, requests, parse_retries, failures in cursor.fetchall()]
+
+
+def metrics_report(db_path, event_id=None):
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            return select_event_reports(conn.cursor(), event_id)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error("Error building metrics report: %s", e)
+        raise
+
+
+def mode_report(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return select_mode_reports(conn.cursor())
+    finally:
+        conn.close()
+
+
+def format_mode_report(reports):
+    lines = [f"{'Mode':>6} {'Images':>7} {'Req.':>6} {'Retries':>7} {'Retry %':>8} {'Failed %':>8}"]
+    for report in reports:
+        lines.append(f"{report.output_mode:>6} {report.images:>7} {report.requests:>6} {report.parse_retries:>7} "
+                     f"{report.retry_rate:>8.1%} {report.failure_rate:>8.1%}")
+    return "\n".join(lines)
+
+
+def format_report(reports):
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "-"
+
+    lines = [f"{'Event':>6} {'Images':>7} {'Receipts':>8} {'Req.':>5} {'Tokens in':>10} {'Tokens out':>10} "
+             f"{'MB sent':>8} {'Rec./min':>8} {'p50':>7} {'p95':>7} {'Cost $':>8}"]
+    for report in reports:
+        throughput = f"{report.receipts_per_minute:.1f}" if report.receipts_per_minute is not None else "-"
+        lines.append(f"{report.event_id!s:>6} {report.images:>7} {report.receipts:>8} {report.requests:>5} "
+                     f"{report.prompt_tokens:>10} {report.completion_tokens:>10} {report.bytes_sent / 1e6:>8.2f} "
+                     f"{throughput:>8} {seconds(report.latency_p50):>7} {seconds(report.latency_p95):>7} "
+                     f"{report.cost:>8.4f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python metrics.py [receipts.db] [event_id]
+    db_path = sys.argv[1] if len(sys.argv) > 1 else './receipts.db'
+    event_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    print(format_report(metrics_report(db_path, event_id)))
+    print()
+    print(format_mode_report(mode_report(db_path)))
@@ -1,21 +1,22 @@
 import base64
-import requests
+import hashlib
+import json
+import mmap
+import random
+import re
+import threading
 import os
 import shutil
 import time
 import logging
+from collections import namedtuple
 
-import ui
 from database import initialize_database, insert_receipt_data  # Importing the database functions
+from instrumentation import instrumented, span
 from datetime import datetime
 
-# Configuration des logs pour affichage dans la console uniquement
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levellevelname)s - %(message)s - [%(filename)s:%(lineno)d] - %(funcName)s()',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[logging.StreamHandler()]
-)
+# La configuration des logs revient au point d'entrée (ui.py, watcher.py, benchmark.py) : importer
+# ce module ne touche ni aux handlers, ni au disque, ni à une interface graphique
 
 logger = logging.getLogger(__name__)
 
@@ -28,22 +29,28 @@ def get_api_key():
             raise ValueError("OpenAI API Key not found. Please set the 'OPENAI_API_KEY' environment variable.")
         return api_key
     except Exception as e:
-        logger.error(f"Error getting API Key: {e}")
+        logger.error("Error getting API Key: %s", e)
         raise
 
 
 # Function to encode the image
+@instrumented('reader.encode')
 def encode_image(image_path):
     try:
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
     except FileNotFoundError:
-        logger.error(f"Image file not found: {image_path}")
+        logger.error("Image file not found: %s", image_path)
         raise
     except Exception as e:
-        logger.error(f"Error encoding image: {e}")
+        logger.error("Error encoding image: %s", e)
         raise
 
+# Function to encode image bytes already in memory (e.g. after preprocessing)
+@instrumented('reader.encode')
+def encode_image_data(image_data):
+    return base64.b64encode(image_data).decode('utf-8')
+
 articles_list = [
     "Alimentation",
     "Boissons",
@@ -66,57 +73,104 @@ sub_articles_list = [
     "Hygiène et Santé"
 ]
 
+# Prompt and model sent with every receipt; any change invalidates the cached responses
+MODEL = "gpt-4o"
+MAX_TOKENS = 1000
+PROMPT = (
+    "Veuillez analyser l'image du reçu joint. Lire méticuleusement le tickets joints et fournir les informations au format suivant :\n"
+    "date, fournisseur, localisation (seulement la ville)\n"
+    "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
+    "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
+    "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
+    "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
+    "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
+    "..., ..., ..., ..., ..., ...\n"
+    "INSTRUCTION IMPORTANTE:\n"
+    "Veille à fournir les informations demandées et seulement ces informations\n"
+    "Pour les famille et les sous famille priorise avant tous les listes suivantes:\n"
+    "Pour les famille d'article, utilise les informations ci-dessous:\n"
+    "L'article, ses quantité, son prix unitaire et total se trouve strictement sur la même ligne"
+    "Ne pas arrondir, ni les quantité, ni les montants"
+    "SI la colonne du prix unitaire est HT, ALORS calculer le prix TTC en ajoutant le pourcentage de TVA indiqué"
+    "SI la ligne se nomme total, ALORS ne pas la prendre en compte"
+    "SI les quantité correspondent à la ligne 'Total' ALORS ne pas tenir compte de cette quantité"
+    f"{articles_list}\n"
+    f"Et pour les sous-famille les informations ci-dessous:\n"
+    f"{sub_articles_list}"
+    f"SI L'IMAGE n'est pas un ticket de caisse ou une facture répondre 'NO RECEIPT PROVIDED'\n"
+    f"SI c'est du Gaz, de l'essence, de l'électricité, du bois, ou tout autre carburant, ALORS la famille est Energie\n"
+    "SI c'est quelque chose qui se mange ou qui se boit pour un être vivant, ALORS la famille est Alimentation\n"
+    "SI ce n'est pas quelque chose qui se mange, ALORS c'est soit une Fourniture, soit de la logistique\n"
+    "Fait des recherches sur le web pour t'assurer que tu as bien définit les familles et sous familles\n"
+    "EXEMPLE DE SORTIE ATTENDUE N°1:\n"
+    "31/08/2023, Intermarché, Foix\n"
+    "ALIMENTATION\n"
+    "Alimentation, snacking, Vico Chips Class.Nat, 3.56, 1, 3.56\n"
+    "Alimentation, crèmerie, Pat. Emmental Rape 3, 3.01, 1, 3.01\n"
+    "Alimentation, crèmerie, Pat Beurre Moule DX, 4.63, 1, 4.63"
+    "EXEMPLE DE SORTIE ATTENDUE N°2:\n"
+    "31/08/2023, Intermarché, Foix\n"
+    "Fournitures, équipement, Tente de spectacle, 437, 1, 427\n"
+    "Energie, carburant, Essence au litre, 1,72, 40, 68.80\n"
+    "Alimentation, charcuterie, Paté de campagne, 4.63, 1, 4.63"
+)
+
+# Output mode: 'json' asks for a strict JSON schema, 'text' for the line format of the prompt.
+# The line parser stays the fallback of the JSON mode.
+OUTPUT_MODE = os.getenv('RECEIPT_OUTPUT_MODE', 'json')
+RECEIPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "date": {"type": "string", "description": "Date du ticket au format JJ/MM/AAAA"},
+        "fournisseur": {"type": "string"},
+        "localisation": {"type": "string", "description": "Ville seulement"},
+        "articles": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "famille": {"type": "string"},
+                    "sous_famille": {"type": "string"},
+                    "nom": {"type": "string"},
+                    "prix_unitaire": {"type": "number"},
+                    "quantite": {"type": "number"},
+                    "prix_total": {"type": "number"}
+                },
+                "required": ["famille", "sous_famille", "nom", "prix_unitaire", "quantite", "prix_total"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["date", "fournisseur", "localisation", "articles"],
+    "additionalProperties": False
+}
+JSON_INSTRUCTIONS = (
+    "\nFORMAT DE SORTIE JSON:\n"
+    "Répondre uniquement par un objet JSON conforme au schéma fourni, avec les mêmes informations que ci-dessus: "
+    "date (JJ/MM/AAAA), fournisseur, localisation et la liste des articles. "
+    "Les montants et quantités sont des nombres avec un point décimal."
+)
+
+_version_source = f"{MODEL}\n{MAX_TOKENS}\n{PROMPT}"
+if OUTPUT_MODE == 'json':
+    _version_source += f"\n{JSON_INSTRUCTIONS}\n{json.dumps(RECEIPT_SCHEMA, sort_keys=True)}"
+PAYLOAD_VERSION = hashlib.sha256(_version_source.encode('utf-8')).hexdigest()[:16]
+
+
 # Function to create the payload
-def create_payload(base64_image):
+@instrumented('reader.payload')
+def create_payload(base64_image, output_mode=None):
+    output_mode = output_mode or OUTPUT_MODE
     try:
-        prompt = (
-            "Veuillez analyser l'image du reçu joint. Lire méticuleusement le tickets joints et fournir les informations au format suivant :\n"
-            "date, fournisseur, localisation (seulement la ville)\n"
-            "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
-            "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
-            "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
-            "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
-            "famille, sous_famille, article, prix unitaire, quantité, prix total\n"
-            "..., ..., ..., ..., ..., ...\n"
-            "INSTRUCTION IMPORTANTE:\n"
-            "Veille à fournir les informations demandées et seulement ces informations\n"
-            "Pour les famille et les sous famille priorise avant tous les listes suivantes:\n"
-            "Pour les famille d'article, utilise les informations ci-dessous:\n"
-            "L'article, ses quantité, son prix unitaire et total se trouve strictement sur la même ligne"
-            "Ne pas arrondir, ni les quantité, ni les montants"
-            "SI la colonne du prix unitaire est HT, ALORS calculer le prix TTC en ajoutant le pourcentage de TVA indiqué"
-            "SI la ligne se nomme total, ALORS ne pas la prendre en compte"
-            "SI les quantité correspondent à la ligne 'Total' ALORS ne pas tenir compte de cette quantité"
-            f"{articles_list}\n"
-            f"Et pour les sous-famille les informations ci-dessous:\n"
-            f"{sub_articles_list}"
-            f"SI L'IMAGE n'est pas un ticket de caisse ou une facture répondre 'NO RECEIPT PROVIDED'\n"
-            f"SI c'est du Gaz, de l'essence, de l'électricité, du bois, ou tout autre carburant, ALORS la famille est Energie\n"
-            "SI c'est quelque chose qui se mange ou qui se boit pour un être vivant, ALORS la famille est Alimentation\n"
-            "SI ce n'est pas quelque chose qui se mange, ALORS c'est soit une Fourniture, soit de la logistique\n"
-            "Fait des recherches sur le web pour t'assurer que tu as bien définit les familles et sous familles\n"
-            "EXEMPLE DE SORTIE ATTENDUE N°1:\n"
-            "31/08/2023, Intermarché, Foix\n"
-            "ALIMENTATION\n"
-            "Alimentation, snacking, Vico Chips Class.Nat, 3.56, 1, 3.56\n"
-            "Alimentation, crèmerie, Pat. Emmental Rape 3, 3.01, 1, 3.01\n"
-            "Alimentation, crèmerie, Pat Beurre Moule DX, 4.63, 1, 4.63"
-            "EXEMPLE DE SORTIE ATTENDUE N°2:\n"
-            "31/08/2023, Intermarché, Foix\n"
-            "Fournitures, équipement, Tente de spectacle, 437, 1, 427\n"
-            "Energie, carburant, Essence au litre, 1,72, 40, 68.80\n"
-            "Alimentation, charcuterie, Paté de campagne, 4.63, 1, 4.63"
-        )
-
-        return {
-            "model": "gpt-4o",
+        payload = {
+            "model": MODEL,
             "messages": [
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": prompt
+                            "text": PROMPT + JSON_INSTRUCTIONS if output_mode == 'json' else PROMPT
                         },
                         {
                             "type": "image_url",
@@ -127,33 +181,278 @@ def create_payload(base64_image):
                     ]
                 }
             ],
-            "max_tokens": 1000
+            "max_tokens": MAX_TOKENS
         }
+        if output_mode == 'json':
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "receipt", "strict": True, "schema": RECEIPT_SCHEMA}
+            }
+        return payload
     except Exception as e:
-        logger.error(f"Error creating payload: {e}")
+        logger.error("Error creating payload: %s", e)
         raise
 
 
-# Function to send the request to the OpenAI API
-def send_request(api_key, payload):
-    try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+# Batch mode: several receipts sent in one request so that the prompt is paid once per batch
+BATCH_SIZE = int(os.getenv('RECEIPT_BATCH_SIZE', '1'))  # 1 désactive le mode lot
+BATCH_MAX_OUTPUT_TOKENS = 16384   # Limite de sortie du modèle, MAX_TOKENS étant réservé par ticket
+BATCH_MAX_INPUT_TOKENS = 100000
+IMAGE_TOKENS = 1105               # Coût maximal d'une image en détail 'high' (6 tuiles de 512px)
+RECEIPT_DELIMITER = "### TICKET {} ###"
+RECEIPT_DELIMITER_PATTERN = re.compile(r"^\s*#{3}\s*TICKET\s+(\d+)\s*#{3}\s*$", re.MULTILINE)
+BATCH_INSTRUCTIONS = (
+    "\nPLUSIEURS TICKETS:\n"
+    "Les {count} images jointes sont des tickets distincts, chacune précédée de son numéro.\n"
+    "Pour chaque ticket, dans l'ordre, écrire d'abord la ligne '### TICKET N ###' (N étant son numéro), "
+    "puis ses informations au format ci-dessus.\n"
+    "Ne jamais mélanger les articles de deux tickets."
+)
 
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
 
-        if response.status_code != 200:
-            raise Exception(f"Request failed: {response.status_code} {response.text}")
+# Les réponses d'un lot dépendent aussi de ses consignes et de son découpage : clé de cache distincte
+def batch_payload_version():
+    source = f"{MODEL}\n{MAX_TOKENS}\n{PROMPT}\n{BATCH_INSTRUCTIONS}\n{RECEIPT_DELIMITER}"
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+BATCH_PAYLOAD_VERSION = batch_payload_version()
+
+
+# Number of receipts that fit in one batch request, given the token limits
+def batch_capacity(batch_size=BATCH_SIZE):
+    by_output = BATCH_MAX_OUTPUT_TOKENS // MAX_TOKENS
+    by_input = BATCH_MAX_INPUT_TOKENS // IMAGE_TOKENS
+    return max(1, min(batch_size, by_output, by_input))
 
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending request: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"General error: {e}")
-        raise
+
+# Function to create the payload of a batch: one delimiter and one image per receipt
+@instrumented('reader.payload')
+def create_batch_payload(base64_images):
+    content = [{"type": "text", "text": PROMPT + BATCH_INSTRUCTIONS.format(count=len(base64_images))}]
+    for index, base64_image in enumerate(base64_images, start=1):
+        content.append({"type": "text", "text": RECEIPT_DELIMITER.format(index)})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}})
+    return {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": min(BATCH_MAX_OUTPUT_TOKENS, MAX_TOKENS * len(base64_images))
+    }
+
+
+# Function to split a batch answer into one single-receipt response per image (None if missing)
+@instrumented('reader.split_batch')
+def split_batch_response(response, count):
+    try:
+        output = response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        logger.warning("No relevant content found in the batch response.")
+        return [None] * count
+
+    matches = list(RECEIPT_DELIMITER_PATTERN.finditer(output))
+    sections = {}
+    for position, match in enumerate(matches):
+        end = matches[position + 1].start() if position + 1 < len(matches) else len(output)
+        sections.setdefault(int(match.group(1)), output[match.end():end].strip())
+
+    responses = []
+    for index in range(1, count + 1):
+        if index in sections:
+            responses.append({"choices": [{"message": {"content": sections[index]}}]})
+        else:
+            logger.warning("Receipt %s missing from the batch response.", index)
+            responses.append(None)
+    return responses
+
+
+# Images at least this large are streamed from a memory map instead of being encoded in memory
+STREAMING_THRESHOLD = 2 * 1024 * 1024
+# Multiple of 3 so that each chunk encodes to base64 without padding
+ENCODE_CHUNK_SIZE = 3 * 16 * 1024
+IMAGE_PLACEHOLDER = "__IMAGE_BASE64__"
+
+
+class StreamingPayload:
+    """JSON request body that base64-encodes the image chunk by chunk while it is sent.
+
+    ``image`` is any buffer (bytes or a memory map). Only one encoded chunk is
+    held in memory at a time, and ``len()`` gives requests the exact
+    Content-Length without building the body.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._file = None
+        head, tail = json.dumps(create_payload(IMAGE_PLACEHOLDER)).encode('utf-8').split(IMAGE_PLACEHOLDER.encode('utf-8'))
+        self._head = head
+        self._tail = tail
+        self._length = len(head) + 4 * ((len(image) + 2) // 3) + len(tail)
+        self.seek(0)
+
+    @classmethod
+    def from_file(cls, image_path):
+        image_file = open(image_path, "rb")
+        try:
+            payload = cls(mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ))
+        except Exception:
+            image_file.close()
+            raise
+        payload._file = image_file
+        return payload
+
+    def _chunks(self):
+        yield self._head
+        for start in range(0, len(self.image), ENCODE_CHUNK_SIZE):
+            yield base64.b64encode(self.image[start:start + ENCODE_CHUNK_SIZE])
+        yield self._tail
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        # Seul le retour au début est nécessaire pour renvoyer la requête
+        if offset != 0 or whence != 0:
+            raise ValueError("StreamingPayload can only be rewound to the start")
+        self._position = 0
+        self._pending = self._chunks()
+        self._buffer = bytearray()
+        return 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        while len(self._buffer) < size:
+            chunk = next(self._pending, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(ENCODE_CHUNK_SIZE), b"")
+
+    def close(self):
+        if self._file is not None:
+            self.image.close()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# HTTP settings: one pooled keep-alive session shared by every request
+API_URL = os.getenv('RECEIPT_API_URL', "https://api.openai.com/v1/chat/completions")
+CONNECT_TIMEOUT = 10   # secondes
+READ_TIMEOUT = 120     # secondes, l'analyse d'un ticket peut être longue
+POOL_SIZE = 16         # Connexions gardées ouvertes, au moins le nombre de workers
+MAX_RETRIES = 4
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0     # secondes
+BACKOFF_MAX = 30.0     # secondes
+PARSE_RETRIES = 1      # Nouvel envoi du même payload si la réponse est illisible
+
+# Mesures d'un appel réussi à l'API: retries est le nombre de tentatives HTTP refaites
+RequestMetrics = namedtuple('RequestMetrics', ['model', 'prompt_tokens', 'completion_tokens', 'latency', 'retries'])
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# Function to get the shared HTTP session, created on first use. requests is imported here
+# rather than at module level: it is most of the import time of this module.
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+# Exponential backoff with full jitter, unless the server says how long to wait
+def backoff_delay(attempt, response=None):
+    if response is not None:
+        try:
+            return min(BACKOFF_MAX, float(response.headers.get("Retry-After")))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _request_metrics(response_json, latency, retries):
+    usage = response_json.get("usage") or {}
+    return RequestMetrics(response_json.get("model", MODEL), usage.get("prompt_tokens", 0),
+                          usage.get("completion_tokens", 0), latency, retries)
+
+
+# Function to send the request to the OpenAI API, retrying on 429/5xx and network errors.
+# When a metrics list is given, a RequestMetrics is appended to it for the successful call.
+def send_request(api_key, payload, metrics=None):
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    session = get_session()
+    import requests
+
+    for attempt in range(MAX_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            with span('reader.http'):
+                if isinstance(payload, StreamingPayload):
+                    payload.seek(0)
+                    response = session.post(API_URL, headers=headers, data=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+                else:
+                    response = session.post(API_URL, headers=headers, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                logger.error("Error sending request after %s attempts: %s", attempt + 1, e)
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning("Error sending request: %s. Retrying in %.1fs", e, delay)
+            with span('reader.backoff'):
+                time.sleep(delay)
+            continue
+        except requests.exceptions.RequestException as e:
+            logger.error("Error sending request: %s", e)
+            raise
+
+        if response.status_code == 200:
+            response_json = response.json()
+            if metrics is not None:
+                metrics.append(_request_metrics(response_json, time.monotonic() - started, attempt))
+            return response_json
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+            delay = backoff_delay(attempt, response)
+            logger.warning("Request failed with status %s. Retrying in %.1fs", response.status_code, delay)
+            with span('reader.backoff'):
+                time.sleep(delay)
+            continue
+
+        logger.error("Request failed: %s %s", response.status_code, response.text)
+        raise Exception(f"Request failed: {response.status_code} {response.text}")
 
 
 def parse_response(response):
@@ -175,7 +474,7 @@ def parse_response(response):
             try:
                 date = datetime.strptime(date_str, "%d/%m/%Y").date()
             except ValueError as e:
-                logger.error(f"Error parsing date: {e}")
+                logger.error("Error parsing date: %s", e)
                 return None, True  # Indiquer que le format est incorrect
 
             fournisseur = date_fournisseur_localisation[1].strip()
@@ -190,7 +489,7 @@ def parse_response(response):
 
                 article_parts = article.split(",")
                 if len(article_parts) < 6:
-                    logger.warning(f"Unexpected response format: Not enough elements in article '{article}'.")
+                    logger.warning("Unexpected response format: Not enough elements in article '%s'.", article)
                     return None, True  # Indiquer que le format est incorrect
 
                 try:
@@ -203,7 +502,7 @@ def parse_response(response):
                         "prix_total": float(article_parts[5].strip())
                     })
                 except ValueError as e:
-                    logger.error(f"Error parsing article data: {e}")
+                    logger.error("Error parsing article data: %s", e)
                     return None, True  # Indiquer que le format est incorrect
 
             return {
@@ -216,56 +515,256 @@ def parse_response(response):
             logger.warning("No relevant content found in the response.")
             return None, True  # Indiquer que le format est incorrect
     except Exception as e:
-        logger.error(f"Error parsing response: {e}")
+        logger.error("Error parsing response: %s", e)
         return None, True  # Indiquer que le format est incorrect
 
 
-# Function to process a single image
-def process_image(image_path, destination_folder, api_key, db_path, event_id, retry=False):
+def _check_number(value, field):
+    # bool est un int en Python : refusé explicitement
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value or value in (float('inf'), float('-inf')):
+        raise ValueError(f"'{field}' must be a finite number, got {value!r}")
+    return float(value)
+
+
+def _check_string(value, field):
+    if not isinstance(value, str):
+        raise ValueError(f"'{field}' must be a string, got {value!r}")
+    return value.strip()
+
+
+def _check_keys(data, properties, where):
+    if not isinstance(data, dict):
+        raise ValueError(f"{where} must be an object")
+    missing = [key for key in properties["required"] if key not in data]
+    extra = [key for key in data if key not in properties["properties"]]
+    if missing or extra:
+        raise ValueError(f"{where} has missing keys {missing} or unexpected keys {extra}")
+
+
+# Function to validate a receipt decoded from JSON against RECEIPT_SCHEMA; raises ValueError
+def validate_receipt_json(data):
+    _check_keys(data, RECEIPT_SCHEMA, "receipt")
+    try:
+        receipt_date = datetime.strptime(_check_string(data["date"], "date"), "%d/%m/%Y").date()
+    except ValueError as e:
+        raise ValueError(f"Invalid date {data['date']!r}: {e}")
+    if not isinstance(data["articles"], list):
+        raise ValueError("'articles' must be a list")
+
+    article_schema = RECEIPT_SCHEMA["properties"]["articles"]["items"]
+    articles = []
+    for position, article in enumerate(data["articles"]):
+        _check_keys(article, article_schema, f"article {position}")
+        articles.append({
+            "famille": _check_string(article["famille"], "famille"),
+            "sous_famille": _check_string(article["sous_famille"], "sous_famille"),
+            "nom": _check_string(article["nom"], "nom"),
+            "prix_unitaire": _check_number(article["prix_unitaire"], "prix_unitaire"),
+            "quantite": _check_number(article["quantite"], "quantite"),
+            "prix_total": _check_number(article["prix_total"], "prix_total")
+        })
+    return {
+        "date": receipt_date,
+        "fournisseur": _check_string(data["fournisseur"], "fournisseur"),
+        "localisation": _check_string(data["localisation"], "localisation"),
+        "articles": articles
+    }
+
+
+def parse_json_response(response):
     try:
-        logger.info(f"Processing image: {image_path}")
-        base64_image = encode_image(image_path)
-        payload = create_payload(base64_image)
-        response = send_request(api_key, payload)
+        output = response["choices"][0]["message"]["content"]
+        return validate_receipt_json(json.loads(output)), False
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        logger.warning("Structured response rejected: %s", e)
+        return None, True
+
+
+# Function to parse a completion in the given output mode; a JSON answer that does not
+# validate is tried again with the line parser, the model sometimes ignoring the schema
+@instrumented('reader.parse')
+def parse_completion(response, output_mode=None):
+    if (output_mode or OUTPUT_MODE) == 'json':
+        parsed_data, parse_error = parse_json_response(response)
+        if parsed_data:
+            return parsed_data, parse_error
+        logger.info("Falling back to the line parser")
+    return parse_response(response)
+
 
-        parsed_data, parse_error = parse_response(response)
+def _should_stream(image_path):
+    try:
+        return os.path.getsize(image_path) >= STREAMING_THRESHOLD
+    except OSError:
+        return False
+
+
+def _send_and_parse(image_path, api_key, image_data, build_payload, cache, metrics=None):
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(image_data, PAYLOAD_VERSION)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logger.info("Cache hit for image %s, skipping API call", os.path.basename(image_path))
+            return cached.parsed_data
+
+    # Le payload est construit une seule fois, même si la réponse doit être redemandée
+    payload = build_payload()
+    for attempt in range(PARSE_RETRIES + 1):
+        response = send_request(api_key, payload, metrics=metrics)
+        parsed_data, parse_error = parse_completion(response)
         if parsed_data:
-            # Afficher les informations avant l'insertion
-            print(f"Date: {parsed_data['date']}, Fournisseur: {parsed_data['fournisseur']}, Localisation: {parsed_data['localisation']}")
-            for article in parsed_data["articles"]:
-                print(f"Famille: {article['famille']}, Sous Famille: {article['sous_famille']}, Nom: {article['nom']}, Prix unitaire: {article['prix_unitaire']}, Quantité: {article['quantite']}, Prix total: {article['prix_total']}")
+            break
+        if attempt < PARSE_RETRIES:
+            logger.warning("Data parsing incomplete or error encountered. Retrying...")
 
-            # Insérer les données dans la base de données
-            insert_receipt_data(db_path, parsed_data, event_id)
+    if parsed_data and cache_key is not None:
+        cache.put(cache_key, response, parsed_data)
+    return parsed_data
 
-            # Déplacer l'image traitée dans le dossier de destination
-            try:
-                shutil.move(image_path, os.path.join(destination_folder, os.path.basename(image_path)))
-                logger.info(f"Moved processed image to: {destination_folder}")
-            except FileNotFoundError as e:
-                logger.error(f"Error moving file: {e}")
-            except Exception as e:
-                logger.error(f"Unexpected error moving file: {e}")
-        else:
-            if not retry:
-                logger.warning("Data parsing incomplete or error encountered. Retrying...")
-                process_image(image_path, destination_folder, api_key, db_path, event_id, retry=True)
-            else:
-                logger.error("Parsed data is empty or incorrect after retry. Skipping this image.")
-                ui.messagebox.showwarning("Warning", "Les données extraites sont incorrectes après réessai. Image ignorée.")
+
+# Function to read a single image: encode it, send it to the API and parse the answer.
+# With a ResponseCache, an image already read with the same prompt never reaches the network.
+# Large files are memory-mapped and encoded while being sent rather than copied in memory.
+# The RequestMetrics of every API call made are appended to the optional metrics list.
+def read_receipt(image_path, api_key, image_data=None, cache=None, metrics=None):
+    if image_data is None and _should_stream(image_path):
+        with StreamingPayload.from_file(image_path) as payload:
+            return _send_and_parse(image_path, api_key, payload.image, lambda: payload, cache, metrics)
+
+    if image_data is None and cache is not None:
+        with open(image_path, "rb") as image_file:
+            image_data = image_file.read()
+
+    if image_data is not None:
+        return _send_and_parse(image_path, api_key, image_data,
+                               lambda: create_payload(encode_image_data(image_data)), cache, metrics)
+    return _send_and_parse(image_path, api_key, None, lambda: create_payload(encode_image(image_path)), None, metrics)
+
+
+def _is_truncated(response):
+    try:
+        return response["choices"][0].get("finish_reason") == "length"
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return False
+
+
+def _share_metrics(request_metrics, count):
+    # Les tokens d'un lot sont répartis entre ses tickets, le reste allant au premier
+    shares = []
+    for index in range(count):
+        shares.append(request_metrics._replace(
+            prompt_tokens=request_metrics.prompt_tokens // count + (request_metrics.prompt_tokens % count if index == 0 else 0),
+            completion_tokens=request_metrics.completion_tokens // count + (request_metrics.completion_tokens % count if index == 0 else 0)))
+    return shares
+
+
+def _read_batch(image_paths, api_key, images_data, cache, metrics):
+    batch_metrics = []
+    response = send_request(api_key, create_batch_payload([encode_image_data(data) for data in images_data]), metrics=batch_metrics)
+    for request_metrics in batch_metrics:
+        for image_metrics, share in zip(metrics, _share_metrics(request_metrics, len(images_data))):
+            image_metrics.append(share)
+    # Réponse coupée par la limite de tokens : le lot est coupé en deux et redemandé
+    if len(images_data) > 1 and _is_truncated(response):
+        half = len(images_data) // 2
+        logger.warning("Batch answer truncated, splitting %s receipts in two requests", len(images_data))
+        return (_read_batch(image_paths[:half], api_key, images_data[:half], cache, metrics[:half])
+                + _read_batch(image_paths[half:], api_key, images_data[half:], cache, metrics[half:]))
+
+    results = []
+    for image_path, image_data, section in zip(image_paths, images_data, split_batch_response(response, len(images_data))):
+        parsed_data = parse_response(section)[0] if section is not None else None
+        if parsed_data and cache is not None:
+            cache.put(cache.make_key(image_data, BATCH_PAYLOAD_VERSION), section, parsed_data)
+        results.append(parsed_data)
+    return results
+
+
+# Function to read several images with a single request. Returns the parsed data of each
+# image, in order, or None for those whose part of the answer could not be parsed; the caller
+# falls back to read_receipt for them. Files too large to be held in memory are left to it too.
+# metrics is an optional list holding one list per image, receiving its share of each batch call.
+def read_receipts(image_paths, api_key, images_data=None, cache=None, metrics=None):
+    image_paths = list(image_paths)
+    images_data = list(images_data) if images_data is not None else [None] * len(image_paths)
+    metrics = metrics if metrics is not None else [[] for image_path in image_paths]
+    results = [None] * len(image_paths)
+
+    pending = []
+    for index, (image_path, image_data) in enumerate(zip(image_paths, images_data)):
+        if image_data is None:
+            if _should_stream(image_path):
+                continue
+            with open(image_path, "rb") as image_file:
+                image_data = image_file.read()
+        if cache is not None:
+            # Une lecture en lot ou à l'unité faite avec les consignes actuelles fait foi
+            cached = (cache.get(cache.make_key(image_data, BATCH_PAYLOAD_VERSION))
+                      or cache.get(cache.make_key(image_data, PAYLOAD_VERSION)))
+            if cached is not None:
+                logger.info("Cache hit for image %s, skipping API call", os.path.basename(image_path))
+                results[index] = cached.parsed_data
+                continue
+        pending.append((index, image_path, image_data))
+
+    capacity = batch_capacity(max(1, len(pending)))
+    for start in range(0, len(pending), capacity):
+        chunk = pending[start:start + capacity]
+        parsed = _read_batch([item[1] for item in chunk], api_key, [item[2] for item in chunk], cache,
+                             [metrics[item[0]] for item in chunk])
+        for (index, image_path, image_data), parsed_data in zip(chunk, parsed):
+            results[index] = parsed_data
+    return results
+
+
+# Function to store the parsed data of a receipt and archive its image. Returns the receipt id,
+# or None when the insert failed: the image is then left where it is
+def store_receipt(image_path, parsed_data, destination_folder, db_path, event_id):
+    # Insérer les données dans la base de données (le ticket est journalisé en DEBUG par database)
+    with span('reader.store'):
+        receipt_id = insert_receipt_data(db_path, parsed_data, event_id)
+
+    if receipt_id is not None:
+        archive_image(image_path, destination_folder)
+    return receipt_id
+
+
+# Function to move a processed image to the destination folder
+@instrumented('reader.archive')
+def archive_image(image_path, destination_folder):
+    try:
+        shutil.move(image_path, os.path.join(destination_folder, os.path.basename(image_path)))
+        logger.info("Moved processed image to: %s", destination_folder)
+    except FileNotFoundError as e:
+        logger.error("Error moving file: %s", e)
     except Exception as e:
-        logger.error(f"Error processing image {os.path.basename(image_path)}: {e}")
-        if not retry:
-            logger.info("Retrying the process for the image.")
-            process_image(image_path, destination_folder, api_key, db_path, event_id, retry=True)
+        logger.error("Unexpected error moving file: %s", e)
+
+
+# Function to process a single image. Returns True when the receipt was stored; problems are
+# reported through the optional notify(title, message) callback instead of a dialog.
+def process_image(image_path, destination_folder, api_key, db_path, event_id, cache=None, notify=None):
+    try:
+        logger.info("Processing image: %s", image_path)
+        parsed_data = read_receipt(image_path, api_key, cache=cache)
+        if not parsed_data:
+            logger.error("Parsed data is empty or incorrect after retry. Skipping this image.")
+            if notify is not None:
+                notify("Warning", "Les données extraites sont incorrectes après réessai. Image ignorée.")
+        elif store_receipt(image_path, parsed_data, destination_folder, db_path, event_id) is not None:
+            return True
         else:
-            logger.error(f"Failed after retrying. Skipping image {os.path.basename(image_path)}")
-            ui.messagebox.showwarning("Warning", f"Erreur dans le traitement de l'image {os.path.basename(image_path)} après réessai. Image ignorée.")
+            logger.error("Receipt of %s could not be stored, image left in place", os.path.basename(image_path))
+            if notify is not None:
+                notify("Warning", f"Le ticket {os.path.basename(image_path)} n'a pas pu être enregistré. Image ignorée.")
+    except Exception as e:
+        logger.error("Failed after retrying. Skipping image %s: %s", os.path.basename(image_path), e)
+        if notify is not None:
+            notify("Warning", f"Erreur dans le traitement de l'image {os.path.basename(image_path)} après réessai. Image ignorée.")
+    return False
 
 
-# Path to your source and destination folders
+# Path to your source and destination folders, created by the entry points that use them
 source_folder = "./receipt_queue"
 destination_folder = "./receipt_processed"
-
-# Ensure the destination folder exists
-os.makedirs(destination_folder, exist_ok=True)
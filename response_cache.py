@@ -0,0 +1,113 @@
+# response_cache.py
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import date
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Réglages par défaut du cache des réponses de l'API
+CACHE_PATH = './response_cache.db'
+MAX_ENTRIES = 10000
+MAX_AGE = 90 * 24 * 3600  # secondes
+EVICT_EVERY = 100         # Nombre d'écritures entre deux passes d'éviction
+
+CachedResponse = namedtuple('CachedResponse', ['completion', 'parsed_data'])
+
+
+def _encode_parsed(parsed_data):
+    return json.dumps(parsed_data, default=lambda value: value.isoformat(), ensure_ascii=False)
+
+def _decode_parsed(text):
+    parsed_data = json.loads(text)
+    try:
+        parsed_data['date'] = date.fromisoformat(parsed_data['date'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return parsed_data
+
+
+class ResponseCache:
+    """SQLite-backed cache of API responses, keyed on the image content and the payload version.
+
+    Entries older than ``max_age`` seconds are ignored and purged; beyond
+    ``max_entries`` the least recently used entries are evicted.
+    """
+
+    def __init__(self, db_path=CACHE_PATH, max_entries=MAX_ENTRIES, max_age=MAX_AGE):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                completion TEXT,
+                parsed_data TEXT,
+                created_at REAL,
+                last_used REAL
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(image_data, version):
+        digest = hashlib.sha256(image_data).hexdigest()
+        return f"{version}:{digest}"
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT completion, parsed_data FROM responses WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return CachedResponse(json.loads(row[0]), _decode_parsed(row[1]))
+
+    def put(self, key, completion, parsed_data):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('''
+                INSERT OR REPLACE INTO responses (key, completion, parsed_data, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (key, json.dumps(completion, ensure_ascii=False), _encode_parsed(parsed_data), now, now))
+            self._conn.commit()
+            self._puts += 1
+            evict = self._puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            expired = self._conn.execute("DELETE FROM responses WHERE created_at < ?",
+                                         (time.time() - self.max_age,)).rowcount
+            overflow = self._conn.execute('''
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,)).rowcount
+            self._conn.commit()
+        if expired or overflow:
+            logger.info("Response cache evicted %s expired and %s least recently used entries", expired, overflow)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import date
+
+import analytics
+from database import ReceiptDatabase
+
+
+def _article(famille, sous_famille, prix_total):
+    return {'famille': famille, 'sous_famille': sous_famille, 'nom': 'Article', 'prix_unitaire': prix_total,
+            'quantite': 1, 'prix_total': prix_total}
+
+
+class TestSpendingRollup(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.db = ReceiptDatabase(self.db_path)
+        self.db.insert_event('Event A', '2024-01-01')
+        self.db.insert_event('Event B', '2024-02-01')
+        self.db.insert_receipt_data({'date': date(2024, 1, 5), 'fournisseur': 'Intermarché', 'localisation': 'Foix', 'articles': [
+            _article('Alimentation', 'Snacking', 3.5), _article('Alimentation', 'Snacking', 1.5),
+            _article('Boissons', 'Soda', 2.0)]}, 1)
+        self.db.insert_receipts_bulk([
+            {'date': date(2024, 2, 10), 'fournisseur': 'Carrefour', 'localisation': 'Pamiers', 'articles': [
+                _article('Alimentation', 'Frais', 10.0), _article(None, None, 4.0)]},
+        ], 2)
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def _adhoc(self, dimensions):
+        # Ventilation de référence calculée directement sur les articles
+        keys = {
+            'event_id': 'r.event_id', 'month': "strftime('%Y-%m', r.date)", 'famille': "COALESCE(fa.name, '')",
+            'sous_famille': "COALESCE(sf.name, '')", 'fournisseur': 'fo.name',
+        }
+        columns = ', '.join(keys[name] for name in dimensions)
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(f'''
+            SELECT {columns}, SUM(a.prix_total), COUNT(*)
+            FROM articles a JOIN receipts r ON r.id = a.receipt_id
+            LEFT JOIN dim_famille fa ON fa.id = a.famille_id
+            LEFT JOIN dim_sous_famille sf ON sf.id = a.sous_famille_id
+            LEFT JOIN dim_fournisseur fo ON fo.id = r.fournisseur_id
+            GROUP BY {columns}
+        ''').fetchall()
+        conn.close()
+        return {tuple(row[:-2]): (row[-2], row[-1]) for row in rows}
+
+    def _assert_matches_adhoc(self):
+        for dimensions in (['famille'], ['famille', 'sous_famille'], ['fournisseur', 'month'], list(analytics.DIMENSIONS)):
+            breakdown = {row.key: (row.total, row.article_count) for row in self.db.spending_breakdown(dimensions)}
+            self.assertEqual(breakdown, self._adhoc(dimensions), dimensions)
+        self.assertEqual(self.db.reader().execute("SELECT COUNT(*) FROM spending_rollup WHERE article_count <= 0").fetchone()[0], 0)
+
+    def test_breakdown_follows_inserts_updates_and_deletes(self):
+        self._assert_matches_adhoc()
+
+        with self.db.writer() as cursor:
+            cursor.execute("UPDATE articles SET famille_id = (SELECT id FROM dim_famille WHERE name = 'Boissons'), prix_total = 6 WHERE id = 1")
+            cursor.execute("DELETE FROM articles WHERE id = 3")
+            cursor.execute("UPDATE receipts SET event_id = 2, date = '2024-03-01' WHERE id = 1")
+        self._assert_matches_adhoc()
+
+        with self.db.writer() as cursor:
+            cursor.execute("DELETE FROM receipts WHERE id = 2")
+            cursor.execute("DELETE FROM articles WHERE receipt_id = 2")
+        self.assertEqual({row.key for row in self.db.spending_breakdown(['fournisseur'])}, {('Intermarché',)})
+        self.assertEqual(analytics.find_rollup_mismatches(self.db.reader().cursor()), [])
+
+    def test_breakdown_filters(self):
+        self.assertEqual(self.db.spending_breakdown(['famille'], event_ids=[1]),
+                         [analytics.SpendingRow(('Alimentation',), 5.0, 2), analytics.SpendingRow(('Boissons',), 2.0, 1)])
+        self.assertEqual(self.db.spending_breakdown([], start_month='2024-02', end_month='2024-02'),
+                         [analytics.SpendingRow((), 14.0, 2)])
+        self.assertEqual(analytics.spending_breakdown(self.db_path, ['sous_famille'], filters={'famille': 'Alimentation'}),
+                         [analytics.SpendingRow(('Frais',), 10.0, 1), analytics.SpendingRow(('Snacking',), 5.0, 2)])
+        with self.assertRaises(ValueError):
+            self.db.spending_breakdown(['nom'])
+
+    def test_breakdown_does_not_read_articles(self):
+        conn = sqlite3.connect(self.db_path)
+        statements = []
+        conn.set_trace_callback(statements.append)
+        analytics.select_breakdown(conn.cursor(), ['famille'], event_ids=[1, 2])
+        conn.set_trace_callback(None)
+
+        plan = ' '.join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statements[0]))
+        conn.close()
+        self.assertIn('spending_rollup', plan)
+        self.assertNotIn('articles', plan)
+        self.assertNotIn('receipts', plan)
+
+    def test_rebuild_rollup_repairs_drift(self):
+        with self.db.writer() as cursor:
+            cursor.execute("UPDATE spending_rollup SET total = 0")
+        self.assertEqual(len(analytics.find_rollup_mismatches(self.db.reader().cursor())), 4)
+
+        analytics.rebuild_rollup(self.db_path)
+        self.assertEqual(analytics.find_rollup_mismatches(self.db.reader().cursor()), [])
+        self._assert_matches_adhoc()
+
+if __name__ == "__main__":
+    unittest.main()
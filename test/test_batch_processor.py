@@ -0,0 +1,107 @@
+import unittest
+from unittest.mock import patch, MagicMock, ANY
+import threading
+import time
+import batch_processor
+import image_preprocessing
+
+
+class TestBatchProcessor(unittest.TestCase):
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_process_images_yields_results_in_order(self, mock_read_receipt, mock_archive_image):
+        def slow_first(image_path, api_key, image_data=None, cache=None, metrics=None):
+            # The first image finishes last to check that results are reordered
+            if image_path == "a.jpg":
+                time.sleep(0.1)
+            return {"image": image_path}
+        mock_read_receipt.side_effect = slow_first
+
+        writer_threads = set()
+        mock_database = MagicMock()
+        mock_database.insert_receipt_data.side_effect = lambda *args: writer_threads.add(threading.get_ident())
+
+        results = list(batch_processor.process_images(["a.jpg", "b.jpg", "c.jpg"], "dest", "key", mock_database, 1,
+                                                      max_workers=3, preprocess=False))
+
+        self.assertEqual([r.image_path for r in results], ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual([c.args[0] for c in mock_database.insert_receipt_data.call_args_list],
+                         [{"image": "a.jpg"}, {"image": "b.jpg"}, {"image": "c.jpg"}])
+        self.assertEqual([c.args[0] for c in mock_archive_image.call_args_list], ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertEqual(writer_threads, {threading.get_ident()})
+        self.assertEqual([c.args[2] for c in mock_database.record_metrics.call_args_list], ["a.jpg", "b.jpg", "c.jpg"])
+
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_process_images_reports_errors(self, mock_read_receipt):
+        mock_read_receipt.side_effect = [None, Exception("API down")]
+        mock_database = MagicMock()
+
+        results = list(batch_processor.process_images(["a.jpg", "b.jpg"], "dest", "key", mock_database, 1,
+                                                      max_workers=1, preprocess=False))
+
+        self.assertEqual(mock_read_receipt.call_count, 2)
+        self.assertEqual(results[0].error, "Les données extraites sont incorrectes")
+        self.assertEqual(results[1].error, "API down")
+        mock_database.insert_receipt_data.assert_not_called()
+        # Les images en échec sont mesurées aussi, sans ticket associé
+        self.assertEqual([c.args[0] for c in mock_database.record_metrics.call_args_list], [None, None])
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    @patch("batch_processor.image_preprocessing.create_process_pool")
+    def test_process_images_sends_preprocessed_bytes(self, mock_create_pool, mock_read_receipt, mock_archive_image):
+        mock_pool = MagicMock()
+        mock_pool.submit.return_value.result.return_value = image_preprocessing.PreprocessedImage("a.jpg", b"small", 100, 95)
+        mock_create_pool.return_value = mock_pool
+        mock_read_receipt.return_value = {"image": "a.jpg"}
+
+        results = list(batch_processor.process_images(["a.jpg"], "dest", "key", MagicMock(), 1, preprocess=True))
+
+        mock_pool.submit.assert_called_once_with(image_preprocessing.preprocess_image, "a.jpg")
+        mock_read_receipt.assert_called_once_with("a.jpg", "key", image_data=b"small", cache=None, metrics=ANY)
+        self.assertEqual(results[0].bytes_saved, 95)
+        mock_pool.shutdown.assert_called_once()
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_process_images_stops_when_cancelled(self, mock_read_receipt, mock_archive_image):
+        cancel_event = threading.Event()
+
+        def slow_read(image_path, api_key, image_data=None, cache=None, metrics=None):
+            cancel_event.set()
+            time.sleep(0.5)
+            return {"image": image_path}
+        mock_read_receipt.side_effect = slow_read
+        mock_database = MagicMock()
+
+        started = time.monotonic()
+        results = list(batch_processor.process_images(["a.jpg", "b.jpg"], "dest", "key", mock_database, 1, max_workers=1,
+                                                      preprocess=False, cancel_event=cancel_event))
+
+        self.assertEqual(results, [])
+        self.assertLess(time.monotonic() - started, 0.5)
+        mock_database.insert_receipt_data.assert_not_called()
+        mock_archive_image.assert_not_called()
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    @patch("batch_processor.receipt_reader.read_receipts")
+    def test_batch_mode_falls_back_to_single_reads(self, mock_read_receipts, mock_read_receipt, mock_archive_image):
+        mock_read_receipts.side_effect = lambda paths, api_key, images_data=None, cache=None, metrics=None: \
+            [{"image": path} if path != "b.jpg" else None for path in paths]
+        mock_read_receipt.return_value = {"image": "b.jpg", "single": True}
+        mock_database = MagicMock()
+
+        results = list(batch_processor.process_images(["a.jpg", "b.jpg", "c.jpg"], "dest", "key", mock_database, 1,
+                                                      max_workers=1, preprocess=False, batch_size=2))
+
+        self.assertEqual([call.args[0] for call in mock_read_receipts.call_args_list], [["a.jpg", "b.jpg"], ["c.jpg"]])
+        mock_read_receipt.assert_called_once_with("b.jpg", "key", image_data=None, cache=None, metrics=ANY)
+        self.assertEqual([r.parsed_data for r in results],
+                         [{"image": "a.jpg"}, {"image": "b.jpg", "single": True}, {"image": "c.jpg"}])
+        self.assertEqual(mock_database.insert_receipt_data.call_count, 3)
+
+if __name__ == "__main__":
+    unittest.main()
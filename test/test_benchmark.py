@@ -0,0 +1,59 @@
+import json
+import unittest
+
+import requests
+
+import benchmark
+import receipt_reader
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_stub_api_answers_like_the_vision_api(self):
+        with benchmark.StubVisionAPI(latency=0) as api:
+            payload = receipt_reader.create_payload("aaa", output_mode='json')
+            answer = requests.post(api.url, json=payload, timeout=5).json()
+            parsed_data, parse_error = receipt_reader.parse_completion(answer, 'json')
+            self.assertFalse(parse_error)
+            self.assertGreater(answer["usage"]["prompt_tokens"], receipt_reader.IMAGE_TOKENS)
+
+            batch = requests.post(api.url, json=receipt_reader.create_batch_payload(["aaa", "bbb"]), timeout=5).json()
+            sections = receipt_reader.split_batch_response(batch, 2)
+            self.assertTrue(all(receipt_reader.parse_response(section)[0] for section in sections))
+
+        with benchmark.StubVisionAPI(latency=0, error_rate=1.0) as api:
+            response = requests.post(api.url, json=payload, timeout=5)
+            self.assertEqual((response.status_code, response.headers["Retry-After"]), (503, "0"))
+
+    def test_run_benchmark_reports_every_flow(self):
+        api_url = receipt_reader.API_URL
+        results = benchmark.run_benchmark(images=3, latency=0, max_workers=2, batch_size=2, image_size=(300, 400))
+
+        self.assertEqual(set(results["flows"]), {"pipeline", "pipeline_batch", "sequential"})
+        for flow in results["flows"].values():
+            self.assertEqual((flow["images"], flow["receipts"]), (3, 3))
+            self.assertGreater(flow["receipts_per_s"], 0)
+            self.assertIn("api", flow["stages_s"])
+        self.assertEqual(receipt_reader.API_URL, api_url)
+        json.dumps(results)
+
+    def test_each_flow_measures_its_own_peak_rss(self):
+        # Un parcours lancé après un pic de mémoire du processus parent ne le voit pas
+        ballast = b"\x01" * (200 * 1024 * 1024)
+        results = benchmark.run_benchmark(images=1, latency=0, max_workers=1, sequential=False, image_size=(100, 100))
+
+        peak = results["flows"]["pipeline"]["peak_rss_mb"]
+        if peak is None:
+            self.skipTest("resource module unavailable")
+        self.assertLess(peak, benchmark.peak_rss_mb() - 100)
+        del ballast
+
+    def test_compare_results_flags_throughput_drops(self):
+        previous = {"flows": {"pipeline": {"receipts_per_s": 10.0}, "sequential": {"receipts_per_s": 5.0}}}
+        current = {"flows": {"pipeline": {"receipts_per_s": 8.0}, "sequential": {"receipts_per_s": 4.9}}}
+        regressions = benchmark.compare_results(previous, current)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("pipeline:"))
+
+if __name__ == "__main__":
+    unittest.main()
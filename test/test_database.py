@@ -2,7 +2,18 @@ import unittest
 from unittest.mock import patch, MagicMock, call
 import sqlite3
 import logging
-from database import initialize_database, insert_receipt_data, insert_event, insert_event_with_iteration, EventExistsError, EventDateMismatchError
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+
+import analytics
+from database import initialize_database, insert_receipt_data, insert_event, insert_event_with_iteration, EventExistsError, EventDateMismatchError, ReceiptDatabase, insert_receipts_bulk
+from database import MIGRATIONS, SCHEMA_VERSION, _select_event_details, _select_event_total, check_duplicate_policy
+from database import get_event_total, check_totals, rebuild_totals, get_event_details, iter_event_receipts, iter_event_articles
 
 
 class TestDatabaseFunctions(unittest.TestCase):
@@ -12,12 +23,18 @@ class TestDatabaseFunctions(unittest.TestCase):
         mock_conn = MagicMock()
         mock_connect.return_value = mock_conn
         mock_cursor = mock_conn.cursor.return_value
+        mock_cursor.fetchone.return_value = (0,)
 
         initialize_database('test.db')
 
-        mock_connect.assert_called_once_with('test.db')
-        self.assertEqual(mock_cursor.execute.call_count, 3)
-        mock_conn.commit.assert_called_once()
+        mock_connect.assert_called_once_with('test.db', isolation_level=None)
+        # The receipts table lookup, 3 tables in a transaction, the user_version lookup, then each migration
+        # in its own transaction (BEGIN, user_version check, statements, version bump, COMMIT);
+        # a new database is not vacuumed
+        migration_count = sum(len(statements) + 4 for version, statements in MIGRATIONS)
+        self.assertEqual(mock_cursor.execute.call_count, 1 + 5 + 1 + migration_count)
+        self.assertNotIn(call('VACUUM'), mock_cursor.execute.call_args_list)
+        self.assertNotIn(call('ROLLBACK'), mock_cursor.execute.call_args_list)
         mock_conn.close.assert_called_once()
 
     @patch('database.sqlite3.connect')
@@ -69,6 +86,7 @@ class TestDatabaseFunctions(unittest.TestCase):
         }
 
         mock_cursor.lastrowid = 1
+        mock_cursor.fetchone.return_value = None  # Aucun ticket de même empreinte, aucun nom connu
 
         logging.info("Before insert_receipt_data")
         insert_receipt_data('test.db', receipt_data, 1)
@@ -78,19 +96,19 @@ class TestDatabaseFunctions(unittest.TestCase):
             logging.info(f"Call made to execute: {call}")
 
         expected_receipt_call = call('''
-            INSERT INTO receipts (event_id, date, fournisseur, localisation)
-            VALUES (?, ?, ?, ?)
-        ''', (1, '2024-01-01', 'Test Supplier', 'Test Location'))
+            INSERT INTO receipts (event_id, date, fournisseur_id, localisation, fingerprint, duplicate_of)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (1, '2024-01-01', 1, 'Test Location', '2024-01-01|testsupplier|2|1250', None))
 
         expected_article_calls = [
             call('''
-                INSERT INTO articles (receipt_id, famille, sous_famille, nom, prix_unitaire, quantite, prix_total)
+                INSERT INTO articles (receipt_id, famille_id, sous_famille_id, nom, prix_unitaire, quantite, prix_total)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (1, 'Food', 'Fruit', 'Apple', 0.5, 10, 5.0)),
+            ''', (1, 1, 1, 'Apple', 0.5, 10, 5.0)),
             call('''
-                INSERT INTO articles (receipt_id, famille, sous_famille, nom, prix_unitaire, quantite, prix_total)
+                INSERT INTO articles (receipt_id, famille_id, sous_famille_id, nom, prix_unitaire, quantite, prix_total)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (1, 'Drink', 'Juice', 'Orange Juice', 1.5, 5, 7.5))
+            ''', (1, 1, 1, 'Orange Juice', 1.5, 5, 7.5))
         ]
 
         mock_connect.assert_called_once_with('test.db')
@@ -147,6 +165,432 @@ class TestDatabaseFunctions(unittest.TestCase):
         mock_conn.commit.assert_called_once()
         mock_conn.close.assert_called_once()
 
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'receipts.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_upgrade_existing_database(self):
+        # test/receipts.db was created before schema versioning and has no index
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'receipts.db'), self.db_path)
+
+        initialize_database(self.db_path)
+
+        conn = sqlite3.connect(self.db_path)
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+        conn.close()
+        self.assertIn('idx_receipts_event_id', indexes)
+        self.assertIn('idx_articles_receipt_id', indexes)
+
+    def test_only_upgraded_databases_are_vacuumed(self):
+        statements = []
+        connect = sqlite3.connect
+
+        def traced_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        with patch('database.sqlite3.connect', side_effect=traced_connect):
+            initialize_database(self.db_path)
+            self.assertNotIn('VACUUM', statements)
+            # Base d'avant les versions du schéma : user_version = 0 mais des noms à encoder
+            legacy_path = os.path.join(self.tmp_dir, 'legacy.db')
+            shutil.copy(os.path.join(os.path.dirname(__file__), 'receipts.db'), legacy_path)
+            initialize_database(legacy_path)
+            self.assertEqual(statements.count('VACUUM'), 1)
+            initialize_database(legacy_path)
+            self.assertEqual(statements.count('VACUUM'), 1)
+
+    def test_failed_migration_is_rolled_back_and_raised(self):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'receipts.db'), self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO event (event_name, event_date) VALUES ('Old Event', '2023-08-31')")
+        conn.execute("INSERT INTO receipts (event_id, date, fournisseur, localisation) VALUES (1, '2023-08-31', 'Intermarché', 'Foix')")
+        conn.commit()
+        conn.close()
+
+        with patch('database._fingerprint', side_effect=ValueError('boom')):
+            with self.assertRaises(sqlite3.OperationalError):
+                initialize_database(self.db_path)
+
+        conn = sqlite3.connect(self.db_path)
+        receipt_columns = {row[1] for row in conn.execute("PRAGMA table_info(receipts)")}
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 7)
+        conn.close()
+        self.assertNotIn('fingerprint', receipt_columns)
+        # Relancée, la migration repart de la version 7 sans « duplicate column name »
+        initialize_database(self.db_path)
+        self.assertEqual(get_event_total(self.db_path, 1), 0)
+
+    def test_event_queries_are_index_driven(self):
+        initialize_database(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        statements = []
+        conn.set_trace_callback(statements.append)
+
+        _select_event_details(conn.cursor(), 1)
+        _select_event_total(conn.cursor(), 1)
+        conn.set_trace_callback(None)
+
+        self.assertEqual(len(statements), 2)
+        details_plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statements[0])]
+        self.assertFalse([step for step in details_plan if step.startswith('SCAN')], details_plan)
+        self.assertTrue(any('idx_receipts_event_id' in step for step in details_plan), details_plan)
+        self.assertTrue(any('idx_articles_receipt_id' in step for step in details_plan), details_plan)
+        # The total is materialized on the event row
+        total_plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statements[1])]
+        self.assertEqual(total_plan, ['SEARCH event USING INTEGER PRIMARY KEY (rowid=?)'])
+        conn.close()
+
+    def test_upgrade_backfills_materialized_totals(self):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'receipts.db'), self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO event (event_name, event_date) VALUES ('Old Event', '2023-08-31')")
+        conn.execute("INSERT INTO receipts (event_id, date, fournisseur, localisation) VALUES (1, '2023-08-31', 'Intermarché', 'Foix')")
+        conn.executemany("INSERT INTO articles (receipt_id, famille, sous_famille, nom, prix_unitaire, quantite, prix_total) "
+                         "VALUES (1, 'Alimentation', 'Snacking', ?, ?, 1, ?)", [('Chips', 3.5, 3.5), ('Beurre', 4.5, 4.5)])
+        conn.commit()
+        conn.close()
+
+        initialize_database(self.db_path)
+
+        self.assertEqual(get_event_total(self.db_path, 1), 8.0)
+        self.assertEqual(check_totals(self.db_path), [])
+
+    def test_upgrade_flags_existing_duplicates(self):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'receipts.db'), self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO event (event_name, event_date) VALUES ('Old Event', '2023-08-31')")
+        conn.executemany("INSERT INTO receipts (event_id, date, fournisseur, localisation) VALUES (1, '2023-08-31', ?, 'Foix')",
+                         [('Intermarché',), ('INTERMARCHE ',), ('Carrefour',)])
+        conn.executemany("INSERT INTO articles (receipt_id, famille, sous_famille, nom, prix_unitaire, quantite, prix_total) "
+                         "VALUES (?, 'Alimentation', 'Snacking', 'Chips', 3.5, 1, 3.5)", [(1,), (2,), (3,)])
+        conn.commit()
+        conn.close()
+
+        initialize_database(self.db_path)
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT id, fingerprint, duplicate_of FROM receipts ORDER BY id").fetchall()
+        conn.close()
+        self.assertEqual(rows, [(1, '2023-08-31|intermarche|1|350', None), (2, '2023-08-31|intermarche|1|350', 1),
+                                (3, '2023-08-31|carrefour|1|350', None)])
+
+    def test_upgrade_encodes_dimensions(self):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'receipts.db'), self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO event (event_name, event_date) VALUES ('Old Event', '2023-08-31')")
+        conn.executemany("INSERT INTO receipts (event_id, date, fournisseur, localisation) VALUES (1, ?, ?, 'Foix')",
+                         [('2023-08-30', 'Intermarché'), ('2023-08-31', 'INTERMARCHE ')])
+        conn.executemany("INSERT INTO articles (receipt_id, famille, sous_famille, nom, prix_unitaire, quantite, prix_total) "
+                         "VALUES (?, ?, NULL, 'Chips', 3.5, 1, 3.5)", [(1, 'Alimentation'), (2, 'alimentation'), (2, 'Boissons')])
+        conn.commit()
+        conn.close()
+
+        initialize_database(self.db_path)
+
+        conn = sqlite3.connect(self.db_path)
+        article_columns = {row[1] for row in conn.execute("PRAGMA table_info(articles)")}
+        self.assertEqual(conn.execute("SELECT id, key, name FROM dim_fournisseur").fetchall(), [(1, 'intermarche', 'Intermarché')])
+        self.assertEqual(conn.execute("SELECT id, name FROM dim_famille ORDER BY id").fetchall(), [(1, 'Alimentation'), (2, 'Boissons')])
+        self.assertEqual(conn.execute("SELECT famille_id, sous_famille_id FROM articles ORDER BY id").fetchall(),
+                         [(1, None), (1, None), (2, None)])
+        conn.close()
+        self.assertNotIn('famille', article_columns)
+        self.assertEqual(analytics.spending_breakdown(self.db_path, ['famille']),
+                         [(('Alimentation',), 7.0, 2), (('Boissons',), 3.5, 1)])
+        self.assertEqual(check_totals(self.db_path), [])
+
+
+class TestReceiptDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = ReceiptDatabase(os.path.join(self.tmp_dir, 'receipts.db'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_connections_use_wal_and_tuned_pragmas(self):
+        reader = self.db.reader()
+        self.assertEqual(reader.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertEqual(reader.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+        self.assertEqual(reader.execute("PRAGMA cache_size").fetchone()[0], -20000)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.execute("DELETE FROM event")
+
+    def test_insert_and_read_back(self):
+        self.db.insert_event('Test Event', '2024-01-01')
+        event_id = self.db.get_events()[0][0]
+        receipt_id = self.db.insert_receipt_data({
+            'date': '2024-01-01',
+            'fournisseur': 'Test Supplier',
+            'localisation': 'Test Location',
+            'articles': [
+                {'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple', 'prix_unitaire': 0.5, 'quantite': 10, 'prix_total': 5.0},
+            ]
+        }, event_id)
+
+        self.assertEqual(receipt_id, 1)
+        self.assertEqual(self.db.get_event(event_id), ('Test Event', '2024-01-01'))
+        self.assertEqual(self.db.get_event_total(event_id), 5.0)
+        with self.assertRaises(EventExistsError):
+            self.db.insert_event('Test Event', '2024-01-01')
+
+    def test_receipt_insert_logs_one_debug_line_per_receipt(self):
+        articles = [{'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple %d' % i, 'prix_unitaire': 0.5,
+                     'quantite': 1, 'prix_total': 0.5} for i in range(50)]
+        with self.assertLogs('database', logging.DEBUG) as logs:
+            self.db.insert_receipt_data({'date': '2024-01-01', 'fournisseur': 'Supplier', 'localisation': 'Foix',
+                                         'articles': articles}, 1)
+
+        self.assertEqual([record.levelname for record in logs.records], ['DEBUG'])
+        self.assertIn('50 articles', logs.output[0])
+
+    def test_insert_receipts_bulk_returns_ids_of_each_receipt(self):
+        receipts = [{
+            'date': '2024-01-0%d' % i,
+            'fournisseur': 'Supplier %d' % i,
+            'localisation': 'Foix',
+            'articles': [
+                {'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple', 'prix_unitaire': 0.5, 'quantite': i, 'prix_total': 0.5 * i},
+                {'famille': 'Drink', 'sous_famille': 'Juice', 'nom': 'Juice', 'prix_unitaire': 1.5, 'quantite': 1, 'prix_total': 1.5},
+            ]
+        } for i in range(1, 6)]
+        self.db.insert_receipt_data(receipts[0], 1)
+
+        receipt_ids = self.db.insert_receipts_bulk(receipts[1:], 1, batch_size=3)
+        more_ids = insert_receipts_bulk(self.db.db_path, receipts[:1], 1)
+
+        self.assertEqual(receipt_ids, [2, 3, 4, 5])
+        # Ticket déjà enregistré : l'ID existant est renvoyé, rien n'est ajouté
+        self.assertEqual(more_ids, [1])
+        rows = self.db.reader().execute(
+            "SELECT r.id, f.name, COUNT(a.id), SUM(a.prix_total) FROM receipts r "
+            "JOIN articles a ON a.receipt_id = r.id JOIN dim_fournisseur f ON f.id = r.fournisseur_id GROUP BY r.id").fetchall()
+        self.assertEqual(rows[1:5], [(i, 'Supplier %d' % i, 2, 0.5 * i + 1.5) for i in range(2, 6)])
+
+    def _duplicate_receipts(self):
+        self.db.insert_event('Event A', '2024-01-01')
+        self.db.insert_event('Event B', '2024-01-02')
+        article = {'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple', 'prix_unitaire': 0.5, 'quantite': 10, 'prix_total': 5.0}
+        first = {'date': '2024-01-01', 'fournisseur': 'Intermarché', 'localisation': 'Foix', 'articles': [article]}
+        # Même ticket photographié deux fois, le fournisseur lu un peu différemment
+        second = dict(first, fournisseur=' INTERMARCHE', localisation='Foix centre')
+        return first, second
+
+    def test_duplicate_receipts_are_skipped_by_default(self):
+        first, second = self._duplicate_receipts()
+        first_id = self.db.insert_receipt_data(first, 1)
+
+        self.assertEqual(self.db.insert_receipt_data(second, 2), first_id)
+        self.assertEqual(self.db.insert_receipts_bulk([second, dict(second, date='2024-01-02'), second], 1),
+                         [first_id, first_id + 1, first_id])
+        self.assertEqual(self.db.get_event_total(1), 10.0)
+        self.assertEqual(self.db.get_event_total(2), 0)
+
+    def test_duplicate_policies_replace_and_flag(self):
+        first, second = self._duplicate_receipts()
+        first_id = self.db.insert_receipt_data(first, 1)
+
+        self.assertEqual(self.db.insert_receipt_data(second, 2, on_duplicate='replace'), first_id)
+        self.assertEqual(self.db.reader().execute("SELECT event_id, localisation FROM receipts").fetchall(), [(2, 'Foix centre')])
+        self.assertEqual((self.db.get_event_total(1), self.db.get_event_total(2)), (0, 5.0))
+
+        flagged_id = self.db.insert_receipt_data(first, 1, on_duplicate='flag')
+        self.assertEqual([row[:2] for row in self.db.get_flagged_duplicates()], [(flagged_id, first_id)])
+        self.assertEqual(self.db.check_totals(), [])
+        with self.assertRaises(ValueError):
+            self.db.insert_receipt_data(first, 1, on_duplicate='merge')
+
+    def test_duplicate_policy_is_normalized_and_checked_up_front(self):
+        first, _ = self._duplicate_receipts()
+        first_id = self.db.insert_receipt_data(first, 1)
+
+        self.assertEqual(check_duplicate_policy(' Skip '), 'skip')
+        self.assertEqual(self.db.insert_receipt_data(first, 1, on_duplicate='FLAG'), first_id + 1)
+        with self.assertRaises(ValueError):
+            ReceiptDatabase(os.path.join(self.tmp_dir, 'other.db'), duplicate_policy='sikp')
+        # Une faute dans RECEIPT_DUPLICATE_POLICY arrête le programme dès l'import
+        result = subprocess.run([sys.executable, '-c', 'import database'], capture_output=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                env={**os.environ, 'RECEIPT_DUPLICATE_POLICY': 'sikp'})
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn(b"Unknown duplicate policy 'sikp'", result.stderr)
+
+    def test_resolving_flagged_duplicates(self):
+        first, second = self._duplicate_receipts()
+        first_id = self.db.insert_receipt_data(first, 1)
+        reread_id = self.db.insert_receipt_data(second, 1, on_duplicate='flag')
+        distinct_id = self.db.insert_receipt_data(first, 1, on_duplicate='flag')
+        self.db.record_metrics(reread_id, 1, 'reread.jpg', ('model', 1, 1, 1, 0.1, 0, 1, 'json'))
+        # Tant qu'ils ne sont pas tranchés, les tickets marqués comptent dans les totaux
+        self.assertEqual(self.db.get_event_total(1), 15.0)
+
+        self.assertEqual(self.db.resolve_duplicate(reread_id), first_id)
+        self.assertEqual(self.db.resolve_duplicate(distinct_id, keep=True), first_id)
+
+        self.assertEqual(self.db.get_flagged_duplicates(), [])
+        self.assertEqual(self.db.get_event_total(1), 10.0)
+        self.assertEqual((self.db.check_totals(), analytics.find_rollup_mismatches(self.db.reader().cursor())), ([], []))
+        reader = self.db.reader()
+        self.assertEqual(reader.execute("SELECT id FROM receipts ORDER BY id").fetchall(), [(first_id,), (distinct_id,)])
+        self.assertEqual(reader.execute("SELECT receipt_id FROM metrics").fetchall(), [(first_id,)])
+        # Une nouvelle lecture reste rapprochée du ticket d'origine
+        self.assertEqual(self.db.insert_receipt_data(second, 1), first_id)
+        with self.assertRaises(ValueError):
+            self.db.resolve_duplicate(first_id)
+
+    def test_duplicate_check_is_an_index_lookup(self):
+        statements = []
+        self.db._writer.set_trace_callback(statements.append)
+        self.db.insert_receipt_data({'date': '2024-01-01', 'fournisseur': 'Supplier', 'localisation': 'Foix', 'articles': []}, 1)
+        self.db._writer.set_trace_callback(None)
+
+        lookup = next(statement for statement in statements if 'fingerprint =' in statement)
+        plan = [row[3] for row in self.db.reader().execute("EXPLAIN QUERY PLAN " + lookup)]
+        self.assertEqual(plan, ['SEARCH receipts USING INDEX idx_receipts_fingerprint (fingerprint=?)'])
+
+    def test_dimension_names_are_interned_once(self):
+        article = {'famille': 'Alimentation', 'sous_famille': 'Épicerie', 'nom': 'Riz', 'prix_unitaire': 2.0, 'quantite': 1, 'prix_total': 2.0}
+        self.db.insert_receipt_data({'date': '2024-01-01', 'fournisseur': 'Intermarché', 'localisation': 'Foix',
+                                     'articles': [article, dict(article, famille='ALIMENTATION ', sous_famille='epicerie')]}, 1)
+        cached = len(self.db.dimension_cache)
+        statements = []
+        self.db._writer.set_trace_callback(statements.append)
+        self.db.insert_receipt_data({'date': '2024-01-02', 'fournisseur': 'Intermarché', 'localisation': 'Foix',
+                                     'articles': [article]}, 1)
+        self.db._writer.set_trace_callback(None)
+
+        reader = self.db.reader()
+        self.assertEqual(reader.execute("SELECT name FROM dim_famille").fetchall(), [('Alimentation',)])
+        self.assertEqual(reader.execute("SELECT name FROM dim_sous_famille").fetchall(), [('Épicerie',)])
+        self.assertEqual(reader.execute("SELECT DISTINCT famille_id FROM articles").fetchall(), [(1,)])
+        # Noms déjà vus : aucune requête sur les dictionnaires
+        self.assertFalse([statement for statement in statements if 'dim_' in statement], statements)
+        self.assertEqual(len(self.db.dimension_cache), cached)
+
+    def test_search_events_by_prefix(self):
+        for name in ['Fête de la musique', 'festival', 'Kermesse', '50%_off']:
+            self.db.insert_event(name, '2024-06-21')
+
+        self.assertEqual([e[1] for e in self.db.search_events('f')], ['festival', 'Fête de la musique'])
+        self.assertEqual(self.db.count_events('F'), 2)
+        self.assertEqual([e[1] for e in self.db.search_events('50%_')], ['50%_off'])
+        self.assertEqual(self.db.count_events('50_'), 0)
+        self.assertEqual([e[1] for e in self.db.search_events('', offset=1, limit=2)], ['festival', 'Kermesse'])
+
+        plan = [row[3] for row in self.db.reader().execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM event WHERE event_name LIKE 'fe%' ESCAPE '\\' ORDER BY event_name COLLATE NOCASE, id")]
+        self.assertTrue(any('idx_event_name' in step for step in plan), plan)
+
+    def test_triggers_keep_totals_in_sync(self):
+        self.db.insert_event('Event A', '2024-01-01')
+        self.db.insert_event('Event B', '2024-01-02')
+        article = {'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple', 'prix_unitaire': 0.5, 'quantite': 10, 'prix_total': 5.0}
+        receipt = {'date': '2024-01-01', 'fournisseur': 'Supplier', 'localisation': 'Foix', 'articles': [article, article]}
+        first_id = self.db.insert_receipt_data(receipt, 1)
+        self.db.insert_receipts_bulk([dict(receipt, fournisseur='Supplier %d' % i) for i in range(2)], 1)
+        self.assertEqual(self.db.get_event_total(1), 30.0)
+
+        with self.db.writer() as cursor:
+            cursor.execute("UPDATE articles SET prix_total = 7.5 WHERE id = 1")
+            cursor.execute("DELETE FROM articles WHERE id = 2")
+            cursor.execute("UPDATE receipts SET event_id = 2 WHERE id = ?", (first_id,))
+        self.assertEqual(self.db.get_event_total(1), 20.0)
+        self.assertEqual(self.db.get_event_total(2), 7.5)
+
+        with self.db.writer() as cursor:
+            cursor.execute("DELETE FROM articles WHERE receipt_id = ?", (first_id,))
+            cursor.execute("DELETE FROM receipts WHERE id = ?", (first_id,))
+        self.assertEqual(self.db.get_event_total(2), 0.0)
+        self.assertEqual(self.db.check_totals(), [])
+
+    def test_rebuild_totals_repairs_drift(self):
+        self.db.insert_event('Event A', '2024-01-01')
+        self.db.insert_receipt_data({'date': '2024-01-01', 'fournisseur': 'Supplier', 'localisation': 'Foix', 'articles': [
+            {'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple', 'prix_unitaire': 0.5, 'quantite': 10, 'prix_total': 5.0}]}, 1)
+        conn = sqlite3.connect(self.db.db_path)
+        conn.execute("DROP TRIGGER trg_receipts_update_total")
+        conn.execute("UPDATE receipts SET receipt_total = 99")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual([m[0] for m in check_totals(self.db.db_path)], ['receipt'])
+        rebuild_totals(self.db.db_path)
+        self.assertEqual(self.db.check_totals(), [])
+        self.assertEqual(self.db.get_event_total(1), 5.0)
+
+    def _insert_event_receipts(self, receipt_count, articles_per_receipt):
+        self.db.insert_event('Event A', '2024-01-01')
+        article = {'famille': 'Food', 'sous_famille': 'Fruit', 'nom': 'Apple', 'prix_unitaire': 0.5, 'quantite': 2, 'prix_total': 1.0}
+        receipt = {'date': '2024-01-01', 'fournisseur': 'Supplier', 'localisation': 'Foix', 'articles': [article] * articles_per_receipt}
+        return self.db.insert_receipts_bulk([dict(receipt, fournisseur='Supplier %d' % i) for i in range(receipt_count)], 1)
+
+    def test_iter_event_receipts_pages_by_receipt_id(self):
+        receipt_ids = self._insert_event_receipts(25, 3)
+        empty_id = self.db.insert_receipt_data({'date': '2024-01-02', 'fournisseur': 'Other', 'localisation': 'Foix', 'articles': []}, 1)
+
+        statements = []
+        self.db.reader().set_trace_callback(statements.append)
+        nested = list(self.db.iter_event_receipts(1, page_size=10))
+        self.db.reader().set_trace_callback(None)
+
+        self.assertEqual([receipt.id for receipt, articles in nested], receipt_ids + [empty_id])
+        self.assertEqual(nested[0][0].total, 3.0)
+        self.assertTrue(all(len(articles) == 3 for receipt, articles in nested[:-1]))
+        self.assertEqual(nested[-1][1], [])
+        # 3 pages de tickets, chacune suivie de ses articles, puis une page vide
+        self.assertEqual(sum('FROM receipts' in statement for statement in statements), 4)
+        self.assertTrue(all('LIMIT 10' in statement for statement in statements if 'FROM receipts' in statement))
+
+        legacy_ids = sorted(row[6] for row in get_event_details(self.db.db_path, 1))
+        self.assertEqual([article.id for article in iter_event_articles(self.db.db_path, 1, page_size=7)], legacy_ids)
+        self.assertEqual([article.id for article in self.db.iter_event_articles(1)], legacy_ids)
+
+    def test_iter_event_receipts_memory_stays_flat(self):
+        self._insert_event_receipts(3000, 5)
+
+        tracemalloc.start()
+        get_event_details(self.db.db_path, 1)
+        full_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        count = sum(len(articles) for receipt, articles in iter_event_receipts(self.db.db_path, 1, page_size=50))
+        streaming_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.assertEqual(count, 15000)
+        self.assertLess(streaming_peak, full_peak / 5)
+
+    def test_reads_are_not_blocked_by_open_write_transaction(self):
+        self.db.insert_event('Test Event', '2024-01-01')
+        writing = threading.Event()
+        release = threading.Event()
+
+        def slow_write():
+            with self.db.writer() as cursor:
+                cursor.execute("INSERT INTO event (event_name, event_date) VALUES ('Other', '2024-01-02')")
+                writing.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=slow_write)
+        thread.start()
+        writing.wait(5)
+        try:
+            self.assertEqual(len(self.db.get_events()), 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(len(self.db.get_events()), 2)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     unittest.main()
@@ -0,0 +1,85 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+import export
+from database import ReceiptDatabase
+
+
+def _receipt(index, articles=2):
+    return {'date': '2024-01-%02d' % index, 'fournisseur': 'Intermarché %d' % index, 'localisation': 'Foix',
+            'articles': [{'famille': 'Alimentation', 'sous_famille': 'Snacking', 'nom': 'Chips',
+                          'prix_unitaire': 1.5, 'quantite': quantity, 'prix_total': 1.5 * quantity}
+                         for quantity in range(1, articles + 1)]}
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'receipts.db')
+        self.db = ReceiptDatabase(self.db_path)
+        self.db.insert_event('Event A', '2024-01-01')
+        self.db.insert_event('Event B', '2024-02-01')
+        self.db.insert_receipts_bulk([_receipt(1), _receipt(2, articles=0), _receipt(3, articles=3)], 1)
+        self.db.insert_receipt_data(_receipt(4), 2)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _read_csv(self, path):
+        with open(path, newline='', encoding='utf-8') as file:
+            return list(csv.DictReader(file))
+
+    def test_csv_export_streams_event_rows_in_chunks(self):
+        path = os.path.join(self.tmp_dir, 'event.csv')
+
+        result = export.export_receipts(self.db_path, path, event_id=1, chunk_size=2)
+
+        rows = self._read_csv(path)
+        self.assertEqual((result.rows, result.receipts, result.watermark), (6, 3, 3))
+        self.assertEqual([(row['receipt_id'], row['article_id']) for row in rows],
+                         [('1', '1'), ('1', '2'), ('2', ''), ('3', '3'), ('3', '4'), ('3', '5')])
+        self.assertEqual({row['event_name'] for row in rows}, {'Event A'})
+        self.assertEqual((rows[0]['fournisseur'], rows[0]['famille'], rows[0]['prix_total']),
+                         ('Intermarché 1', 'Alimentation', '1.5'))
+        self.assertEqual(os.listdir(self.tmp_dir).count('event.csv.partial'), 0)
+
+    def test_sync_export_only_writes_new_receipts(self):
+        folder = os.path.join(self.tmp_dir, 'sync')
+        watermark_path = os.path.join(self.tmp_dir, 'export.watermark')
+
+        first = export.sync_export(self.db_path, folder, watermark_path)
+        self.assertIsNone(export.sync_export(self.db_path, folder, watermark_path))
+        self.db.insert_receipt_data(_receipt(5, articles=1), 2)
+        second = export.sync_export(self.db_path, folder, watermark_path)
+
+        self.assertEqual((first.receipts, first.watermark), (4, 4))
+        self.assertEqual(os.path.basename(second.path), 'receipts_5-5.csv')
+        self.assertEqual([row['receipt_id'] for row in self._read_csv(second.path)], ['5'])
+        self.assertEqual(export.read_watermark(watermark_path), 5)
+
+    def test_export_format_is_checked_before_writing(self):
+        path = os.path.join(self.tmp_dir, 'event.xlsx')
+        with self.assertRaises(ValueError):
+            export.export_receipts(self.db_path, path)
+        self.assertFalse(os.path.exists(path))
+
+    @unittest.skipUnless(export.PARQUET_AVAILABLE, "pyarrow is not installed")
+    def test_parquet_export_matches_csv(self):
+        import pyarrow.parquet
+        csv_path = os.path.join(self.tmp_dir, 'event.csv')
+        parquet_path = os.path.join(self.tmp_dir, 'event.parquet')
+
+        export.export_receipts(self.db_path, csv_path, chunk_size=3)
+        result = export.export_receipts(self.db_path, parquet_path, chunk_size=3)
+
+        table = pyarrow.parquet.read_table(parquet_path)
+        self.assertEqual((result.format, table.num_rows), (export.PARQUET, len(self._read_csv(csv_path))))
+        self.assertEqual(table.column_names, [name for name, _ in export.EXPORT_COLUMNS])
+
+if __name__ == "__main__":
+    unittest.main()
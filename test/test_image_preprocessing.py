@@ -0,0 +1,80 @@
+import unittest
+import io
+import os
+import shutil
+import tempfile
+import image_preprocessing
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+@unittest.skipIf(Image is None, "Pillow is not installed")
+class TestImagePreprocessing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save_receipt_photo(self, name, size=(1200, 1600), **save_options):
+        # A light receipt on a dark table, with some noise so that the PNG is large
+        photo = Image.effect_noise(size, 20).convert('RGB')
+        photo.paste((40, 40, 40), (0, 0, size[0], size[1] // 10))
+        path = os.path.join(self.tmp_dir, name)
+        photo.save(path, **save_options)
+        return path
+
+    def test_preprocess_image_downscales_and_recompresses(self):
+        path = self.save_receipt_photo('receipt.png')
+
+        result = image_preprocessing.preprocess_image(path, long_edge=500, quality=60)
+
+        with Image.open(io.BytesIO(result.data)) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.mode, 'L')
+            self.assertLessEqual(max(image.size), 500)
+        self.assertEqual(result.original_size, os.path.getsize(path))
+        self.assertEqual(result.bytes_saved, result.original_size - len(result.data))
+        self.assertGreater(result.bytes_saved, 0)
+
+    def test_preprocess_image_applies_exif_orientation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90° clockwise
+        path = self.save_receipt_photo('rotated.jpg', size=(400, 200), exif=exif)
+
+        result = image_preprocessing.preprocess_image(path, crop=False)
+
+        with Image.open(io.BytesIO(result.data)) as image:
+            self.assertEqual(image.size, (200, 400))
+
+    def test_crop_to_receipt_keeps_the_paper(self):
+        photo = Image.new('L', (1000, 1000), 30)
+        photo.paste(240, (200, 100, 700, 900))
+
+        cropped = image_preprocessing.crop_to_receipt(photo, margin=0)
+
+        self.assertEqual(cropped.size, (500, 800))
+
+    def test_preprocess_image_keeps_undecodable_files(self):
+        path = os.path.join(self.tmp_dir, 'not_an_image.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'not an image')
+
+        result = image_preprocessing.preprocess_image(path)
+
+        self.assertEqual(result.data, b'not an image')
+        self.assertEqual(result.bytes_saved, 0)
+
+    def test_preprocess_images_uses_process_pool_in_order(self):
+        paths = [self.save_receipt_photo(f'receipt_{i}.png', size=(800, 600)) for i in range(3)]
+
+        results = image_preprocessing.preprocess_images(paths, max_workers=2, long_edge=300)
+
+        self.assertEqual([r.image_path for r in results], paths)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+# Budget de démarrage des modules du moteur, mesuré dans un interpréteur neuf
+IMPORT_BUDGET = 1.0  # secondes
+ENGINE_MODULES = ['receipt_reader', 'database', 'batch_processor', 'response_cache', 'metrics', 'watcher']
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = '''
+import sys, json, time, logging
+started = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "elapsed": elapsed,
+    "gui": sorted(name for name in sys.modules if name.split('.')[0] in ('tkinter', '_tkinter', 'customtkinter', 'ui')),
+    "handlers": len(logging.getLogger().handlers),
+}))
+'''
+
+
+class TestEngineImport(unittest.TestCase):
+
+    def setUp(self):
+        # Dossier de travail vide : l'import ne doit rien y créer
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_engine_imports_fast_without_gui_or_side_effects(self):
+        env = dict(os.environ, PYTHONPATH=PROJECT_DIR, PYTHONDONTWRITEBYTECODE='1')
+        env.pop('DISPLAY', None)
+        # Premier lancement pour les caches du système de fichiers, le second est mesuré
+        for attempt in range(2):
+            output = subprocess.run([sys.executable, '-c', _PROBE, *ENGINE_MODULES], cwd=self.work_dir, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+        probe = json.loads(output)
+
+        self.assertEqual(probe['gui'], [])
+        self.assertEqual(probe['handlers'], 0)
+        self.assertEqual(os.listdir(self.work_dir), [])
+        self.assertLess(probe['elapsed'], IMPORT_BUDGET)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        instrumentation.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        instrumentation.stop_periodic_dump()
+        instrumentation.reset()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_spans_feed_histograms_from_every_thread(self):
+        @instrumentation.instrumented('test.outer')
+        def work():
+            with instrumentation.span('test.inner'):
+                time.sleep(0.002)
+
+        threads = [threading.Thread(target=work) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        snapshot = instrumentation.snapshot()
+        self.assertEqual(snapshot['test.outer']['count'], 4)
+        self.assertEqual(snapshot['test.inner']['count'], 4)
+        self.assertGreaterEqual(snapshot['test.inner']['min_s'], 0.002)
+        self.assertGreaterEqual(snapshot['test.outer']['total_s'], snapshot['test.inner']['total_s'])
+
+    def test_histogram_percentiles(self):
+        histogram = instrumentation.Histogram()
+        for duration in [0.001] * 90 + [1.0] * 10:
+            histogram.add(duration)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertLessEqual(summary['p50_s'], 0.0016)
+        self.assertEqual(summary['p99_s'], 1.0)
+        self.assertIsNone(instrumentation.Histogram().percentile(0.5))
+
+    def test_spans_record_failures_too(self):
+        with self.assertRaises(ValueError):
+            with instrumentation.span('test.failing'):
+                raise ValueError("boom")
+        self.assertEqual(instrumentation.snapshot()['test.failing']['count'], 1)
+
+    @patch("instrumentation.PROFILE_MODES", {'cprofile'})
+    def test_dump_writes_snapshot_and_profile(self):
+        with instrumentation.span('test.profiled'):
+            sum(range(1000))
+        path = os.path.join(self.tmp_dir, 'stages.json')
+
+        instrumentation.dump(path)
+
+        with open(path, encoding='utf-8') as dump_file:
+            self.assertEqual(json.load(dump_file)['stages']['test.profiled']['count'], 1)
+        self.assertGreater(pstats.Stats(f"{path}.prof").total_calls, 0)
+
+    def test_periodic_dump(self):
+        path = os.path.join(self.tmp_dir, 'stages.json')
+        instrumentation.start_periodic_dump(path, interval=0.05)
+        with instrumentation.span('test.periodic'):
+            pass
+        time.sleep(0.2)
+        self.assertTrue(os.path.exists(path))
+
+        instrumentation.stop_periodic_dump()
+        with open(path, encoding='utf-8') as dump_file:
+            self.assertIn('test.periodic', json.load(dump_file)['stages'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+from unittest.mock import patch
+
+import jobs
+import batch_processor
+import image_preprocessing
+from database import ReceiptDatabase
+
+
+def _receipt(fournisseur):
+    return {'date': '2024-01-02', 'fournisseur': fournisseur, 'localisation': 'Foix', 'articles': [
+        {'famille': 'Alimentation', 'sous_famille': 'Frais', 'nom': 'Pain', 'prix_unitaire': 2, 'quantite': 1, 'prix_total': 2}]}
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = ReceiptDatabase(os.path.join(self.tmp_dir, 'receipts.db'))
+        self.db.insert_event('Event', '2024-01-01')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _receipt_count(self):
+        return self.db.reader().execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+    def test_enqueue_keeps_one_active_job_per_image(self):
+        first = self.db.enqueue_jobs(['a.jpg', 'b.jpg'], 1)
+        self.assertEqual(self.db.enqueue_jobs(['b.jpg', 'a.jpg'], 1), first[::-1])
+
+        claimed = self.db.claim_jobs(first)
+        self.db.fail_job(claimed[0], "unreadable")
+        self.db.complete_job(claimed[1], _receipt('B'))
+        # L'image en échec est remise en file, celle déjà traitée obtient un nouveau job
+        again = self.db.enqueue_jobs(['a.jpg', 'b.jpg'], 1)
+        self.assertEqual(again[0], first[0])
+        self.assertNotEqual(again[1], first[1])
+        self.assertEqual(self.db.count_jobs(), {'pending': 2, 'done': 1})
+
+    def test_claim_skips_active_leases_and_gives_up_on_repeated_expiry(self):
+        job_id, = self.db.enqueue_jobs(['a.jpg'], 1)
+        with self.db.writer() as cursor:
+            self.assertEqual([job.attempts for job in jobs.claim_jobs(cursor, [job_id], lease=10, now=0)], [1])
+            self.assertEqual(jobs.claim_jobs(cursor, [job_id], lease=10, now=5), [])
+            self.assertEqual([job.attempts for job in jobs.claim_jobs(cursor, [job_id], lease=10, now=11)], [2])
+            jobs.claim_jobs(cursor, [job_id], lease=10, now=22)
+            self.assertEqual(jobs.claim_jobs(cursor, [job_id], lease=10, now=33), [])
+        self.assertEqual(self.db.count_jobs(), {'failed': 1})
+
+    def test_receipt_is_rolled_back_when_the_lease_was_lost(self):
+        job_id, = self.db.enqueue_jobs(['a.jpg'], 1)
+        job, = self.db.claim_jobs([job_id])
+        self.db.recover_jobs()
+
+        with self.assertRaises(jobs.JobStateError):
+            self.db.complete_job(job, _receipt('A'))
+        self.assertEqual(self._receipt_count(), 0)
+        self.assertEqual(self.db.get_event_total(1), 0)
+
+    def test_stale_claim_cannot_change_a_job_taken_over(self):
+        job_id, = self.db.enqueue_jobs(['a.jpg'], 1)
+        stale, = self.db.claim_jobs([job_id], lease=0)
+        current, = self.db.claim_jobs([job_id])
+
+        # Le premier worker, dont le bail a expiré, ne touche pas au job repris par le second
+        self.assertFalse(self.db.fail_job(stale, 'timeout'))
+        with self.assertRaises(jobs.JobStateError):
+            self.db.complete_job(stale, _receipt('A'))
+        self.assertEqual(self.db.release_jobs([stale]), 0)
+        self.assertEqual([(job.state, job.attempts) for job in self.db.unfinished_jobs()], [('in_flight', 2)])
+
+        self.assertEqual(self.db.complete_job(current, _receipt('A')), 1)
+        self.assertEqual((self._receipt_count(), self.db.count_jobs()), (1, {'done': 1}))
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_result_of_a_lost_lease_is_left_to_the_new_owner(self, mock_read_receipt, mock_archive_image):
+        job_ids = self.db.enqueue_jobs(['a.jpg', 'b.jpg'], 1)
+
+        def read_while_taken_over(image_path, *args, **kwargs):
+            # Bail expiré pendant l'appel à l'API : un autre worker reprend le job
+            self.db.recover_jobs()
+            self.db.claim_jobs(job_ids)
+            if image_path == 'b.jpg':
+                raise RuntimeError('timeout')
+            return _receipt(image_path)
+        mock_read_receipt.side_effect = read_while_taken_over
+
+        results = list(batch_processor.process_jobs(job_ids, 'dest', 'key', self.db, max_workers=1, preprocess=False))
+
+        self.assertEqual(results, [])
+        mock_archive_image.assert_not_called()
+        self.assertEqual(self._receipt_count(), 0)
+        self.assertEqual([job.state for job in self.db.unfinished_jobs()], ['in_flight', 'in_flight'])
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_restart_resumes_only_unfinished_work(self, mock_read_receipt, mock_archive_image):
+        mock_read_receipt.side_effect = lambda image_path, *args, **kwargs: _receipt(image_path)
+        job_ids = self.db.enqueue_jobs(['a.jpg', 'b.jpg', 'c.jpg'], 1)
+        # Premier lancement : a.jpg est enregistré, b.jpg est en cours au moment du plantage
+        done, crashed = self.db.claim_jobs(job_ids[:2])
+        self.db.complete_job(done, _receipt('a.jpg'))
+        self.db.close()
+
+        self.db = ReceiptDatabase(os.path.join(self.tmp_dir, 'receipts.db'))
+        self.assertEqual(self.db.recover_jobs(), 1)
+        unfinished = [job.id for job in self.db.unfinished_jobs()]
+        results = list(batch_processor.process_jobs(unfinished, 'dest', 'key', self.db, max_workers=2, preprocess=False))
+
+        self.assertEqual([result.image_path for result in results], ['b.jpg', 'c.jpg'])
+        self.assertEqual(sorted(call.args[0] for call in mock_read_receipt.call_args_list), ['b.jpg', 'c.jpg'])
+        self.assertEqual(self._receipt_count(), 3)
+        self.assertEqual(self.db.count_jobs(), {'done': 3})
+
+    @patch("batch_processor.receipt_reader.archive_image")
+    @patch("batch_processor.receipt_reader.read_receipt")
+    @patch("batch_processor.image_preprocessing.create_process_pool")
+    def test_jobs_share_one_pipeline_and_are_claimed_lazily(self, mock_create_pool, mock_read_receipt, mock_archive_image):
+        mock_read_receipt.side_effect = lambda image_path, *args, **kwargs: _receipt(image_path)
+        mock_create_pool.return_value.submit.side_effect = lambda function, image_path: self._preprocessed(image_path)
+        self.db.insert_event('Other event', '2024-01-02')
+        job_ids = self.db.enqueue_jobs(['a.jpg', 'b.jpg', 'c.jpg'], 1) + self.db.enqueue_jobs(['d.jpg', 'e.jpg', 'f.jpg'], 2)
+        claims = []
+        claim_jobs = self.db.claim_jobs
+        self.db.claim_jobs = lambda ids: claims.append(list(ids)) or claim_jobs(ids)
+
+        with patch("batch_processor.ThreadPoolExecutor", wraps=batch_processor.ThreadPoolExecutor) as mock_executor:
+            results = batch_processor.process_jobs(job_ids, 'dest', 'key', self.db, claim_size=2, max_workers=1,
+                                                   preprocess=True)
+            first = next(results)
+            # Deux requêtes d'avance pour un worker : seul le premier lot de jobs est réclamé
+            self.assertEqual((first.image_path, len(claims)), ('a.jpg', 1))
+            results = [first] + list(results)
+
+        self.assertEqual([result.image_path for result in results], ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg', 'f.jpg'])
+        self.assertEqual(len(claims), 3)
+        self.assertEqual((mock_executor.call_count, mock_create_pool.call_count), (1, 1))
+        self.assertEqual((self.db.get_event_total(1), self.db.get_event_total(2)), (6, 6))
+        self.assertEqual(self.db.count_jobs(), {'done': 6})
+
+    def _preprocessed(self, image_path):
+        future = Future()
+        future.set_result(image_preprocessing.PreprocessedImage(image_path, b'small', 10, 5))
+        return future
+
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_cancelled_jobs_go_back_to_the_queue(self, mock_read_receipt):
+        cancel_event = threading.Event()
+
+        def read_and_cancel(image_path, *args, **kwargs):
+            cancel_event.set()
+            return None
+        mock_read_receipt.side_effect = read_and_cancel
+        job_ids = self.db.enqueue_jobs(['a.jpg', 'b.jpg'], 1)
+
+        list(batch_processor.process_jobs(job_ids, 'dest', 'key', self.db, max_workers=1, preprocess=False,
+                                          cancel_event=cancel_event))
+
+        self.assertEqual([(job.state, job.attempts) for job in self.db.unfinished_jobs()], [('pending', 0)] * 2)
+
+if __name__ == "__main__":
+    unittest.main()
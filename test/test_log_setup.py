@@ -0,0 +1,63 @@
+import os
+import logging
+import threading
+import unittest
+from unittest.mock import patch
+
+import log_setup
+
+
+class _ThreadRecorder(logging.Handler):
+    # Garde chaque message avec le thread qui l'a écrit
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.written = threading.Event()
+
+    def emit(self, record):
+        self.records.append((self.format(record), threading.current_thread().name))
+        self.written.set()
+
+
+class TestLogSetup(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger()
+        self.root_level = root.level
+        self.root_handlers = list(root.handlers)
+        self.loggers = ('urllib3', 'PIL', 'database', 'receipt_reader')
+        self.levels = {name: logging.getLogger(name).level for name in self.loggers}
+
+    def tearDown(self):
+        log_setup.stop_logging()
+        root = logging.getLogger()
+        root.setLevel(self.root_level)
+        self.assertEqual(root.handlers, self.root_handlers)
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+
+    def test_records_are_written_by_the_listener_thread(self):
+        recorder = _ThreadRecorder()
+        log_setup.setup_logging(logging.INFO, handlers=[recorder], fmt='%(name)s %(levelname)s %(message)s')
+
+        logging.getLogger('database').info("Inserted %s receipts", 3)
+        self.assertTrue(recorder.written.wait(5))
+
+        message, thread_name = recorder.records[0]
+        self.assertEqual(message, 'database INFO Inserted 3 receipts')
+        self.assertNotEqual(thread_name, threading.current_thread().name)
+
+    def test_module_levels_from_environment_and_arguments(self):
+        with patch.dict(os.environ, {'RECEIPT_LOG_LEVELS': 'database=debug, receipt_reader=ERROR'}):
+            log_setup.setup_logging(logging.WARNING, module_levels={'receipt_reader': 'INFO'},
+                                    handlers=[logging.NullHandler()])
+
+        self.assertEqual(logging.getLogger().level, logging.WARNING)
+        self.assertEqual(logging.getLogger('database').level, logging.DEBUG)
+        self.assertEqual(logging.getLogger('receipt_reader').level, logging.INFO)
+        self.assertEqual(logging.getLogger('urllib3').level, logging.WARNING)
+        with self.assertRaises(ValueError):
+            log_setup.parse_module_levels('database')
+
+if __name__ == "__main__":
+    unittest.main()
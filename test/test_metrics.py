@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import metrics
+from database import ReceiptDatabase
+from receipt_reader import RequestMetrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = ReceiptDatabase(os.path.join(self.tmp_dir, 'receipts.db'))
+        self.db.insert_event('Event A', '2024-01-01')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_summarize_requests_counts_retries_and_resends(self):
+        image_metrics = metrics.summarize_requests([RequestMetrics('gpt-4o', 1000, 100, 2.0, 2),
+                                                    RequestMetrics('gpt-4o', 1000, 120, 1.5, 0)], 2048)
+        self.assertEqual(image_metrics, metrics.ImageMetrics('gpt-4o', 2000, 220, 2048, 3.5, 3, 2))
+        self.assertEqual(metrics.summarize_requests([], 0).requests, 0)
+
+    def test_model_cost_uses_longest_prefix(self):
+        self.assertAlmostEqual(metrics.model_cost('gpt-4o-2024-08-06', 1_000_000, 100_000), 3.5)
+        self.assertAlmostEqual(metrics.model_cost('gpt-4o-mini-2024-07-18', 1_000_000, 0), 0.15)
+        self.assertEqual(metrics.model_cost('unknown', 1000, 1000), 0.0)
+
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 21))
+        self.assertEqual(metrics.percentile(values, 0.5), 10)
+        self.assertEqual(metrics.percentile(values, 0.95), 19)
+        self.assertIsNone(metrics.percentile([], 0.5))
+
+    @patch("metrics.time.time")
+    def test_event_report(self, mock_time):
+        mock_time.side_effect = [1000.0 + 6 * index for index in range(11)]
+        for index in range(10):
+            self.db.record_metrics(index + 1, 1, f"{index}.jpg",
+                                   metrics.ImageMetrics('gpt-4o', 1000, 100, 50_000, float(index + 1), 0, 1))
+        # Image illisible : comptée dans le coût mais pas dans les tickets
+        self.db.record_metrics(None, 1, "bad.jpg", metrics.ImageMetrics('gpt-4o', 1000, 100, 50_000, 30.0, 1, 2))
+
+        report, = self.db.metrics_report(1)
+        self.assertEqual((report.images, report.receipts, report.requests), (11, 10, 12))
+        self.assertEqual((report.prompt_tokens, report.completion_tokens, report.bytes_sent), (11000, 1100, 550_000))
+        self.assertEqual(report.receipts_per_minute, 10.0)
+        self.assertEqual((report.latency_p50, report.latency_p95), (6.0, 30.0))
+        self.assertAlmostEqual(report.cost, metrics.model_cost('gpt-4o', 11000, 1100))
+        self.assertIn("Rec./min", metrics.format_report([report]))
+
+    def test_mode_report_compares_retry_rates(self):
+        for output_mode, requests, receipt_id in [('json', 1, 1), ('json', 1, 2), ('text', 2, 3), ('text', 1, None)]:
+            self.db.record_metrics(receipt_id, 1, "image.jpg",
+                                   metrics.ImageMetrics('gpt-4o', 1000, 100, 1000, 1.0, requests - 1, requests, output_mode))
+        self.db.record_metrics(4, 1, "cached.jpg", metrics.ImageMetrics(None, 0, 0, 0, 0.0, 0, 0, 'json'))
+
+        json_report, text_report = self.db.mode_report()
+        self.assertEqual(json_report, metrics.ModeReport('json', 2, 2, 0, 0.0, 0.0))
+        self.assertEqual(text_report, metrics.ModeReport('text', 2, 3, 1, 0.5, 0.5))
+        self.assertIn("Retry %", metrics.format_mode_report([json_report, text_report]))
+
+if __name__ == "__main__":
+    unittest.main()
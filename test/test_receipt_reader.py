@@ -4,6 +4,9 @@ import receipt_reader
 import base64
 import requests
 import os
+import json
+import tempfile
+import tracemalloc
 from datetime import date
 
 class TestReceiptReader(unittest.TestCase):
@@ -21,11 +24,12 @@ class TestReceiptReader(unittest.TestCase):
         self.assertIn("messages", payload)
         self.assertEqual(payload["messages"][0]["content"][1]["image_url"]["url"], f"data:image/jpeg;base64,{base64_image}")
 
-    @patch("requests.post")
-    def test_send_request(self, mock_post):
+    @patch("receipt_reader.get_session")
+    def test_send_request(self, mock_get_session):
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {"choices": [{"message": {"content": "response"}}]}
+        mock_post = mock_get_session.return_value.post
         mock_post.return_value = mock_response
 
         api_key = "test_api_key"
@@ -36,9 +40,78 @@ class TestReceiptReader(unittest.TestCase):
         mock_post.assert_called_once_with(
             "https://api.openai.com/v1/chat/completions",
             headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
-            json=payload
+            json=payload,
+            timeout=(receipt_reader.CONNECT_TIMEOUT, receipt_reader.READ_TIMEOUT)
         )
 
+    @patch("receipt_reader.time.sleep")
+    @patch("receipt_reader.get_session")
+    def test_send_request_retries_with_backoff(self, mock_get_session, mock_sleep):
+        throttled = MagicMock(status_code=429, headers={"Retry-After": "2"})
+        unavailable = MagicMock(status_code=503, headers={})
+        ok = MagicMock(status_code=200)
+        ok.json.return_value = {"choices": []}
+        mock_post = mock_get_session.return_value.post
+        mock_post.side_effect = [throttled, requests.exceptions.ConnectionError("reset"), unavailable, ok]
+
+        response = receipt_reader.send_request("test_api_key", {"test": "data"})
+
+        self.assertEqual(response, {"choices": []})
+        self.assertEqual(mock_post.call_count, 4)
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        self.assertEqual(delays[0], 2.0)
+        self.assertLessEqual(delays[1], receipt_reader.BACKOFF_BASE * 2)
+        self.assertLessEqual(delays[2], receipt_reader.BACKOFF_BASE * 4)
+
+    @patch("receipt_reader.time.sleep")
+    @patch("receipt_reader.get_session")
+    def test_send_request_does_not_retry_client_errors(self, mock_get_session, mock_sleep):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = MagicMock(status_code=400, text="bad request")
+
+        with self.assertRaises(Exception):
+            receipt_reader.send_request("test_api_key", {"test": "data"})
+
+        mock_post.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch("receipt_reader.get_session")
+    def test_send_request_records_usage(self, mock_get_session):
+        mock_response = MagicMock(status_code=200)
+        mock_response.json.return_value = {"model": "gpt-4o-2024-08-06", "usage": {"prompt_tokens": 1200, "completion_tokens": 80}}
+        mock_get_session.return_value.post.return_value = mock_response
+
+        request_metrics = []
+        receipt_reader.send_request("key", {"some": "payload"}, metrics=request_metrics)
+
+        self.assertEqual(request_metrics[0][:3], ("gpt-4o-2024-08-06", 1200, 80))
+        self.assertEqual(request_metrics[0].retries, 0)
+
+    def test_get_session_is_shared(self):
+        receipt_reader.close_session()
+        session = receipt_reader.get_session()
+        self.assertIs(receipt_reader.get_session(), session)
+        self.assertEqual(session.get_adapter("https://api.openai.com")._pool_maxsize, receipt_reader.POOL_SIZE)
+        receipt_reader.close_session()
+
+    @patch("shutil.move")
+    @patch("receipt_reader.insert_receipt_data")
+    @patch("receipt_reader.send_request")
+    @patch("receipt_reader.encode_image")
+    def test_process_image_retries_parse_without_reencoding(self, mock_encode_image, mock_send_request, mock_insert_receipt_data, mock_shutil_move):
+        mock_encode_image.return_value = "encoded_image"
+        mock_send_request.side_effect = [
+            {"choices": [{"message": {"content": "ALIMENTATION"}}]},
+            {"choices": [{"message": {"content": "31/08/2023, Intermarché, Foix\nFood, Fruit, Apple, 0.5, 10, 5.0"}}]},
+        ]
+
+        receipt_reader.process_image("test.jpg", "destination_folder", "test_api_key", "test_db_path", 1)
+
+        mock_encode_image.assert_called_once_with("test.jpg")
+        self.assertEqual(mock_send_request.call_count, 2)
+        self.assertIs(mock_send_request.call_args_list[0].args[1], mock_send_request.call_args_list[1].args[1])
+        mock_insert_receipt_data.assert_called_once()
+
     def test_parse_response(self):
         response = {
             "choices": [
@@ -51,13 +124,54 @@ class TestReceiptReader(unittest.TestCase):
                 }
             ]
         }
-        parsed_data = receipt_reader.parse_response(response)
+        parsed_data, parse_error = receipt_reader.parse_response(response)
         self.assertIsNotNone(parsed_data)
+        self.assertFalse(parse_error)
         self.assertEqual(parsed_data["date"], date(2023, 8, 31))  # Correction ici
         self.assertEqual(parsed_data["fournisseur"], "Intermarché")
         self.assertEqual(parsed_data["localisation"], "Foix")
         self.assertEqual(len(parsed_data["articles"]), 2)
 
+    def test_json_payload_requests_the_schema(self):
+        payload = receipt_reader.create_payload("aaa", output_mode='json')
+        self.assertEqual(payload["response_format"]["json_schema"]["schema"], receipt_reader.RECEIPT_SCHEMA)
+        self.assertTrue(payload["response_format"]["json_schema"]["strict"])
+        self.assertNotIn("response_format", receipt_reader.create_payload("aaa", output_mode='text'))
+
+    def test_parse_json_response(self):
+        content = json.dumps({
+            "date": "31/08/2023", "fournisseur": "Boulangerie, Pâtisserie Dupont", "localisation": "Foix",
+            "articles": [{"famille": "Energie", "sous_famille": "carburant", "nom": "Essence", "prix_unitaire": 1.72,
+                          "quantite": 40, "prix_total": 68.8}]
+        })
+        parsed_data, parse_error = receipt_reader.parse_completion({"choices": [{"message": {"content": content}}]}, 'json')
+
+        self.assertFalse(parse_error)
+        self.assertEqual(parsed_data["fournisseur"], "Boulangerie, Pâtisserie Dupont")
+        self.assertEqual(parsed_data["date"], date(2023, 8, 31))
+        self.assertEqual(parsed_data["articles"][0]["prix_unitaire"], 1.72)
+
+    def test_validate_receipt_json_is_strict(self):
+        valid = {"date": "31/08/2023", "fournisseur": "Shop", "localisation": "Foix",
+                 "articles": [{"famille": "A", "sous_famille": "B", "nom": "C", "prix_unitaire": 1, "quantite": 1, "prix_total": 1}]}
+        receipt_reader.validate_receipt_json(valid)
+        invalid = [
+            {**valid, "date": "2023-08-31"},
+            {**valid, "extra": 1},
+            {key: value for key, value in valid.items() if key != "localisation"},
+            {**valid, "articles": [{**valid["articles"][0], "prix_total": "1,72"}]},
+            {**valid, "articles": [{**valid["articles"][0], "quantite": True}]},
+        ]
+        for data in invalid:
+            with self.assertRaises(ValueError):
+                receipt_reader.validate_receipt_json(data)
+
+    def test_parse_completion_falls_back_to_line_parser(self):
+        response = {"choices": [{"message": {"content": "31/08/2023, Intermarché, Foix\nFood, Fruit, Apple, 0.5, 10, 5.0"}}]}
+        parsed_data, parse_error = receipt_reader.parse_completion(response, 'json')
+        self.assertFalse(parse_error)
+        self.assertEqual(parsed_data["articles"][0]["nom"], "Apple")
+
     @patch("shutil.move")
     @patch("receipt_reader.insert_receipt_data")
     @patch("receipt_reader.send_request")
@@ -84,5 +198,153 @@ class TestReceiptReader(unittest.TestCase):
         mock_insert_receipt_data.assert_called_once()
         mock_shutil_move.assert_called_once_with("test.jpg", os.path.join("destination_folder", "test.jpg"))
 
+    @patch("shutil.move")
+    @patch("receipt_reader.insert_receipt_data")
+    @patch("receipt_reader.send_request")
+    def test_process_image_cache_hit_skips_api(self, mock_send_request, mock_insert_receipt_data, mock_shutil_move):
+        cached_data = {"date": date(2023, 8, 31), "fournisseur": "Intermarché", "localisation": "Foix", "articles": []}
+        mock_cache = MagicMock()
+        mock_cache.get.return_value.parsed_data = cached_data
+
+        with patch("builtins.open", mock_open(read_data=b"image data")):
+            receipt_reader.process_image("test.jpg", "destination_folder", "test_api_key", "test_db_path", 1, cache=mock_cache)
+
+        mock_cache.make_key.assert_called_once_with(b"image data", receipt_reader.PAYLOAD_VERSION)
+        mock_send_request.assert_not_called()
+        mock_insert_receipt_data.assert_called_once_with("test_db_path", cached_data, 1)
+
+    def test_streaming_payload_matches_json_payload(self):
+        image_data = os.urandom(receipt_reader.ENCODE_CHUNK_SIZE * 2 + 1000)
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as image_file:
+            image_file.write(image_data)
+        try:
+            with receipt_reader.StreamingPayload.from_file(image_file.name) as payload:
+                body = b"".join(iter(lambda: payload.read(1000), b""))
+                self.assertEqual(len(body), len(payload))
+                payload.seek(0)
+                self.assertEqual(payload.read(), body)
+        finally:
+            os.remove(image_file.name)
+
+        expected = receipt_reader.create_payload(receipt_reader.encode_image_data(image_data))
+        self.assertEqual(json.loads(body), expected)
+
+    def test_streaming_payload_memory_is_bounded(self):
+        image_data = os.urandom(8 * 1024 * 1024)
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as image_file:
+            image_file.write(image_data)
+        del image_data
+        try:
+            tracemalloc.start()
+            with receipt_reader.StreamingPayload.from_file(image_file.name) as payload:
+                for block in iter(lambda: payload.read(8192), b""):
+                    pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            os.remove(image_file.name)
+
+        self.assertLess(peak, 1024 * 1024)
+
+    @patch("receipt_reader.STREAMING_THRESHOLD", 10)
+    @patch("receipt_reader.send_request")
+    def test_read_receipt_streams_large_images(self, mock_send_request):
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as image_file:
+            image_file.write(b"large image data")
+        mock_send_request.return_value = {"choices": [{"message": {"content": "31/08/2023, Intermarché, Foix\n"
+                                                                              "Food, Fruit, Apple, 0.5, 10, 5.0"}}]}
+        try:
+            parsed_data = receipt_reader.read_receipt(image_file.name, "test_api_key")
+        finally:
+            os.remove(image_file.name)
+
+        payload = mock_send_request.call_args.args[1]
+        self.assertIsInstance(payload, receipt_reader.StreamingPayload)
+        self.assertEqual(parsed_data["fournisseur"], "Intermarché")
+
+    def test_split_batch_response(self):
+        content = ("### TICKET 1 ###\n31/08/2023, Intermarché, Foix\nAlimentation, snacking, Chips, 3.5, 1, 3.5\n"
+                   "### TICKET 3 ###\n01/09/2023, Carrefour, Pamiers\nBoissons, soda, Cola, 2, 2, 4\n")
+        sections = receipt_reader.split_batch_response({"choices": [{"message": {"content": content}}]}, 3)
+
+        self.assertIsNone(sections[1])
+        first, _ = receipt_reader.parse_response(sections[0])
+        third, _ = receipt_reader.parse_response(sections[2])
+        self.assertEqual((first["fournisseur"], first["articles"][0]["nom"]), ("Intermarché", "Chips"))
+        self.assertEqual((third["date"], third["articles"][0]["prix_total"]), (date(2023, 9, 1), 4.0))
+
+    def test_batch_capacity_respects_token_limits(self):
+        self.assertEqual(receipt_reader.batch_capacity(1), 1)
+        self.assertEqual(receipt_reader.batch_capacity(1000),
+                         receipt_reader.BATCH_MAX_OUTPUT_TOKENS // receipt_reader.MAX_TOKENS)
+        payload = receipt_reader.create_batch_payload(["aaa", "bbb"])
+        self.assertEqual(payload["max_tokens"], 2 * receipt_reader.MAX_TOKENS)
+        self.assertEqual([part.get("text") for part in payload["messages"][0]["content"][1::2]],
+                         ["### TICKET 1 ###", "### TICKET 2 ###"])
+
+    @patch("receipt_reader.send_request")
+    def test_read_receipts_splits_truncated_batches(self, mock_send_request):
+        def answer(api_key, payload, metrics=None):
+            metrics.append(receipt_reader.RequestMetrics("gpt-4o", 1001, 10, 0.5, 0))
+            images = [part for part in payload["messages"][0]["content"] if part["type"] == "image_url"]
+            if len(images) > 2:
+                return {"choices": [{"message": {"content": "### TICKET 1 ###\n31/08"}, "finish_reason": "length"}]}
+            content = "".join(f"### TICKET {index} ###\n31/08/2023, Shop, Foix\nAlimentation, snacking, Chips, 1, 1, 1\n"
+                              for index in range(1, len(images) + 1))
+            return {"choices": [{"message": {"content": content}, "finish_reason": "stop"}]}
+        mock_send_request.side_effect = answer
+        cache = MagicMock()
+        cache.get.return_value = None
+
+        request_metrics = [[], [], [], []]
+        results = receipt_reader.read_receipts(["a.jpg", "b.jpg", "c.jpg", "d.jpg"], "key",
+                                               images_data=[b"a", b"b", b"c", b"d"], cache=cache, metrics=request_metrics)
+
+        self.assertEqual(mock_send_request.call_count, 3)
+        # Le lot coupé puis chaque moitié : les tokens sont répartis entre les tickets de chaque requête
+        self.assertEqual([len(image_metrics) for image_metrics in request_metrics], [2, 2, 2, 2])
+        self.assertEqual(sum(metric.prompt_tokens for image_metrics in request_metrics for metric in image_metrics), 3003)
+        self.assertEqual(request_metrics[0][1].prompt_tokens, 501)
+        self.assertTrue(all(result["fournisseur"] == "Shop" for result in results))
+        self.assertEqual(cache.put.call_count, 4)
+        self.assertTrue(all(key.startswith(receipt_reader.BATCH_PAYLOAD_VERSION + ':')
+                            for key in (put.args[0] for put in cache.put.call_args_list)))
+
+    def test_batch_cache_key_follows_batch_instructions(self):
+        self.assertNotEqual(receipt_reader.BATCH_PAYLOAD_VERSION, receipt_reader.PAYLOAD_VERSION)
+        for name in ("BATCH_INSTRUCTIONS", "RECEIPT_DELIMITER"):
+            with patch.object(receipt_reader, name, getattr(receipt_reader, name) + " changed"):
+                self.assertNotEqual(receipt_reader.batch_payload_version(), receipt_reader.BATCH_PAYLOAD_VERSION)
+
+    @patch("receipt_reader.send_request")
+    @patch("receipt_reader.encode_image")
+    def test_process_image_notifies_instead_of_showing_dialogs(self, mock_encode_image, mock_send_request):
+        mock_encode_image.return_value = "encoded_image"
+        mock_send_request.side_effect = Exception("API down")
+        notify = MagicMock()
+
+        stored = receipt_reader.process_image("test.jpg", "destination_folder", "test_api_key", "test_db_path", 1, notify=notify)
+
+        self.assertFalse(stored)
+        notify.assert_called_once()
+        self.assertIn("test.jpg", notify.call_args.args[1])
+
+    @patch("shutil.move")
+    @patch("receipt_reader.insert_receipt_data", return_value=None)
+    @patch("receipt_reader.send_request")
+    @patch("receipt_reader.encode_image")
+    def test_process_image_keeps_the_image_when_the_insert_fails(self, mock_encode_image, mock_send_request,
+                                                                 mock_insert_receipt_data, mock_shutil_move):
+        mock_encode_image.return_value = "encoded_image"
+        mock_send_request.return_value = {"choices": [{"message": {"content": "31/08/2023, Intermarché, Foix\nFood, Fruit, Apple, 0.5, 10, 5.0"}}]}
+        notify = MagicMock()
+
+        stored = receipt_reader.process_image("test.jpg", "destination_folder", "test_api_key", "test_db_path", 1, notify=notify)
+
+        self.assertFalse(stored)
+        mock_insert_receipt_data.assert_called_once()
+        mock_shutil_move.assert_not_called()
+        self.assertIn("test.jpg", notify.call_args.args[1])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import patch
+import os
+import shutil
+import tempfile
+from datetime import date
+from response_cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_and_get_round_trip(self):
+        cache = ResponseCache(self.cache_path)
+        key = cache.make_key(b"image data", "v1")
+        completion = {"choices": [{"message": {"content": "31/08/2023, Intermarché, Foix"}}]}
+        parsed_data = {"date": date(2023, 8, 31), "fournisseur": "Intermarché", "localisation": "Foix", "articles": []}
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, completion, parsed_data)
+        cached = cache.get(key)
+        cache.close()
+
+        self.assertEqual(cached.completion, completion)
+        self.assertEqual(cached.parsed_data, parsed_data)
+
+    def test_key_depends_on_image_and_version(self):
+        self.assertEqual(ResponseCache.make_key(b"a", "v1"), ResponseCache.make_key(b"a", "v1"))
+        self.assertNotEqual(ResponseCache.make_key(b"a", "v1"), ResponseCache.make_key(b"b", "v1"))
+        self.assertNotEqual(ResponseCache.make_key(b"a", "v1"), ResponseCache.make_key(b"a", "v2"))
+
+    def test_evicts_expired_entries(self):
+        cache = ResponseCache(self.cache_path, max_age=60)
+        with patch("response_cache.time.time", return_value=1000.0):
+            cache.put("old", {}, {"articles": []})
+        with patch("response_cache.time.time", return_value=1100.0):
+            self.assertIsNone(cache.get("old"))
+            cache.evict()
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = ResponseCache(self.cache_path, max_entries=2)
+        for i, key in enumerate(["a", "b", "c"]):
+            with patch("response_cache.time.time", return_value=1000.0 + i):
+                cache.put(key, {}, {"articles": []})
+        with patch("response_cache.time.time", return_value=1010.0):
+            cache.get("a")
+            cache.evict()
+            self.assertIsNotNone(cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNotNone(cache.get("c"))
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
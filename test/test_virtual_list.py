@@ -0,0 +1,47 @@
+import unittest
+from unittest.mock import MagicMock
+from virtual_list import ListSource, PagedQuerySource, MAX_CACHED_PAGES
+
+
+class TestListSource(unittest.TestCase):
+
+    def test_add_update_remove(self):
+        source = ListSource()
+        for name in ["a.jpg", "b.jpg", "c.jpg"]:
+            source.add(name, name)
+        source.add("a.jpg", "a.jpg")
+        source.update("b.jpg", "b.jpg - erreur", "#f2c4c4")
+        source.remove(["a.jpg"])
+
+        self.assertEqual(source.count(), 2)
+        self.assertEqual(source.fetch(0, 5), [("b.jpg", "b.jpg - erreur", "#f2c4c4"), ("c.jpg", "c.jpg", None)])
+        self.assertNotIn("a.jpg", source)
+
+
+class TestPagedQuerySource(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [(i, f"Event {i}", None) for i in range(1000)]
+        self.count_rows = MagicMock(side_effect=lambda query: len(self.rows))
+        self.fetch_rows = MagicMock(side_effect=lambda query, offset, limit: self.rows[offset:offset + limit])
+        self.source = PagedQuerySource(self.count_rows, self.fetch_rows, page_size=100)
+
+    def test_fetch_reads_only_the_needed_pages(self):
+        self.assertEqual(self.source.fetch(95, 105), self.rows[95:105])
+        self.assertEqual(self.source.fetch(96, 104), self.rows[96:104])
+
+        self.assertEqual([c.args for c in self.fetch_rows.call_args_list], [("", 0, 100), ("", 100, 100)])
+
+    def test_cache_is_bounded_and_invalidated(self):
+        for page in range(MAX_CACHED_PAGES + 2):
+            self.source.fetch(page * 100, page * 100 + 1)
+        self.assertEqual(len(self.source._pages), MAX_CACHED_PAGES)
+
+        self.source.count()
+        self.source.set_query("Event 1")
+        self.source.count()
+        self.assertEqual(self.count_rows.call_count, 2)
+        self.assertEqual(self.source._pages, {})
+
+if __name__ == "__main__":
+    unittest.main()
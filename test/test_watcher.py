@@ -0,0 +1,104 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import watcher
+from database import ReceiptDatabase
+
+
+class TestQueueWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = os.path.join(self.tmp_dir, 'queue')
+        self.processed = os.path.join(self.tmp_dir, 'processed')
+        self.failed = os.path.join(self.tmp_dir, 'failed')
+        self.database = ReceiptDatabase(os.path.join(self.tmp_dir, 'receipts.db'))
+        self.database.insert_event('Event', '2024-01-01')
+        self.watcher = watcher.QueueWatcher(self.database, 1, 'key', self.queue, self.processed, self.failed,
+                                            max_workers=2, batch_size=1, max_batch=2, poll_interval=0.01,
+                                            settle_time=0, preprocess=False)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _drop(self, name, data=b'image'):
+        path = os.path.join(self.queue, name)
+        with open(path, 'wb') as image_file:
+            image_file.write(data)
+        return path
+
+    def test_images_are_taken_once_settled(self):
+        first = self._drop('a.jpg')
+        self._drop('notes.txt')
+        self.assertEqual(self.watcher.ready_images(now=0), [])
+        self.assertEqual(self.watcher.ready_images(now=1), [first])
+
+        self.watcher.settle_time = 5
+        second = self._drop('b.png')
+        self.watcher.ready_images(now=10)
+        # L'image grossit encore : le délai repart de zéro
+        self._drop('b.png', b'image, more bytes')
+        self.assertEqual(self.watcher.ready_images(now=13), [first])
+        self.assertEqual(self.watcher.ready_images(now=18), [first, second])
+
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_run_once_moves_stored_and_failed_images(self, mock_read_receipt):
+        mock_read_receipt.side_effect = lambda image_path, *args, **kwargs: None if image_path.endswith('bad.jpg') else {
+            'date': '2024-01-02', 'fournisseur': os.path.basename(image_path), 'localisation': 'Foix', 'articles': []}
+        for name in ('a.jpg', 'b.jpg', 'c.jpg', 'bad.jpg'):
+            self._drop(name)
+
+        self.watcher.run(once=True)
+
+        self.assertEqual(os.listdir(self.queue), [])
+        self.assertEqual(sorted(os.listdir(self.processed)), ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.assertEqual(os.listdir(self.failed), ['bad.jpg'])
+        self.assertEqual((self.watcher.stored, self.watcher.failed), (3, 1))
+        self.assertEqual(sorted(receipt.fournisseur for receipt, articles in self.database.iter_event_receipts(1)), ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.assertEqual(self.database.count_jobs(), {'done': 3, 'failed': 1})
+
+    @patch("batch_processor.receipt_reader.read_receipt")
+    def test_images_leased_elsewhere_are_skipped_until_the_lease_expires(self, mock_read_receipt):
+        path = self._drop('a.jpg')
+        # Job réclamé par un autre worker, bail encore valable
+        self.database.claim_jobs(self.database.enqueue_jobs([path], 1))
+        calls = []
+        process_batch = self.watcher.process_batch
+        self.watcher.process_batch = lambda image_paths: calls.append(image_paths) or process_batch(image_paths)
+
+        started = time.monotonic()
+        self.watcher.run(once=True)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(calls, [[path]])
+        mock_read_receipt.assert_not_called()
+        self.assertEqual(os.listdir(self.queue), ['a.jpg'])
+        self.assertEqual(self.watcher.ready_images(), [])
+        # Bail expiré : l'image est reprise
+        self.watcher._leased[path] = time.time() - 1
+        self.watcher.ready_images()
+        self.assertEqual(self.watcher.ready_images(), [path])
+
+    @patch("watcher.batch_processor.process_jobs")
+    def test_stop_drains_then_cancels(self, mock_process_jobs):
+        def process(job_ids, *args, cancel_event=None, **kwargs):
+            # Un signal arrive pendant la passe : elle doit se terminer normalement
+            self.watcher.stop()
+            self.assertFalse(cancel_event.is_set())
+            return []
+        mock_process_jobs.side_effect = process
+        self._drop('a.jpg')
+
+        self.watcher.run()
+
+        self.assertEqual(mock_process_jobs.call_count, 1)
+        self.watcher.stop()
+        self.assertTrue(self.watcher.cancel_event.is_set())
+
+if __name__ == "__main__":
+    unittest.main()
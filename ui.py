@@ -2,21 +2,28 @@
 import customtkinter as ctk
 from tkinter import filedialog, messagebox
 import os
+import time
+import queue
 import logging
+import threading
 import receipt_reader
-from database import initialize_database, insert_event, insert_event_with_iteration, get_event_total, EventExistsError, EventDateMismatchError
+import batch_processor
+import instrumentation
+import jobs
+import export
+import log_setup
+from virtual_list import VirtualList, ListSource, PagedQuerySource
+from response_cache import ResponseCache
+from database import ReceiptDatabase, EventExistsError, EventDateMismatchError
 import sqlite3
 
-# Configuration des logs pour affichage dans la console uniquement
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s - [%(filename)s:%(lineno)d] - %(funcName)s()',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[logging.StreamHandler()]
-)
-
 logger = logging.getLogger(__name__)
 
+# Intervalle de lecture de la file de progression par la boucle Tk
+PROGRESS_POLL_MS = 100
+# Délai après la dernière frappe avant de lancer la recherche d'évènements
+SEARCH_DELAY_MS = 250
+
 class TicketApp:
     def __init__(self, master):
         self.master = master
@@ -26,15 +33,29 @@ class TicketApp:
         self.center_window(800, 800)  # Augmenter la hauteur de la fenêtre
 
         self.db_path = './receipts.db'
-        initialize_database(self.db_path)
+        self.db = ReceiptDatabase(self.db_path)
+        self.response_cache = ResponseCache()
+        # Sans RECEIPT_INSTRUMENTATION_DUMP, aucun fichier n'est écrit
+        instrumentation.start_periodic_dump()
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.selected_event_id = None
         self.selected_event_label = None
+        self.max_workers = batch_processor.DEFAULT_MAX_WORKERS
+
+        # État du traitement en arrière-plan
+        self.progress_queue = queue.Queue()
+        self.processing_thread = None
+        self.cancel_event = None
+        self.images_source = ListSource()
+        self.search_job = None
+        self.resume_job = None
 
         self.main_frame = ctk.CTkFrame(master)
         self.main_frame.pack(fill="both", expand=True, padx=10, pady=10)
 
         self.create_ui()
+        self.resume_jobs()
 
     def center_window(self, width, height):
         screen_width = self.master.winfo_screenwidth()
@@ -73,8 +94,18 @@ class TicketApp:
 
         self.add_section_header(self.right_frame, "SELECTIONNER EVENEMENT")
 
-        self.events_frame = ctk.CTkScrollableFrame(self.right_frame, fg_color="#ebebeb", height=200)
-        self.events_frame.pack(pady=10, fill="both", expand=True)
+        self.event_search_entry = ctk.CTkEntry(self.right_frame, placeholder_text="Rechercher un évènement")
+        self.event_search_entry.pack(pady=5, fill="x")
+        self.event_search_entry.bind("<KeyRelease>", self.schedule_event_search, add="+")
+
+        # Seules les lignes visibles sont créées, les évènements sont lus page par page
+        self.events_source = PagedQuerySource(
+            self.db.count_events,
+            lambda query, offset, limit: [(event[0], f"{event[1]} ({event[2]})", None)
+                                          for event in self.db.search_events(query, offset, limit)])
+        self.events_list = VirtualList(self.right_frame, self.events_source, on_select=self.select_event,
+                                       fg_color="#ebebeb", height=200)
+        self.events_list.pack(pady=10, fill="both", expand=True)
         self.load_events()
 
         # Bottom Frame - Upload and Process Tickets Section
@@ -91,15 +122,32 @@ class TicketApp:
         self.upload_button = ctk.CTkButton(self.bottom_frame, text="Télécharger les tickets", command=self.upload_tickets)
         self.upload_button.pack(pady=10)
 
-        self.images_frame = ctk.CTkScrollableFrame(self.bottom_frame, fg_color="white", height=200)
-        self.images_frame.pack(pady=10, fill="both")
+        self.images_list = VirtualList(self.bottom_frame, self.images_source, fg_color="white", height=200)
+        self.images_list.pack(pady=10, fill="both")
+
+        self.progress_bar = ctk.CTkProgressBar(self.bottom_frame)
+        self.progress_bar.set(0)
+        self.progress_bar.pack(pady=5, fill="x", padx=20)
+
+        self.progress_label = ctk.CTkLabel(self.bottom_frame, text="", fg_color="#ebebeb")
+        self.progress_label.pack(pady=2)
 
-        self.process_tickets_button = ctk.CTkButton(self.bottom_frame, text="Traiter les tickets", command=self.process_tickets)
-        self.process_tickets_button.pack(pady=10)
+        self.process_buttons_frame = ctk.CTkFrame(self.bottom_frame, fg_color="#ebebeb")
+        self.process_buttons_frame.pack(pady=10)
+
+        self.process_tickets_button = ctk.CTkButton(self.process_buttons_frame, text="Traiter les tickets", command=self.process_tickets)
+        self.process_tickets_button.pack(side="left", padx=5)
+
+        self.cancel_button = ctk.CTkButton(self.process_buttons_frame, text="Annuler", command=self.cancel_processing,
+                                           state="disabled")
+        self.cancel_button.pack(side="left", padx=5)
 
         self.total_expenses_button = ctk.CTkButton(self.bottom_frame, text="Afficher les dépenses totales", command=self.show_total_expenses)
         self.total_expenses_button.pack(pady=10)
 
+        self.export_button = ctk.CTkButton(self.bottom_frame, text="Exporter l'événement", command=self.export_event)
+        self.export_button.pack(pady=10)
+
         self.uploaded_images = []
 
     def add_section_header(self, parent, title):
@@ -116,61 +164,57 @@ class TicketApp:
         try:
             event_name = self.event_name_entry.get()
             event_date = self.event_date_entry.get()
-            message = insert_event(self.db_path, event_name, event_date)
+            message = self.db.insert_event(event_name, event_date)
             self.load_events()
             self.show_info(message)
         except EventExistsError as e:
-            logger.error(f"EventExistsError: {e}")
+            logger.error("EventExistsError: %s", e)
             messagebox.showerror("Erreur", str(e))
         except EventDateMismatchError as e:
-            logger.error(f"EventDateMismatchError: {e}")
+            logger.error("EventDateMismatchError: %s", e)
             result = messagebox.askyesno("Avertissement", f"{str(e)}\nVoulez-vous ajouter un nouvel évènement avec une nouvelle date?")
             if result:
-                message = insert_event_with_iteration(self.db_path, event_name, event_date)
+                message = self.db.insert_event_with_iteration(event_name, event_date)
                 self.load_events()
                 self.show_info(message)
         except Exception as e:
-            logger.error(f"An error occurred while adding the event: {e}")
+            logger.error("An error occurred while adding the event: %s", e)
             messagebox.showerror("Erreur", f"An unexpected error occurred: {e}")
 
     def load_events(self):
         try:
-            for widget in self.events_frame.winfo_children():
-                widget.destroy()
-
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, event_name, event_date FROM event")
-            events = cursor.fetchall()
-            conn.close()
-
-            for event in events:
-                event_button = ctk.CTkButton(self.events_frame, text=f"{event[1]} ({event[2]})",
-                                             command=lambda e=event[0]: self.select_event(e))
-                event_button.pack(pady=5)
+            # Relire les pages depuis la base : seules les lignes modifiées sont redessinées
+            self.events_source.invalidate()
+            self.events_list.refresh()
         except sqlite3.Error as e:
-            logger.error(f"Database error: {e}")
+            logger.error("Database error: %s", e)
             raise
         except Exception as e:
-            logger.error(f"An error occurred while loading events: {e}")
+            logger.error("An error occurred while loading events: %s", e)
             raise
 
+    def schedule_event_search(self, event=None):
+        if self.search_job is not None:
+            self.master.after_cancel(self.search_job)
+        self.search_job = self.master.after(SEARCH_DELAY_MS, self.search_events)
+
+    def search_events(self):
+        self.search_job = None
+        self.events_source.set_query(self.event_search_entry.get().strip())
+        self.events_list.scroll_to_top()
+
     def select_event(self, event_id):
         try:
             self.selected_event_id = event_id
 
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT event_name, event_date FROM event WHERE id = ?", (event_id,))
-            event = cursor.fetchone()
-            conn.close()
+            event = self.db.get_event(event_id)
 
             event_name = event[0]
             event_date = event[1]
             self.selected_event_label.configure(text=f"Événement sélectionné : {event_name} ({event_date})")
-            logger.info(f"Selected Event ID: {event_id}")
+            logger.info("Selected Event ID: %s", event_id)
         except Exception as e:
-            logger.error(f"An error occurred while selecting the event: {e}")
+            logger.error("An error occurred while selecting the event: %s", e)
             raise
 
     def upload_tickets(self):
@@ -181,18 +225,46 @@ class TicketApp:
 
             for image_path in image_paths:
                 try:
+                    if image_path in self.images_source:
+                        continue
                     self.uploaded_images.append(image_path)
-                    image_label = ctk.CTkLabel(self.images_frame, text=os.path.basename(image_path), fg_color="#ebebeb")
-                    image_label.pack(pady=2)
+                    self.images_source.add(image_path, os.path.basename(image_path))
                 except PermissionError as e:
-                    logger.error(f"Permission error: {e}")
+                    logger.error("Permission error: %s", e)
                 except Exception as e:
-                    logger.error(f"An error occurred while uploading tickets: {e}")
+                    logger.error("An error occurred while uploading tickets: %s", e)
                     raise
+            self.images_list.refresh()
         except Exception as e:
-            logger.error(f"An error occurred while selecting tickets to upload: {e}")
+            logger.error("An error occurred while selecting tickets to upload: %s", e)
             raise
 
+    def resume_jobs(self):
+        # Images d'un traitement interrompu (plantage, fermeture) : elles reviennent dans la liste
+        # et seront traitées pour leur évènement d'origine, sans renvoyer celles déjà enregistrées.
+        # Les jobs sous un bail encore valable sont en cours ailleurs (watcher.py), ou ont été laissés
+        # par cette interface avant un plantage : la liste est parcourue de nouveau à l'expiration
+        # du premier de ces baux, après quoi claim_jobs peut les reprendre.
+        self.resume_job = None
+        try:
+            now = time.time()
+            next_expiry = None
+            for job in self.db.unfinished_jobs():
+                if job.image_path in self.images_source:
+                    continue
+                if job.state == jobs.IN_FLIGHT and job.lease_until is not None and job.lease_until > now:
+                    next_expiry = job.lease_until if next_expiry is None else min(next_expiry, job.lease_until)
+                    continue
+                self.uploaded_images.append(job.image_path)
+                self.images_source.add(job.image_path, os.path.basename(job.image_path))
+                self.set_image_status(job.image_path, "à reprendre")
+            self.images_list.refresh()
+            if next_expiry is not None:
+                delay_ms = int((next_expiry - now) * 1000) + PROGRESS_POLL_MS
+                self.resume_job = self.master.after(delay_ms, self.resume_jobs)
+        except Exception as e:
+            logger.error("An error occurred while resuming interrupted jobs: %s", e)
+
     def process_tickets(self):
         try:
             if self.selected_event_id is None:
@@ -200,31 +272,129 @@ class TicketApp:
                 messagebox.showwarning("Warning",
                                        "Vous devez sélectionner un évènement dans la section SELECTIONNER EVENEMENT")
                 return
+            if self.processing_thread is not None:
+                return
+            if not self.uploaded_images:
+                messagebox.showinfo("Informations", "Aucun ticket à traiter")
+                return
 
-            source_folder = "./receipt_queue"
             destination_folder = "./receipt_processed"
-            db_path = "./receipts.db"
             api_key = receipt_reader.get_api_key()
 
             if not os.path.exists(destination_folder):
                 os.makedirs(destination_folder)
 
-            for image in self.uploaded_images:
-                try:
-                    receipt_reader.process_image(image, destination_folder, api_key, db_path, self.selected_event_id)
-                except PermissionError as e:
-                    logger.error(f"Permission error: {e}")
-                except Exception as e:
-                    logger.error(f"An error occurred while processing tickets: {e}")
-                    raise
+            images = list(self.uploaded_images)
+            job_ids = self.db.enqueue_jobs(images, self.selected_event_id)
+            self.processing_stats = {"total": len(images), "done": 0, "failed": [], "stored": [], "bytes_saved": 0,
+                                     "started": time.monotonic()}
+            self.cancel_event = threading.Event()
+            self.progress_bar.set(0)
+            self.progress_label.configure(text=f"0 / {len(images)} tickets traités")
+            self.process_tickets_button.configure(state="disabled")
+            self.cancel_button.configure(state="normal")
+            for image_path in images:
+                self.set_image_status(image_path, "en attente")
+            self.images_list.refresh()
+
+            # Le traitement tourne hors de la boucle Tk et ne communique que par la file
+            self.processing_thread = threading.Thread(
+                target=self.process_tickets_worker,
+                args=(job_ids, destination_folder, api_key, self.cancel_event),
+                name="ticket-processing", daemon=True)
+            self.processing_thread.start()
+            self.master.after(PROGRESS_POLL_MS, self.poll_progress)
+        except Exception as e:
+            logger.error("An error occurred while processing tickets: %s", e)
+            messagebox.showerror("Erreur", f"An error occurred: {e}")
 
-            self.uploaded_images = []
-            for widget in self.images_frame.winfo_children():
-                widget.destroy()
-            logger.info("All tickets processed")
+    def process_tickets_worker(self, job_ids, destination_folder, api_key, cancel_event):
+        # Exécuté dans un thread : aucun appel à Tk ici
+        try:
+            for result in batch_processor.process_jobs(job_ids, destination_folder, api_key, self.db,
+                                                       max_workers=self.max_workers, cache=self.response_cache,
+                                                       cancel_event=cancel_event):
+                self.progress_queue.put(("result", result))
         except Exception as e:
-            logger.error(f"An error occurred while processing tickets: {e}")
-            raise
+            logger.error("An error occurred while processing tickets: %s", e)
+            self.progress_queue.put(("error", str(e)))
+        finally:
+            self.progress_queue.put(("done", cancel_event.is_set()))
+
+    def poll_progress(self):
+        finished = None
+        try:
+            while True:
+                kind, value = self.progress_queue.get_nowait()
+                if kind == "result":
+                    self.show_result(value)
+                elif kind == "error":
+                    messagebox.showerror("Erreur", f"An error occurred: {value}")
+                elif kind == "done":
+                    finished = value
+        except queue.Empty:
+            pass
+        self.images_list.refresh()
+
+        if finished is None:
+            self.master.after(PROGRESS_POLL_MS, self.poll_progress)
+        else:
+            self.finish_processing(cancelled=finished)
+
+    def show_result(self, result):
+        stats = self.processing_stats
+        stats["done"] += 1
+        stats["bytes_saved"] += result.bytes_saved
+        if result.error:
+            stats["failed"].append(result.image_path)
+            self.set_image_status(result.image_path, "erreur", "#f2c4c4")
+        else:
+            stats["stored"].append(result.image_path)
+            self.set_image_status(result.image_path, "enregistré", "#c8e6c9")
+
+        elapsed = time.monotonic() - stats["started"]
+        throughput = stats["done"] / elapsed * 60 if elapsed > 0 else 0
+        self.progress_bar.set(stats["done"] / stats["total"])
+        self.progress_label.configure(
+            text=f"{stats['done']} / {stats['total']} tickets traités - {len(stats['failed'])} erreur(s) - "
+                 f"{throughput:.1f} tickets/min")
+
+    def set_image_status(self, image_path, status, color=None):
+        # Mise à jour de la source uniquement, l'appelant rafraîchit la liste une seule fois
+        self.images_source.update(image_path, f"{os.path.basename(image_path)} - {status}", color)
+
+    def finish_processing(self, cancelled=False):
+        stats = self.processing_stats
+        self.processing_thread = None
+        self.process_tickets_button.configure(state="normal")
+        self.cancel_button.configure(state="disabled")
+
+        # Les tickets enregistrés quittent la liste, les autres restent pour un nouvel essai
+        stored = set(stats["stored"])
+        self.uploaded_images = [image_path for image_path in self.uploaded_images if image_path not in stored]
+        self.images_source.remove(stored)
+        failed = set(stats["failed"])
+        for image_path in self.uploaded_images:
+            if image_path not in failed:
+                self.set_image_status(image_path, "non traité" if cancelled else "en attente")
+        self.images_list.refresh()
+
+        status = "annulé" if cancelled else "terminé"
+        self.progress_label.configure(
+            text=f"Traitement {status} : {len(stored)} / {stats['total']} tickets enregistrés - {len(stats['failed'])} erreur(s)")
+        logger.info("Ticket processing %s: %s stored, %s failed (%s bytes saved by image preprocessing)",
+                    'cancelled' if cancelled else 'finished', len(stored), len(stats['failed']), stats['bytes_saved'])
+
+        if stats["failed"]:
+            messagebox.showwarning("Warning", "Les images suivantes n'ont pas pu être traitées après réessai et ont été ignorées:\n"
+                                   + "\n".join(os.path.basename(image_path) for image_path in stats["failed"]))
+
+    def cancel_processing(self):
+        if self.cancel_event is not None:
+            logger.info("Cancelling ticket processing")
+            self.cancel_event.set()
+            self.cancel_button.configure(state="disabled")
+            self.progress_label.configure(text="Annulation en cours...")
 
     def show_total_expenses(self):
         try:
@@ -232,17 +402,58 @@ class TicketApp:
                 messagebox.showwarning("Warning", "Vous devez sélectionner un évènement")
                 return
 
-            total = get_event_total(self.db_path, self.selected_event_id)
+            total = self.db.get_event_total(self.selected_event_id)
             self.show_info(f"Dépenses totales pour l'événement sélectionné: {total} euros")
         except Exception as e:
-            logger.error(f"An error occurred while fetching total expenses: {e}")
+            logger.error("An error occurred while fetching total expenses: %s", e)
+            messagebox.showerror("Erreur", f"An error occurred: {e}")
+
+    def export_event(self):
+        try:
+            if self.selected_event_id is None:
+                messagebox.showwarning("Warning", "Vous devez sélectionner un évènement")
+                return
+
+            filetypes = [("CSV", "*.csv")]
+            if export.PARQUET_AVAILABLE:
+                filetypes.append(("Parquet", "*.parquet"))
+            path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=filetypes)
+            if not path:
+                return
+
+            result = export.export_receipts(self.db.db_path, path, event_id=self.selected_event_id)
+            self.show_info(f"{result.receipts} tickets ({result.rows} lignes) exportés dans {os.path.basename(path)}")
+        except Exception as e:
+            logger.error("An error occurred while exporting the event: %s", e)
             messagebox.showerror("Erreur", f"An error occurred: {e}")
 
+    def on_close(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+        if self.processing_thread is not None and self.processing_thread.is_alive():
+            # Le thread peut être au milieu d'une écriture : la fenêtre est masquée et la base
+            # n'est fermée qu'une fois le traitement annulé terminé
+            self.master.withdraw()
+            self.master.after(PROGRESS_POLL_MS, self.on_close)
+            return
+        if self.resume_job is not None:
+            self.master.after_cancel(self.resume_job)
+        self.db.close()
+        self.response_cache.close()
+        receipt_reader.close_session()
+        instrumentation.stop_periodic_dump()
+        self.master.destroy()
+
 if __name__ == "__main__":
+    # Configuration des logs pour affichage dans la console uniquement, écrits par le thread de log_setup
+    # Niveaux donnés par RECEIPT_LOG_LEVEL et RECEIPT_LOG_LEVELS
+    log_setup.setup_logging(
+        fmt='%(asctime)s - %(levelname)s - %(message)s - [%(filename)s:%(lineno)d] - %(funcName)s()',
+    )
     try:
         root = ctk.CTk()
         app = TicketApp(root)
         root.mainloop()
     except Exception as e:
-        logger.critical(f"An error occurred in the main application: {e}")
+        logger.critical("An error occurred in the main application: %s", e)
         raise
@@ -0,0 +1,205 @@
+# virtual_list.py
+import customtkinter as ctk
+
+# Nombre maximal de pages gardées en mémoire par PagedQuerySource
+MAX_CACHED_PAGES = 10
+
+
+class ListSource:
+    """In-memory rows for a VirtualList, addressed by key.
+
+    Each row is shown as ``(key, text, color)``; a color of None keeps the
+    widget's default color.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._rows = {}
+
+    def count(self):
+        return len(self._keys)
+
+    def fetch(self, start, stop):
+        return [(key, *self._rows[key]) for key in self._keys[start:stop]]
+
+    def keys(self):
+        return list(self._keys)
+
+    def add(self, key, text, color=None):
+        if key not in self._rows:
+            self._keys.append(key)
+        self._rows[key] = (text, color)
+
+    def update(self, key, text, color=None):
+        if key in self._rows:
+            self._rows[key] = (text, color)
+
+    def remove(self, keys):
+        keys = set(keys)
+        self._keys = [key for key in self._keys if key not in keys]
+        for key in keys:
+            self._rows.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+
+class PagedQuerySource:
+    """Rows read page by page from an indexed query, for lists too long to load at once.
+
+    ``count_rows(query)`` returns the number of matching rows and
+    ``fetch_rows(query, offset, limit)`` one page of ``(key, text, color)``
+    rows. Pages are cached until ``invalidate`` is called, keeping at most
+    MAX_CACHED_PAGES of them.
+    """
+
+    def __init__(self, count_rows, fetch_rows, page_size=100):
+        self.count_rows = count_rows
+        self.fetch_rows = fetch_rows
+        self.page_size = page_size
+        self.query = ''
+        self.invalidate()
+
+    def invalidate(self):
+        self._count = None
+        self._pages = {}
+
+    def set_query(self, query):
+        if query != self.query:
+            self.query = query
+            self.invalidate()
+
+    def count(self):
+        if self._count is None:
+            self._count = self.count_rows(self.query)
+        return self._count
+
+    def _page(self, number):
+        page = self._pages.pop(number, None)
+        if page is None:
+            page = self.fetch_rows(self.query, number * self.page_size, self.page_size)
+            if len(self._pages) >= MAX_CACHED_PAGES:
+                self._pages.pop(next(iter(self._pages)))
+        # La page consultée passe en dernier : la moins récemment lue est évincée en premier
+        self._pages[number] = page
+        return page
+
+    def fetch(self, start, stop):
+        if stop <= start:
+            return []
+        first_page = start // self.page_size
+        rows = []
+        for number in range(first_page, (stop - 1) // self.page_size + 1):
+            rows.extend(self._page(number))
+        offset = start - first_page * self.page_size
+        return rows[offset:offset + stop - start]
+
+
+class VirtualList(ctk.CTkFrame):
+    """Scrollable list that only creates widgets for the rows that fit on screen.
+
+    Row widgets are created once and reused while scrolling; ``refresh``
+    reconfigures only the rows whose content changed, so updating a source
+    never rebuilds the list. When ``on_select`` is given, rows are buttons
+    calling it with the row key, otherwise they are labels.
+    """
+
+    def __init__(self, master, source, on_select=None, row_height=32, row_color="#ebebeb", **kwargs):
+        super().__init__(master, **kwargs)
+        self.source = source
+        self.on_select = on_select
+        self.row_height = row_height
+        self.row_color = row_color
+
+        self._offset = 0
+        self._visible = 0
+        self._rows = []
+        self._rendered = []
+        self._default_colors = []
+
+        self._scrollbar = ctk.CTkScrollbar(self, command=self.yview)
+        self._scrollbar.pack(side="right", fill="y")
+        self._body = ctk.CTkFrame(self, fg_color="transparent")
+        self._body.pack(side="left", fill="both", expand=True)
+        # La taille de la liste ne dépend pas du nombre de lignes affichées
+        self._body.pack_propagate(False)
+
+        self._body.bind("<Configure>", self._on_resize, add="+")
+        self._bind_wheel(self._body)
+
+    def _bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", self._on_wheel, add="+")
+        widget.bind("<Button-4>", self._on_wheel, add="+")
+        widget.bind("<Button-5>", self._on_wheel, add="+")
+
+    def _make_row(self, index):
+        if self.on_select is not None:
+            row = ctk.CTkButton(self._body, text="", height=self.row_height - 4,
+                                command=lambda i=index: self._select(i))
+        else:
+            row = ctk.CTkLabel(self._body, text="", height=self.row_height - 4, fg_color=self.row_color)
+        self._bind_wheel(row)
+        self._rows.append(row)
+        self._rendered.append(None)
+        self._default_colors.append(row.cget("fg_color"))
+
+    def _on_resize(self, event):
+        visible = max(1, event.height // self.row_height)
+        if visible == self._visible:
+            return
+        while len(self._rows) < visible:
+            self._make_row(len(self._rows))
+        for index in range(visible, len(self._rows)):
+            self._rows[index].pack_forget()
+            self._rendered[index] = None
+        self._visible = visible
+        self.refresh()
+
+    def _on_wheel(self, event):
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self.yview("scroll", -3, "units")
+        else:
+            self.yview("scroll", 3, "units")
+
+    def _select(self, index):
+        item = self._rendered[index]
+        if item is not None:
+            self.on_select(item[0])
+
+    def yview(self, *args):
+        total = self.source.count()
+        if args and args[0] == "moveto":
+            self._offset = int(float(args[1]) * total)
+        elif args and args[0] == "scroll":
+            step = int(args[1])
+            self._offset += step * self._visible if args[2] == "pages" else step
+        self.refresh()
+
+    def scroll_to_top(self):
+        self._offset = 0
+        self.refresh()
+
+    def refresh(self):
+        total = self.source.count()
+        self._offset = max(0, min(self._offset, total - self._visible))
+        stop = min(total, self._offset + self._visible)
+        items = self.source.fetch(self._offset, stop) if stop > self._offset else []
+
+        for index in range(self._visible):
+            item = tuple(items[index]) if index < len(items) else None
+            if item == self._rendered[index]:
+                continue  # Ligne inchangée : aucun appel à Tk
+            self._rendered[index] = item
+            row = self._rows[index]
+            if item is None:
+                row.pack_forget()
+                continue
+            key, text, color = item
+            row.configure(text=text, fg_color=color or self._default_colors[index])
+            if not row.winfo_manager():
+                row.pack(fill="x", padx=2, pady=2)
+
+        if total:
+            self._scrollbar.set(self._offset / total, stop / total)
+        else:
+            self._scrollbar.set(0, 1)
@@ -0,0 +1,214 @@
+# watcher.py
+"""Headless processing of the receipt_queue folder, without the Tk UI.
+
+    python watcher.py --event-id 3 [--workers 4] [--once]
+
+Images dropped into the queue folder are picked up once their size and
+modification time have stopped changing, queued as jobs (see jobs.py) and
+processed in batches with batch_processor.process_jobs against the given
+event, then moved to receipt_processed; images that cannot be read are moved
+to receipt_failed.
+SIGINT or SIGTERM stops picking up images and lets the current batch finish;
+a second signal cancels it, leaving its unstored images in the queue.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+import threading
+
+import receipt_reader
+import batch_processor
+import image_preprocessing
+import instrumentation
+import log_setup
+from response_cache import ResponseCache
+from database import ReceiptDatabase
+
+logger = logging.getLogger(__name__)
+
+QUEUE_FOLDER = './receipt_queue'
+PROCESSED_FOLDER = './receipt_processed'
+FAILED_FOLDER = './receipt_failed'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+POLL_INTERVAL = float(os.getenv('RECEIPT_WATCH_INTERVAL', '2'))   # secondes entre deux parcours du dossier
+SETTLE_TIME = float(os.getenv('RECEIPT_WATCH_SETTLE', '1'))       # secondes sans changement avant de prendre une image
+MAX_BATCH = int(os.getenv('RECEIPT_WATCH_BATCH', '20'))           # images prises par passe, donc en mémoire à la fois
+
+
+class QueueWatcher:
+    """Poll ``queue_folder`` and process the images that land in it with a ReceiptDatabase.
+
+    At most ``max_batch`` images are taken per pass and at most ``max_workers``
+    requests are in flight; the next pass starts once the batch is stored.
+    """
+
+    def __init__(self, database, event_id, api_key, queue_folder=QUEUE_FOLDER, processed_folder=PROCESSED_FOLDER,
+                 failed_folder=FAILED_FOLDER, max_workers=batch_processor.DEFAULT_MAX_WORKERS,
+                 batch_size=receipt_reader.BATCH_SIZE, max_batch=MAX_BATCH, poll_interval=POLL_INTERVAL,
+                 settle_time=SETTLE_TIME, preprocess=image_preprocessing.PREPROCESS_ENABLED, cache=None):
+        self.database = database
+        self.event_id = event_id
+        self.api_key = api_key
+        self.queue_folder = queue_folder
+        self.processed_folder = processed_folder
+        self.failed_folder = failed_folder
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_batch = max(1, max_batch)
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.preprocess = preprocess
+        self.cache = cache
+        self.stop_event = threading.Event()
+        self.cancel_event = threading.Event()
+        self.stored = 0
+        self.failed = 0
+        # Chemin -> (taille, date de modification, instant où cette signature a été vue la première fois)
+        self._pending = {}
+        # Images traitées mais restées dans la file (déplacement impossible), à ne pas renvoyer
+        self._stuck = set()
+        # Images dont le job est sous le bail d'un autre worker : chemin -> fin du bail (time.time())
+        self._leased = {}
+
+        for folder in (queue_folder, processed_folder, failed_folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def ready_images(self, now=None):
+        """Return the queued images whose size and mtime are unchanged for settle_time, oldest first."""
+        now = time.monotonic() if now is None else now
+        wall_clock = time.time()
+        self._leased = {path: until for path, until in self._leased.items() if until > wall_clock}
+        present = {}
+        with os.scandir(self.queue_folder) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(IMAGE_EXTENSIONS) or entry.path in self._stuck \
+                        or entry.path in self._leased:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:  # Image retirée pendant le parcours
+                    continue
+                present[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        ready = []
+        pending = {}
+        for path, signature in present.items():
+            previous = self._pending.get(path)
+            since = previous[2] if previous is not None and previous[:2] == signature else now
+            pending[path] = (*signature, since)
+            # Une image encore en cours d'écriture par le scanner change de taille entre deux parcours
+            if previous is not None and now - since >= self.settle_time:
+                ready.append(path)
+        self._pending = pending
+
+        ready.sort(key=lambda path: (pending[path][1], path))
+        return ready[:self.max_batch]
+
+    def process_batch(self, image_paths):
+        results = []
+        # Une image dont le job est encore sous bail (watcher arrêté brutalement) attend l'expiration du bail
+        job_ids = self.database.enqueue_jobs(image_paths, self.event_id)
+        for result in batch_processor.process_jobs(job_ids, self.processed_folder, self.api_key, self.database,
+                                                   max_workers=self.max_workers, preprocess=self.preprocess,
+                                                   cache=self.cache, cancel_event=self.cancel_event,
+                                                   batch_size=self.batch_size):
+            if result.error:
+                self.failed += 1
+                logger.warning("Image %s moved to %s: %s", os.path.basename(result.image_path), self.failed_folder, result.error)
+                receipt_reader.archive_image(result.image_path, self.failed_folder)
+            else:
+                self.stored += 1
+            if os.path.exists(result.image_path):
+                logger.error("Image %s is still in the queue and will be ignored", os.path.basename(result.image_path))
+                self._stuck.add(result.image_path)
+            self._pending.pop(result.image_path, None)
+            results.append(result)
+
+        # Images non réclamées : leur job est en cours ailleurs (autre worker, ou watcher arrêté
+        # brutalement) ; elles sont ignorées jusqu'à l'expiration du bail
+        processed = {result.image_path for result in results}
+        unclaimed = [path for path in image_paths if path not in processed]
+        if unclaimed and not self.cancel_event.is_set():
+            leases = {job.image_path: job.lease_until for job in self.database.unfinished_jobs()}
+            for path in unclaimed:
+                self._leased[path] = leases.get(path) or time.time() + self.poll_interval
+                self._pending.pop(path, None)
+            logger.info("%s queued images are being processed elsewhere, skipped until their lease expires",
+                        len(unclaimed))
+        return results
+
+    def run(self, once=False):
+        """Process the queue until stop() is called, or until it is empty when ``once`` is set."""
+        logger.info("Watching %s for event %s", self.queue_folder, self.event_id)
+        while not self.stop_event.is_set():
+            ready = self.ready_images()
+            if ready:
+                logger.info("Processing %s queued images", len(ready))
+                if self.process_batch(ready):
+                    continue
+            if once and not self._pending:
+                break
+            self.stop_event.wait(self.poll_interval)
+        logger.info("Watcher stopped: %s receipts stored, %s images failed", self.stored, self.failed)
+
+    def stop(self):
+        # Premier appel : fin de la passe en cours ; second appel : abandon de la passe
+        if self.stop_event.is_set():
+            logger.warning("Cancelling the current batch")
+            self.cancel_event.set()
+        else:
+            logger.info("Stopping after the current batch")
+        self.stop_event.set()
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.stop())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--event-id", type=int, required=True)
+    parser.add_argument("--db", default='./receipts.db')
+    parser.add_argument("--queue", default=QUEUE_FOLDER)
+    parser.add_argument("--processed", default=PROCESSED_FOLDER)
+    parser.add_argument("--failed", default=FAILED_FOLDER)
+    parser.add_argument("--workers", type=int, default=batch_processor.DEFAULT_MAX_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=receipt_reader.BATCH_SIZE, help="tickets par requête")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="images prises par passe")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="secondes")
+    parser.add_argument("--settle", type=float, default=SETTLE_TIME, help="secondes")
+    parser.add_argument("--no-preprocess", action="store_true")
+    parser.add_argument("--once", action="store_true", help="s'arrêter quand la file est vide")
+    args = parser.parse_args(argv)
+
+    log_setup.setup_logging()
+
+    database = ReceiptDatabase(args.db)
+    cache = ResponseCache()
+    instrumentation.start_periodic_dump()
+    try:
+        if database.get_event(args.event_id) is None:
+            logger.error("Event %s does not exist", args.event_id)
+            return 2
+        watcher = QueueWatcher(database, args.event_id, receipt_reader.get_api_key(), args.queue, args.processed,
+                               args.failed, max_workers=args.workers, batch_size=args.batch_size,
+                               max_batch=args.max_batch, poll_interval=args.poll_interval, settle_time=args.settle,
+                               preprocess=image_preprocessing.PREPROCESS_ENABLED and not args.no_preprocess,
+                               cache=cache)
+        watcher.install_signal_handlers()
+        watcher.run(once=args.once)
+        return 0
+    finally:
+        instrumentation.stop_periodic_dump()
+        receipt_reader.close_session()
+        cache.close()
+        database.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())